@@ -1,29 +1,44 @@
 import discord
 from discord import app_commands, ui
 from discord.ext import commands
-import database as db
+import async_database as db
 from utils.make_embed import success, error, info
 from utils.format_tag import format_tag
 from utils.helpers import check_ban
 import logging
 from discord.ui import View, Button
-from PIL import ImageFilter
-from PIL import Image
-from ocr_utils import preprocess_image_for_ocr, extract_nicktags, find_best_nicktag
-import requests
+from ocr_utils import parse_roi, image_dhash
+from nicktag_matcher import MatcherCache
+from batch_ocr import reprocess_channel
+import metrics
+from ocr_engine import ScreenshotEngine, EngineSaturated
+from utils.downloads import create_session, check_attachment, download_attachment, DownloadRejected
+from utils.message_filter import MessageFilter
+from ingestion import IngestionQueue, ScreenshotJob
 import asyncio
-from io import BytesIO
 import re
+import weakref
 from datetime import datetime, timezone, timedelta
-import pytesseract
 from discord import SelectOption
 from discord.interactions import Interaction
 import discord
 from discord import Embed, Color
-import sqlite3
 
 logger = logging.getLogger('bot')
 
+SATURATED_MESSAGE = "Hay demasiadas capturas en proceso. Vuelve a enviarla en unos minutos."
+
+# Un lock por (guild, jugador): los clics simultáneos sobre ofertas del mismo jugador se procesan de a uno.
+# La base de datos ya hace cada transferencia en una transacción; esto evita que el segundo clic llegue a intentarlo.
+_player_locks = weakref.WeakValueDictionary()
+
+def player_lock(guild_id: int, player_name: str) -> asyncio.Lock:
+    key = (guild_id, player_name)
+    lock = _player_locks.get(key)
+    if lock is None:
+        lock = _player_locks[key] = asyncio.Lock()
+    return lock
+
 class OfferView(discord.ui.View):
     def __init__(self, offer_id, manager_id, guild_id, is_clause_payment=False):
         super().__init__(timeout=None)
@@ -36,20 +51,27 @@ class OfferView(discord.ui.View):
     async def accept(self, interaction: discord.Interaction, button: ui.Button):
         if await check_ban(interaction, interaction.user.id, self.guild_id):
             return
-        
-        offer = db.get_offer(self.guild_id, self.offer_id)
+
+        player = (await db.get_identity(self.guild_id, interaction.user.id))['player']
+        if not player:
+            await interaction.response.edit_message(embed=error("No eres el jugador objetivo de esta oferta."), view=None)
+            return
+        async with player_lock(self.guild_id, player['name']):
+            await self._accept(interaction, player)
+
+    async def _accept(self, interaction: discord.Interaction, player: dict):
+        offer = await db.get_offer(self.guild_id, self.offer_id)
         if not offer or offer['status'] not in ['pending', 'bought_clause']:
             await interaction.response.edit_message(embed=error("Oferta no válida o ya procesada."), view=None)
             return
         
         # Verificar que el usuario que acepta es el jugador objetivo
-        player = db.get_player_by_id(self.guild_id, interaction.user.id)
-        if not player or player['name'] != offer['player_name']:
+        if player['name'] != offer['player_name']:
             await interaction.response.edit_message(embed=error("No eres el jugador objetivo de esta oferta."), view=None)
             return
         
         if self.is_clause_payment:
-            if db.accept_clause_payment(self.guild_id, self.offer_id):
+            if await db.accept_clause_payment(self.guild_id, self.offer_id):
                 await interaction.response.edit_message(embed=success("Transferencia por cláusula aceptada."), view=None)
                 manager = interaction.client.get_user(self.manager_id)
                 if manager:
@@ -60,7 +82,7 @@ class OfferView(discord.ui.View):
             else:
                 await interaction.response.edit_message(embed=error("Fondos insuficientes."), view=None)
         else:
-            if db.accept_offer(self.guild_id, self.offer_id):
+            if await db.accept_offer(self.guild_id, self.offer_id):
                 await interaction.response.edit_message(embed=success("Oferta aceptada."), view=None)
                 manager = interaction.client.get_user(self.manager_id)
                 if manager:
@@ -76,12 +98,17 @@ class OfferView(discord.ui.View):
         if await check_ban(interaction, interaction.user.id, self.guild_id):
             return
         
-        offer = db.get_offer(self.guild_id, self.offer_id)
-        if not offer or offer['status'] not in ['pending', 'bought_clause']:
+        offer = await db.get_offer(self.guild_id, self.offer_id)
+        if not offer:
             await interaction.response.edit_message(embed=error("Oferta no válida o ya procesada."), view=None)
             return
-        
-        db.reject_offer(self.guild_id, self.offer_id)
+        async with player_lock(self.guild_id, offer['player_name']):
+            # Se vuelve a leer dentro del lock: un clic en Aceptar pudo terminar mientras se esperaba
+            offer = await db.get_offer(self.guild_id, self.offer_id)
+            if not offer or offer['status'] not in ['pending', 'bought_clause']:
+                await interaction.response.edit_message(embed=error("Oferta no válida o ya procesada."), view=None)
+                return
+            await db.reject_offer(self.guild_id, self.offer_id)
         await interaction.response.edit_message(embed=info("Oferta rechazada."), view=None)
         manager = interaction.client.get_user(self.manager_id)
         if manager:
@@ -110,25 +137,25 @@ class ConfirmAmistosoView(ui.View):
 
     @ui.button(label="✅ Aceptar", style=discord.ButtonStyle.green)
     async def accept(self, interaction: discord.Interaction, button: ui.Button):
-        solicitud = db.get_solicitud_by_id(self.guild_id, self.solicitud_id)
+        solicitud = await db.get_solicitud_by_id(self.guild_id, self.solicitud_id)
         if not solicitud or solicitud['status'] != 'pending':
             await interaction.response.send_message(embed=error("Solicitud no válida o ya procesada."), ephemeral=True)
             return
-        team = db.get_team_by_manager(self.guild_id, interaction.user.id) or db.get_team_by_captain(self.guild_id, interaction.user.id)
+        team = (await db.get_identity(self.guild_id, interaction.user.id))['team']
         if not team or team['id'] != solicitud['solicitado_team_id']:
             await interaction.response.send_message(embed=error("No eres el manager ni capitán del equipo solicitado."), ephemeral=True)
             return
 
-        amistosos = db.get_amistosos_for_tabla(self.guild_id, solicitud['tabla_id'])
+        amistosos = await db.get_amistosos_for_tabla(self.guild_id, solicitud['tabla_id'])
         if any(a['horario'] == solicitud['horario'] and (a['team1_id'] in [solicitud['solicitante_team_id'], solicitud['solicitado_team_id']] or a['team2_id'] in [solicitud['solicitante_team_id'], solicitud['solicitado_team_id']]) for a in amistosos):
             await interaction.response.send_message(embed=error("Uno de los equipos ya tiene un amistoso en ese horario."), ephemeral=True)
             return
 
-        db.update_solicitud_status(self.guild_id, self.solicitud_id, 'accepted', interaction.user.id)
-        db.add_amistoso(self.guild_id, solicitud['solicitante_team_id'], solicitud['solicitado_team_id'], solicitud['horario'], solicitud['tabla_id'])
+        await db.update_solicitud_status(self.guild_id, self.solicitud_id, 'accepted', interaction.user.id)
+        await db.add_amistoso(self.guild_id, solicitud['solicitante_team_id'], solicitud['solicitado_team_id'], solicitud['horario'], solicitud['tabla_id'])
 
-        solicitante_team = db.get_team_by_id(self.guild_id, solicitud['solicitante_team_id'])
-        solicitado_team = db.get_team_by_id(self.guild_id, solicitud['solicitado_team_id'])
+        solicitante_team = await db.get_team_by_id(self.guild_id, solicitud['solicitante_team_id'])
+        solicitado_team = await db.get_team_by_id(self.guild_id, solicitud['solicitado_team_id'])
         embed = success(f"Amistoso programado: {solicitante_team['name']} vs {solicitado_team['name']} a las {solicitud['horario']}")
         
         solicitante_manager = self.bot.get_user(solicitante_team['manager_id'])
@@ -138,7 +165,7 @@ class ConfirmAmistosoView(ui.View):
             except discord.HTTPException:
                 pass
         
-        config = db.get_server_config(self.guild_id)
+        config = await db.get_server_config(self.guild_id)
         if config and config['amistosos_channel_id']:
             channel = self.bot.get_channel(config['amistosos_channel_id'])
             if channel:
@@ -149,9 +176,9 @@ class ConfirmAmistosoView(ui.View):
         if config and config['amistosos_channel_id']:
             channel = self.bot.get_channel(config['amistosos_channel_id'])
             if channel and self.cog.amistosos_message_id:
-                tabla = db.get_latest_amistosos_tabla(self.guild_id)
+                tabla = await db.get_latest_amistosos_tabla(self.guild_id)
                 if tabla:
-                    tabla_texto = self.cog.generate_amistosos_table(self.guild_id, tabla['id'])
+                    tabla_texto = await self.cog.generate_amistosos_table(self.guild_id, tabla['id'])
                 else:
                     tabla_texto = "No hay tabla activa."
                 try:
@@ -162,19 +189,19 @@ class ConfirmAmistosoView(ui.View):
 
     @ui.button(label="❌ Rechazar", style=discord.ButtonStyle.red)
     async def reject(self, interaction: discord.Interaction, button: ui.Button):
-        solicitud = db.get_solicitud_by_id(self.guild_id, self.solicitud_id)
+        solicitud = await db.get_solicitud_by_id(self.guild_id, self.solicitud_id)
         if not solicitud or solicitud['status'] != 'pending':
             await interaction.response.send_message(embed=error("Solicitud no válida o ya procesada."), ephemeral=True)
             return
-        team = db.get_team_by_manager(self.guild_id, interaction.user.id) or db.get_team_by_captain(self.guild_id, interaction.user.id)
+        team = (await db.get_identity(self.guild_id, interaction.user.id))['team']
         if not team or team['id'] != solicitud['solicitado_team_id']:
             await interaction.response.send_message(embed=error("No eres el manager ni capitán del equipo solicitado."), ephemeral=True)
             return
 
-        db.update_solicitud_status(self.guild_id, self.solicitud_id, 'rejected', interaction.user.id)
+        await db.update_solicitud_status(self.guild_id, self.solicitud_id, 'rejected', interaction.user.id)
 
-        solicitante_team = db.get_team_by_id(self.guild_id, solicitud['solicitante_team_id'])
-        solicitado_team = db.get_team_by_id(self.guild_id, solicitud['solicitado_team_id'])
+        solicitante_team = await db.get_team_by_id(self.guild_id, solicitud['solicitante_team_id'])
+        solicitado_team = await db.get_team_by_id(self.guild_id, solicitud['solicitado_team_id'])
         embed = error(f"Solicitud de amistoso rechazada: {solicitante_team['name']} vs {solicitado_team['name']} a las {solicitud['horario']}")
         
         solicitante_manager = self.bot.get_user(solicitante_team['manager_id'])
@@ -198,7 +225,7 @@ class TeamBookView(ui.View):
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         return interaction.user.id == self.user_id
 
-    def get_embed(self) -> discord.Embed:
+    async def get_embed(self) -> discord.Embed:
         if self.current_page == 0:
             embed = info("Equipos Registrados")
             if not self.teams:
@@ -214,12 +241,12 @@ class TeamBookView(ui.View):
                 team['manager_id']) if team['manager_id'] else None
             embed.add_field(
                 name="Manager", value=manager.mention if manager else "Sin manager", inline=False)
-            captains = db.get_captains(self.guild_id, team['id'])
+            captains = await db.get_captains(self.guild_id, team['id'])
             captain_mentions = [self.bot.get_user(
                 c).mention for c in captains if self.bot.get_user(c)]
             embed.add_field(name="Capitanes", value=", ".join(
                 captain_mentions) or "Sin capitanes", inline=False)
-            players = db.get_players_by_team(self.guild_id, team['id'])
+            players = await db.get_players_by_team(self.guild_id, team['id'])
             embed.add_field(
                 name="Jugadores",
                 value="\n".join([
@@ -236,19 +263,19 @@ class TeamBookView(ui.View):
     @ui.button(label="🏠", style=discord.ButtonStyle.grey)
     async def home_button(self, interaction: discord.Interaction, button: ui.Button):
         self.current_page = 0
-        await interaction.response.edit_message(embed=self.get_embed(), view=self)
+        await interaction.response.edit_message(embed=await self.get_embed(), view=self)
 
     @ui.button(label="⬅️", style=discord.ButtonStyle.blurple)
     async def prev_button(self, interaction: discord.Interaction, button: ui.Button):
         if self.current_page > 0:
             self.current_page -= 1
-        await interaction.response.edit_message(embed=self.get_embed(), view=self)
+        await interaction.response.edit_message(embed=await self.get_embed(), view=self)
 
     @ui.button(label="➡️", style=discord.ButtonStyle.blurple)
     async def next_button(self, interaction: discord.Interaction, button: ui.Button):
         if self.current_page < len(self.teams):
             self.current_page += 1
-        await interaction.response.edit_message(embed=self.get_embed(), view=self)
+        await interaction.response.edit_message(embed=await self.get_embed(), view=self)
 
     async def on_timeout(self):
         try:
@@ -263,13 +290,18 @@ class EliminarAmistosoView(ui.View):
         self.guild_id = guild_id
         self.add_item(EliminarAmistosoSelect(amistosos, bot, guild_id))
 
+    @classmethod
+    async def create(cls, bot, guild_id: int, tabla_id: int):
+        amistosos = await db.get_amistosos_with_teams(guild_id, tabla_id)
+        return cls(amistosos, bot, guild_id)
+
 class EliminarAmistosoSelect(ui.Select):
     def __init__(self, amistosos, bot, guild_id: int):
         self.bot = bot
         self.guild_id = guild_id
         options = [
             SelectOption(
-                label=f"{db.get_team_by_id(self.guild_id, a['team1_id'])['name']} vs {db.get_team_by_id(self.guild_id, a['team2_id'])['name']} ({a['horario']})",
+                label=f"{a['team1_name'] or 'Desconocido'} vs {a['team2_name'] or 'Desconocido'} ({a['horario']})",
                 value=str(a['id'])
             ) for a in amistosos
         ]
@@ -283,27 +315,26 @@ class EliminarAmistosoSelect(ui.Select):
             return
 
         amistoso_id = int(self.values[0])
-        amistoso = next((a for a in db.get_amistosos_for_tabla(self.guild_id, db.get_latest_amistosos_tabla(self.guild_id)['id']) if a['id'] == amistoso_id), None)
+        tabla = await db.get_latest_amistosos_tabla(self.guild_id)
+        amistosos = await db.get_amistosos_with_teams(self.guild_id, tabla['id']) if tabla else []
+        amistoso = next((a for a in amistosos if a['id'] == amistoso_id), None)
         if not amistoso:
             await interaction.response.send_message(embed=error("Amistoso no encontrado."), ephemeral=True)
             return
 
-        manager_team = db.get_team_by_manager(self.guild_id, interaction.user.id)
-        captain_team = db.get_team_by_captain(self.guild_id, interaction.user.id)
-        team = manager_team or captain_team
+        team = (await db.get_identity(self.guild_id, interaction.user.id))['team']
         if not team or (team['id'] != amistoso['team1_id'] and team['id'] != amistoso['team2_id']):
             await interaction.response.send_message(embed=error("No eres manager ni capitán de los equipos involucrados."), ephemeral=True)
             return
 
-        db.delete_amistoso(self.guild_id, amistoso_id)
+        await db.delete_amistoso(self.guild_id, amistoso_id)
         logger.info(f"Amistoso ID {amistoso_id} eliminado por {interaction.user.name} ({interaction.user.id})")
 
-        team1 = db.get_team_by_id(self.guild_id, amistoso['team1_id'])
-        team2 = db.get_team_by_id(self.guild_id, amistoso['team2_id'])
+        team1_name, team2_name = amistoso['team1_name'] or "Desconocido", amistoso['team2_name'] or "Desconocido"
         recipients = []
-        for t in [team1, team2]:
-            manager_id = t['manager_id']
-            captains = db.get_captains(self.guild_id, t['id'])
+        for team_id, manager_id in ((amistoso['team1_id'], amistoso['team1_manager_id']),
+                                    (amistoso['team2_id'], amistoso['team2_manager_id'])):
+            captains = await db.get_captains(self.guild_id, team_id)
             if manager_id:
                 recipients.append(manager_id)
             recipients.extend(captains)
@@ -313,20 +344,20 @@ class EliminarAmistosoSelect(ui.Select):
                 recipient = self.bot.get_user(recipient_id)
                 if recipient:
                     try:
-                        await recipient.send(embed=info(f"El amistoso entre {team1['name']} y {team2['name']} en el horario {amistoso['horario']} fue eliminado por {interaction.user.name} en el servidor {interaction.guild.name}."))
+                        await recipient.send(embed=info(f"El amistoso entre {team1_name} y {team2_name} en el horario {amistoso['horario']} fue eliminado por {interaction.user.name} en el servidor {interaction.guild.name}."))
                         logger.info(f"Notificación de eliminación enviada a {recipient.name} ({recipient_id})")
                     except discord.Forbidden:
                         logger.warning(f"No se pudo notificar a {recipient.name} ({recipient_id}) - DMs desactivados")
                     except discord.HTTPException as e:
                         logger.error(f"Error HTTP al notificar a {recipient.name} ({recipient_id}): {e}")
 
-        tabla = db.get_latest_amistosos_tabla(self.guild_id)
+        tabla = await db.get_latest_amistosos_tabla(self.guild_id)
         if tabla:
-            table = self.bot.cogs['LeagueCog'].generate_amistosos_table(self.guild_id, tabla['id'])
+            table = await self.bot.cogs['LeagueCog'].generate_amistosos_table(self.guild_id, tabla['id'])
         else:
             table = "No hay tabla activa."
 
-        config = db.get_server_config(self.guild_id)
+        config = await db.get_server_config(self.guild_id)
         if config and config['amistosos_channel_id']:
             channel = self.bot.get_channel(config['amistosos_channel_id'])
             if channel and self.bot.cogs['LeagueCog'].amistosos_message_id:
@@ -398,7 +429,7 @@ class ReviewView(ui.View):
         self.guild_id = guild_id
 
     async def check_arbiter(self, interaction: discord.Interaction):
-        config = db.get_server_config(self.guild_id)
+        config = await db.get_server_config(self.guild_id)
         if not config or not config['arbiter_role_id']:
             return False
         arbiter_role_id = config['arbiter_role_id']
@@ -409,7 +440,7 @@ class ReviewView(ui.View):
         if not await self.check_arbiter(interaction):
             await interaction.response.send_message(embed=error("Solo los árbitros pueden revisar capturas."), ephemeral=True)
             return
-        db.update_screenshot_status(self.guild_id, self.screenshot_id, 'accepted')
+        await db.update_screenshot_status(self.guild_id, self.screenshot_id, 'accepted')
         await interaction.response.edit_message(embed=success(f"Captura #{self.screenshot_id} aceptada."), view=None)
 
     @ui.button(label="❌ Rechazar", style=discord.ButtonStyle.red)
@@ -417,7 +448,7 @@ class ReviewView(ui.View):
         if not await self.check_arbiter(interaction):
             await interaction.response.send_message(embed=error("Solo los árbitros pueden revisar capturas."), ephemeral=True)
             return
-        db.update_screenshot_status(self.guild_id, self.screenshot_id, 'rejected')
+        await db.update_screenshot_status(self.guild_id, self.screenshot_id, 'rejected')
         await interaction.response.edit_message(embed=success(f"Captura #{self.screenshot_id} rechazada."), view=None)
 
 class LeagueCog(commands.Cog):
@@ -425,16 +456,30 @@ class LeagueCog(commands.Cog):
         self.bot = bot
         self.tz_minus_3 = timezone(timedelta(hours=-3))
         self.amistosos_message_id = None
-
-    def generate_amistosos_table(self, guild_id: int, tabla_id: int) -> str:
-        horarios = db.get_horarios_for_tabla(tabla_id, guild_id)
-        amistosos = db.get_amistosos_for_tabla(guild_id, tabla_id)
+        self.ocr_engine = ScreenshotEngine()
+        self.http_session = None
+        self.message_filter = MessageFilter()
+        self.ingestion = IngestionQueue(self.process_screenshot)
+        self.nicktag_matchers = MatcherCache()
+
+    async def cog_load(self):
+        self.ocr_engine.start()
+        self.http_session = create_session()
+        self.ingestion.start()
+
+    async def cog_unload(self):
+        await self.ingestion.stop()
+        self.ocr_engine.shutdown()
+        if self.http_session:
+            await self.http_session.close()
+
+    async def generate_amistosos_table(self, guild_id: int, tabla_id: int) -> str:
+        horarios = await db.get_horarios_for_tabla(tabla_id, guild_id)
+        amistosos = await db.get_amistosos_with_teams(guild_id, tabla_id)
         partidos_por_horario = {h['horario']: "Disponible" if h['disponible'] else "Ocupado" for h in horarios}
         for amistoso in amistosos:
-            team1 = db.get_team_by_id(guild_id, amistoso['team1_id'])
-            team2 = db.get_team_by_id(guild_id, amistoso['team2_id'])
-            if team1 and team2:
-                partidos_por_horario[amistoso['horario']] = f"**{team1['name']} vs {team2['name']}** ⚽"
+            if amistoso['team1_name'] and amistoso['team2_name']:
+                partidos_por_horario[amistoso['horario']] = f"**{amistoso['team1_name']} vs {amistoso['team2_name']}** ⚽"
         table = f"```\n📅 Tabla de Amistosos (ID: {tabla_id}) 📅\n⚽ Horario | Partido ⚽\n{'═'*30}\n"
         for horario in [h['horario'] for h in horarios]:
             partido = partidos_por_horario[horario]
@@ -444,113 +489,139 @@ class LeagueCog(commands.Cog):
 
     @commands.Cog.listener()
     async def on_message(self, message):
-        if message.author.bot:
-            logger.debug("Ignorando mensaje de un bot.")
-            return
-
-        config = db.get_server_config(message.guild.id)
-        if not config or not config.get('ss_channel_ids', []) or message.channel.id not in config['ss_channel_ids']:
-            return
-
-        if not config['arbiter_role_id']:
-            logger.warning(f"No se encontró rol de árbitro configurado en guild {message.guild.id}")
+        reason, config, images = await self.message_filter.check(message)
+        if reason == 'not_image' and config:
+            await message.reply(embed=error("Por favor, envía una imagen en formato PNG o JPG."))
             return
-
-        if not message.attachments:
-            logger.debug(f"Mensaje en {message.channel.id} sin adjuntos, ignorado.")
+        if reason:
             return
 
-        await asyncio.sleep(1)
         logger.info(f"Mensaje recibido en canal {message.channel.id} por {message.author} con adjuntos: {message.attachments}")
 
-        attachment = message.attachments[0]
-        if not attachment.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            await message.reply(embed=error("Por favor, envía una imagen en formato PNG o JPG."))
-            return
+        with metrics.span('player'):
+            player = await db.get_player_by_id(message.guild.id, message.author.id)
+        if not player:
+            return  # no es jugador
 
-        guild_id = message.guild.id
-        user_id = message.author.id
-        player = db.get_player_by_id(guild_id, user_id)
+        for attachment in images:
+            try:
+                check_attachment(attachment)
+            except DownloadRejected as e:
+                await message.reply(embed=error(f"{attachment.filename}: {e}"))
+                continue
+            if not self.ingestion.submit(ScreenshotJob(message, attachment, config)):
+                await message.reply(embed=error(SATURATED_MESSAGE))
+                break
 
-        if not player:
-            team = db.get_team_by_manager(guild_id, user_id)
-            if team:
-                db_path = db.get_db_path(guild_id)
-                with sqlite3.connect(db_path) as conn:
-                    conn.row_factory = sqlite3.Row
-                    cur = conn.cursor()
-                    cur.execute('SELECT * FROM players WHERE team_id = ? AND user_id = ?', (team['id'], user_id))
-                    player = cur.fetchone()
+        await self.bot.process_commands(message)
 
-        if not player:
-            return  # no es jugador 
+    async def process_screenshot(self, job: ScreenshotJob) -> str:
+        message, attachment, config = job.message, job.attachment, job.config
+        guild_id = job.guild_id
+
+        if self.ocr_engine.saturated:
+            await message.reply(embed=error(SATURATED_MESSAGE))
+            return 'saturated'
 
         try:
-            response = requests.get(attachment.url)
-            response.raise_for_status()
-            img = Image.open(BytesIO(response.content))
-            img = preprocess_image_for_ocr(img)
+            with metrics.span('download'):
+                data = await download_attachment(self.http_session, attachment)
+        except DownloadRejected as e:
+            await message.reply(embed=error(str(e)))
+            return 'rejected'
         except Exception as e:
-            logger.error(f"Error al procesar la imagen: {e}")
+            logger.error(f"Error al descargar la imagen: {e}")
             await message.reply(embed=error("Error al procesar la imagen. Intenta de nuevo."))
-            return
+            return 'error'
 
-        try:
-            text = pytesseract.image_to_string(img, lang='eng')
-            logger.debug(f"Texto extraído por OCR: {text}")
-            text = text.replace('O', '0').replace('I', '1').replace('l', '1')
-        except Exception as e:
-            logger.error(f"Error en OCR: {e}")
-            await message.reply(embed=error("Error al procesar la imagen con OCR. Intenta de nuevo."))
-            return
+        with metrics.span('dedup'):
+            try:
+                image_hash = await asyncio.to_thread(image_dhash, data)
+            except Exception as e:
+                logger.warning(f"No se pudo calcular el hash de la imagen: {e}")
+                image_hash = None
+            duplicate = await db.find_duplicate_screenshot(guild_id, image_hash) if image_hash is not None else None
+        if duplicate:
+            # Misma imagen (o casi) ya procesada: se reutiliza su OCR y se marca para los árbitros
+            logger.info(f"Captura de {message.author} parecida a la #{duplicate['screenshot_id']} (distancia {duplicate['distance']}).")
+            result = {'text': '', 'nicktags': duplicate['nicktags'], 'screenshot_time': duplicate['screenshot_time']}
+        else:
+            try:
+                roi = await db.get_ocr_roi(guild_id)
+                with metrics.span('ocr_total'):
+                    result = await self.ocr_engine.process(data, roi)
+                # decode, preprocess y ocr se miden dentro del proceso de OCR
+                metrics.record_stages(result['timings'])
+                logger.debug(f"Texto extraído por OCR: {result['text']}")
+            except EngineSaturated:
+                await message.reply(embed=error(SATURATED_MESSAGE))
+                return 'saturated'
+            except Exception as e:
+                logger.error(f"Error en OCR: {e}")
+                await message.reply(embed=error("Error al procesar la imagen con OCR. Intenta de nuevo."))
+                return 'error'
 
-        nicktags = extract_nicktags(text)
         discord_name = message.author.name
         discord_display = message.author.display_name
-        nicktag = find_best_nicktag(nicktags, discord_name, discord_display)
-
-        time_pattern = re.compile(r'\b([01]?\d|2[0-3])[:.][0-5]\d\b')
-        time_match = time_pattern.search(text)
-        screenshot_time = time_match.group(0).replace('.', ':') if time_match else None
+        with metrics.span('match'):
+            matcher = await self.nicktag_matchers.get(guild_id)
+            match = matcher.match_player(result['nicktags'], job.user_id, aliases={job.user_id: (discord_name, discord_display)})
+        nicktag = match['tag'] if match else None
+        screenshot_time = result['screenshot_time']
 
-        review_channel_id = config['ss_channel_ids'][0]
+        review_channel_id = config['review_channel_id']
         review_channel = self.bot.get_channel(review_channel_id)
         arbiter_role = message.guild.get_role(config['arbiter_role_id'])
         if not review_channel or not arbiter_role:
             logger.error(f"Canal de revisión {review_channel_id} o rol {config['arbiter_role_id']} no encontrado.")
             await message.reply(embed=error("Error interno: canal o rol no encontrado. Contacta a un admin."))
-            return
-
-        screenshot_id = db.add_screenshot(
-            message.guild.id,
-            message.author.id,
-            nicktag or "No detectado",
-            discord_name,
-            message.channel.id,
-            attachment.url,
-            screenshot_time
-        )
-
-        if nicktag and screenshot_time:
-            db.update_screenshot_status(message.guild.id, screenshot_id, 'accepted')
-            await message.reply(embed=success(f"Captura validada correctamente. NICKTAG: {nicktag}, Hora: {screenshot_time}"))
-        else:
-            embed = info(f"Captura dudosa #{screenshot_id} de {discord_name}")
-            embed.add_field(name="NICKTAG detectado", value=nicktag or "No detectado", inline=False)
-            embed.add_field(name="Nombre Discord", value=discord_name, inline=False)
-            embed.add_field(name="Hora detectada", value=screenshot_time or "No detectada", inline=False)
-            embed.set_image(url=attachment.url)
-            view = ReviewView(screenshot_id, message.guild.id)
+            return 'error'
+
+        with metrics.span('db_insert'):
+            screenshot_id = await db.add_screenshot(
+                message.guild.id,
+                message.author.id,
+                nicktag or "No detectado",
+                discord_name,
+                message.channel.id,
+                attachment.url,
+                screenshot_time,
+                duplicate_of=duplicate['screenshot_id'] if duplicate else None,
+                attachment_id=attachment.id
+            )
+            if image_hash is not None and not duplicate and screenshot_id != -1:
+                await db.add_screenshot_hash(guild_id, image_hash, screenshot_id, result['nicktags'], screenshot_time)
+            accepted = bool(nicktag and screenshot_time and not duplicate)
+            if accepted:
+                await db.update_screenshot_status(message.guild.id, screenshot_id, 'accepted')
+
+        if accepted:
+            with metrics.span('reply'):
+                await message.reply(embed=success(f"Captura validada correctamente. NICKTAG: {nicktag}, Hora: {screenshot_time}"))
+            return 'accepted'
+
+        embed = info(f"Captura dudosa #{screenshot_id} de {discord_name}")
+        embed.add_field(name="NICKTAG detectado", value=f"{nicktag} ({match['confidence']:.0%})" if match else "No detectado", inline=False)
+        embed.add_field(name="Nombre Discord", value=discord_name, inline=False)
+        embed.add_field(name="Hora detectada", value=screenshot_time or "No detectada", inline=False)
+        if duplicate:
+            embed.add_field(name="⚠️ Posible duplicado", value=f"Igual o muy parecida a la captura #{duplicate['screenshot_id']}", inline=False)
+        embed.set_image(url=attachment.url)
+        view = ReviewView(screenshot_id, message.guild.id)
+        with metrics.span('review_post'):
             await review_channel.send(content=f"{arbiter_role.mention}", embed=embed, view=view)
-            await message.reply(embed=error("Captura enviada a revisión: datos incompletos."))
-
-        await self.bot.process_commands(message)
+        with metrics.span('reply'):
+            if duplicate:
+                await message.reply(embed=error("Captura enviada a revisión: parece una captura ya enviada."))
+            else:
+                await message.reply(embed=error("Captura enviada a revisión: datos incompletos."))
+        return 'duplicate' if duplicate else 'review'
 
     @app_commands.command(name="set_registro_channel", description="Establece el canal para registros de jugadores (solo admin)")
     @app_commands.describe(canal="Canal para registros")
     @app_commands.checks.has_permissions(administrator=True)
     async def set_registro_channel(self, interaction: discord.Interaction, canal: discord.TextChannel):
-        db.set_registro_channel(interaction.guild.id, canal.id)
+        await db.set_registro_channel(interaction.guild.id, canal.id)
         await interaction.response.send_message(embed=success(f"Canal de registros establecido a {canal.mention}."), ephemeral=True)
     
     @app_commands.command(name="test_command", description="Comando de prueba para verificar sincronización")
@@ -559,7 +630,7 @@ class LeagueCog(commands.Cog):
 
     @app_commands.command(name="check_market", description="Verifica el estado del mercado")
     async def check_market(self, interaction: discord.Interaction):
-        status = db.get_market_status(interaction.guild.id)
+        status = await db.get_market_status(interaction.guild.id)
         await interaction.response.send_message(f"El mercado está {status}.", ephemeral=True)
 
     @app_commands.command(name="ss", description="Ver historial de capturas")
@@ -570,7 +641,7 @@ class LeagueCog(commands.Cog):
             return
 
         user_id = jugador.id if jugador else interaction.user.id
-        screenshots = db.get_screenshots_by_user(interaction.guild.id, user_id)
+        screenshots = await db.get_screenshots_by_user(interaction.guild.id, user_id)
         if not screenshots:
             await interaction.response.send_message(embed=info("No hay capturas registradas."), ephemeral=True)
             return
@@ -634,7 +705,7 @@ class LeagueCog(commands.Cog):
             return
 
         ss_channel_ids_str = ','.join(map(str, channel_ids))
-        db.set_server_settings(interaction.guild.id, ss_channel_ids_str, rol.id)
+        await db.set_server_settings(interaction.guild.id, ss_channel_ids_str, rol.id)
 
         channel_mentions_str = ', '.join([f'<#{id}>' for id in channel_ids])
         await interaction.response.send_message(
@@ -642,18 +713,65 @@ class LeagueCog(commands.Cog):
             ephemeral=True
         )
     
+    @app_commands.command(name="set_ocr_roi", description="Define la zona de la captura que lee el OCR (solo admin)")
+    @app_commands.describe(
+        region="Zona a configurar",
+        x0="Borde izquierdo en % del ancho", y0="Borde superior en % del alto",
+        x1="Borde derecho en % del ancho", y1="Borde inferior en % del alto",
+        borrar="Quita la zona y vuelve a leer la captura completa"
+    )
+    @app_commands.choices(region=[
+        app_commands.Choice(name="Lista de nicktags", value="nicktags"),
+        app_commands.Choice(name="Reloj", value="clock"),
+    ])
+    @app_commands.checks.has_permissions(administrator=True)
+    async def set_ocr_roi(self, interaction: discord.Interaction, region: app_commands.Choice[str],
+                          x0: int = 0, y0: int = 0, x1: int = 100, y1: int = 100, borrar: bool = False):
+        roi = await db.get_ocr_roi(interaction.guild.id)
+        if borrar:
+            roi.pop(region.value, None)
+        else:
+            roi[region.value] = [x0 / 100, y0 / 100, x1 / 100, y1 / 100]
+        try:
+            roi = parse_roi(roi)
+        except ValueError as e:
+            await interaction.response.send_message(embed=error(f"Zona inválida: {e}"), ephemeral=True)
+            return
+        await db.set_ocr_roi(interaction.guild.id, roi)
+        if not roi:
+            description = "Sin zonas: el OCR lee la captura completa."
+        else:
+            description = "\n".join(
+                f"**{name}**: x {box[0]:.0%}–{box[2]:.0%}, y {box[1]:.0%}–{box[3]:.0%}" for name, box in roi.items())
+        await interaction.response.send_message(embed=success(f"Zonas de OCR actualizadas.\n{description}"), ephemeral=True)
+
+    @app_commands.command(name="reprocesarcapturas", description="Vuelve a pasar por el OCR las capturas de un canal (solo admin)")
+    @app_commands.describe(canal="Canal de capturas", limite="Número de mensajes a revisar (por defecto 1000)")
+    @app_commands.checks.has_permissions(administrator=True)
+    async def reprocesarcapturas(self, interaction: discord.Interaction, canal: discord.TextChannel, limite: int = 1000):
+        await interaction.response.defer(ephemeral=True, thinking=True)
+
+        async def progress(summary):
+            await interaction.edit_original_response(
+                embed=info(f"Reprocesando {canal.mention}: {summary.get('processed', 0)} capturas de {summary.get('messages', 0)} mensajes..."))
+
+        summary = await reprocess_channel(canal, interaction.guild.id, self.ocr_engine, self.http_session, limite, progress)
+        await interaction.edit_original_response(embed=success(
+            f"Reprocesadas {summary.get('processed', 0)} capturas de {summary.get('messages', 0)} mensajes en {summary['seconds']:.1f}s: "
+            f"{summary.get('updated', 0)} actualizadas, {summary.get('inserted', 0)} nuevas, {summary.get('errors', 0)} errores."))
+
     @app_commands.command(name="asignarcanalamistosos", description="Asignar el canal para tablas de amistosos (solo admin)")
     @app_commands.describe(canal="Canal para tablas de amistosos")
     @app_commands.checks.has_permissions(administrator=True)
     async def asignarcanalamistosos(self, interaction: discord.Interaction, canal: discord.TextChannel):
-        db.set_amistosos_channel(interaction.guild.id, canal.id)
+        await db.set_amistosos_channel(interaction.guild.id, canal.id)
         await interaction.response.send_message(embed=success(f"Canal de tablas de amistosos establecido a {canal.mention}."), ephemeral=True)
     
     @app_commands.command(name="crearequipo", description="Crear un equipo nuevo")
     @app_commands.describe(nombre="Nombre del equipo", division="División del equipo")
     @app_commands.checks.has_permissions(administrator=True)
     async def crearequipo(self, interaction: discord.Interaction, nombre: str, division: str):
-        if db.add_team(interaction.guild.id, nombre, division):
+        if await db.add_team(interaction.guild.id, nombre, division):
             await interaction.response.send_message(embed=success(f"Equipo {nombre} creado en división {division}."), ephemeral=True)
         else:
             await interaction.response.send_message(embed=error("El equipo ya existe o el manager ya está asignado a otro equipo."), ephemeral=True)
@@ -662,46 +780,48 @@ class LeagueCog(commands.Cog):
     @app_commands.describe(equipo="Nombre del equipo", manager="Usuario a asignar")
     @app_commands.checks.has_permissions(administrator=True)
     async def asignarmanager(self, interaction: discord.Interaction, equipo: str, manager: discord.User):
-        team = db.get_team_by_name(interaction.guild.id, equipo)
+        team = await db.get_team_by_name(interaction.guild.id, equipo)
         if not team:
             await interaction.response.send_message(embed=error("Equipo no encontrado."), ephemeral=True)
             return
         if team and team['manager_id'] is not None:
             await interaction.response.send_message(embed=error("El equipo ya tiene un manager."), ephemeral=True)
             return
-        if db.get_team_by_manager(interaction.guild.id, manager.id):
+        if await db.get_team_by_manager(interaction.guild.id, manager.id):
             await interaction.response.send_message(embed=error("El usuario ya es manager de otro equipo."), ephemeral=True)
             return
-        db.assign_manager_to_team(interaction.guild.id, team['id'], manager.id)
+        await db.assign_manager_to_team(interaction.guild.id, team['id'], manager.id)
         await interaction.response.send_message(embed=success(f"{manager.name} asignado como manager de {equipo}."))
 
     @app_commands.command(name="registrarjugador", description="Regístrate como jugador en la liga")
     async def registrarjugador(self, interaction: discord.Interaction):
         user = interaction.user
         
-        config = db.get_server_config(interaction.guild.id)
+        config = await db.get_server_config(interaction.guild.id)
         if config and 'registro_channel_id' in config and interaction.channel_id != config['registro_channel_id']:
             await interaction.response.send_message(embed=error("Este comando solo puede usarse en el canal de registros."), ephemeral=True)
             return
     
-        if db.get_team_by_manager(interaction.guild.id, user.id):
+        identity = await db.get_identity(interaction.guild.id, user.id)
+        if identity['manager_of']:
             await interaction.response.send_message(embed=error(f"{user.name} es manager y no puede ser jugador."), ephemeral=True)
             return
     
-        existing_player = db.get_player_by_id(interaction.guild.id, user.id)
+        existing_player = identity['player']
         if existing_player:
             await interaction.response.send_message(embed=error(f"{user.name} ya está registrado como {existing_player['name']}."),
                                                     ephemeral=True)
             return
     
-        if db.add_player(interaction.guild.id, user.name, user.id):
+        if await db.add_player(interaction.guild.id, user.name, user.id):
+            self.nicktag_matchers.invalidate(interaction.guild.id)
             await interaction.response.send_message(embed=success(f"{user.name} registrado como jugador."), ephemeral=True)
         else:
             await interaction.response.send_message(embed=error("Error al registrarte. Contacta a un administrador."), ephemeral=True)
 
     @app_commands.command(name="agenteslibres", description="Mostrar la lista de agentes libres")
     async def agenteslibres(self, interaction: discord.Interaction):
-        players = db.get_free_agents(interaction.guild.id)
+        players = await db.get_free_agents(interaction.guild.id)
         if not players:
             await interaction.response.send_message(embed=error("No hay agentes libres disponibles."), ephemeral=True)
             return
@@ -725,15 +845,15 @@ class LeagueCog(commands.Cog):
     @app_commands.describe(equipo="Nombre del equipo", jugador="Jugador a agregar como capitán")
     @app_commands.checks.has_permissions(administrator=True)
     async def agregarcapitan(self, interaction: discord.Interaction, equipo: str, jugador: discord.User):
-        team = db.get_team_by_name(interaction.guild.id, equipo)
+        team = await db.get_team_by_name(interaction.guild.id, equipo)
         if not team:
             await interaction.response.send_message(embed=error("Equipo no encontrado."), ephemeral=True)
             return
-        player = db.get_player_by_id(interaction.guild.id, jugador.id)
+        player = await db.get_player_by_id(interaction.guild.id, jugador.id)
         if not player:
             await interaction.response.send_message(embed=error("Jugador no encontrado."), ephemeral=True)
             return
-        if db.add_captain(interaction.guild.id, team['id'], jugador.id):
+        if await db.add_captain(interaction.guild.id, team['id'], jugador.id):
             await interaction.response.send_message(embed=success(f"{jugador.name} agregado como capitán de {equipo}."), ephemeral=True)
         else:
             await interaction.response.send_message(embed=error("El jugador ya es capitán o error al agregar."), ephemeral=True)
@@ -742,11 +862,11 @@ class LeagueCog(commands.Cog):
     @app_commands.describe(equipo="Nombre del equipo", jugador="Jugador a quitar como capitán")
     @app_commands.checks.has_permissions(administrator=True)
     async def quitarcapitan(self, interaction: discord.Interaction, equipo: str, jugador: discord.User):
-        team = db.get_team_by_name(interaction.guild.id, equipo)
+        team = await db.get_team_by_name(interaction.guild.id, equipo)
         if not team:
             await interaction.response.send_message(embed=error("Equipo no encontrado."), ephemeral=True)
             return
-        if db.remove_captain(interaction.guild.id, team['id'], jugador.id):
+        if await db.remove_captain(interaction.guild.id, team['id'], jugador.id):
             await interaction.response.send_message(embed=success(f"{jugador.name} removido como capitán de {equipo}."), ephemeral=True)
         else:
             await interaction.response.send_message(embed=error("El jugador no es capitán o error al quitar."), ephemeral=True)
@@ -757,7 +877,7 @@ class LeagueCog(commands.Cog):
         if await check_ban(interaction, jugador.id, interaction.guild.id):
             return
 
-        manager_team = db.get_team_by_manager(interaction.guild.id, interaction.user.id)
+        manager_team = (await db.get_identity(interaction.guild.id, interaction.user.id))['manager_of']
         if not manager_team:
             await interaction.response.send_message(embed=error("No eres manager de ningún equipo."), ephemeral=True)
             return
@@ -766,16 +886,16 @@ class LeagueCog(commands.Cog):
             await interaction.response.send_message(embed=error("Cláusula y duración deben ser positivas."), ephemeral=True)
             return
 
-        player = db.get_player_by_id(interaction.guild.id, jugador.id)
+        player = (await db.get_identity(interaction.guild.id, jugador.id))['player']
         if not player:
             await interaction.response.send_message(embed=error(f"{jugador.name} no está registrado como jugador."), ephemeral=True)
             return
 
-        if db.has_pending_offer(interaction.guild.id, interaction.user.id, jugador.id):
+        if await db.has_pending_offer(interaction.guild.id, interaction.user.id, jugador.id):
             await interaction.response.send_message(embed=error("Ya existe una oferta pendiente para este jugador."), ephemeral=True)
             return
 
-        offer_id = db.create_transfer_offer(
+        offer_id = await db.create_transfer_offer(
             interaction.guild.id,
             player['name'],
             None if not player['team_id'] else player['team_id'],
@@ -792,6 +912,9 @@ class LeagueCog(commands.Cog):
         elif offer_id == -2:
             await interaction.response.send_message(embed=error("El mercado está cerrado."), ephemeral=True)
             return
+        elif offer_id == -3:
+            await interaction.response.send_message(embed=error("La cláusula supera el máximo permitido."), ephemeral=True)
+            return
 
         view = OfferView(offer_id, interaction.user.id, interaction.guild.id)
         try:
@@ -803,26 +926,26 @@ class LeagueCog(commands.Cog):
     @app_commands.command(name="cancelaroferta", description="Cancelar una oferta enviada")
     @app_commands.describe(oferta_id="ID de la oferta")
     async def cancelaroferta(self, interaction: discord.Interaction, oferta_id: int):
-        offer = db.get_offer(interaction.guild.id, oferta_id)
+        offer = await db.get_offer(interaction.guild.id, oferta_id)
         if not offer or offer['from_manager_id'] != interaction.user.id:
             await interaction.response.send_message(embed=error("Oferta no encontrada o no autorizada."), ephemeral=True)
             return
         if offer['status'] not in ['pending', 'bought_clause']:
             await interaction.response.send_message(embed=error("Solo puedes cancelar ofertas pendientes o de cláusula."), ephemeral=True)
             return
-        db.update_offer_status(interaction.guild.id, oferta_id, 'cancelled')
+        await db.update_offer_status(interaction.guild.id, oferta_id, 'cancelled')
         await interaction.response.send_message(embed=success("Oferta cancelada."), ephemeral=True)
 
     @app_commands.command(name="ofertaspendientes", description="Ver todas las ofertas pendientes")
     async def ofertaspendientes(self, interaction: discord.Interaction):
-        player = db.get_player_by_id(interaction.guild.id, interaction.user.id)
+        player = await db.get_player_by_id(interaction.guild.id, interaction.user.id)
         if player and player['banned']:
             await interaction.response.send_message(embed=error("Estás sancionado y no puedes usar este comando."), ephemeral=True)
             return
-        sent = db.list_offers_by_manager(interaction.guild.id, interaction.user.id, 'pending') + \
-            db.list_offers_by_manager(
+        sent = await db.list_offers_by_manager(interaction.guild.id, interaction.user.id, 'pending') + \
+            await db.list_offers_by_manager(
                 interaction.guild.id, interaction.user.id, 'bought_clause')
-        received = db.list_offers_for_player(interaction.guild.id, interaction.user.id, 'pending') + db.list_offers_for_player(
+        received = await db.list_offers_for_player(interaction.guild.id, interaction.user.id, 'pending') + await db.list_offers_for_player(
             interaction.guild.id, interaction.user.id, 'bought_clause') if player else []
         embed = info("Ofertas pendientes:")
         if sent:
@@ -840,11 +963,11 @@ class LeagueCog(commands.Cog):
     async def perfil(self, interaction: discord.Interaction, jugador: discord.User):
         if await check_ban(interaction, jugador.id, interaction.guild.id):
             return
-        player = db.get_player_by_id(interaction.guild.id, jugador.id)
+        player = await db.get_player_by_id(interaction.guild.id, jugador.id)
         if not player:
             await interaction.response.send_message(embed=error("Jugador no encontrado."), ephemeral=True)
             return
-        team = db.get_team_by_id(
+        team = await db.get_team_by_id(
             interaction.guild.id, player['team_id']) if player['team_id'] else None
         embed = info(f"Perfil de {jugador.name}")
         embed.add_field(
@@ -862,7 +985,7 @@ class LeagueCog(commands.Cog):
     @app_commands.command(name="equipo", description="Ver información de un equipo")
     @app_commands.describe(equipo="Nombre del equipo")
     async def equipo(self, interaction: discord.Interaction, equipo: str):
-        team = db.get_team_by_name(interaction.guild.id, equipo)
+        team = await db.get_team_by_name(interaction.guild.id, equipo)
         if not team:
             await interaction.response.send_message(embed=error("Equipo no encontrado."), ephemeral=True)
             return
@@ -871,23 +994,24 @@ class LeagueCog(commands.Cog):
         embed = info(f"Equipo {team['name']} (División {team['division']})")
         embed.add_field(
             name="Manager", value=manager.mention if manager else "Sin manager", inline=True)
-        captains = db.get_captains(interaction.guild.id, team['id'])
+        captains = await db.get_captains(interaction.guild.id, team['id'])
         captain_mentions = [self.bot.get_user(
             c).mention for c in captains if self.bot.get_user(c)]
         embed.add_field(name="Capitanes", value=", ".join(
             captain_mentions) or "Sin capitanes", inline=True)
+        balance = await db.get_club_balance(interaction.guild.id, team['id'])
         embed.add_field(
-            name="Balance", value=f"{db.get_club_balance(interaction.guild.id, team['id']):,}", inline=True)
+            name="Balance", value=f"{balance:,}", inline=True)
         await interaction.response.send_message(embed=embed)
 
     @app_commands.command(name="players", description="Ver jugadores de un equipo")
     @app_commands.describe(equipo="Nombre del equipo")
     async def players(self, interaction: discord.Interaction, equipo: str):
-        team = db.get_team_by_name(interaction.guild.id, equipo)
+        team = await db.get_team_by_name(interaction.guild.id, equipo)
         if not team:
             await interaction.response.send_message(embed=error("Equipo no encontrado."), ephemeral=True)
             return
-        players = db.get_players_by_team(interaction.guild.id, team['id'])
+        players = await db.get_players_by_team(interaction.guild.id, team['id'])
         embed = info(f"Jugadores de {equipo}")
         embed.description = "\n".join(
             [f"{p['name']}: {p['contract_duration'] or 'Sin contrato'}" for p in players]) or "No hay jugadores."
@@ -898,11 +1022,11 @@ class LeagueCog(commands.Cog):
     async def historialjugador(self, interaction: discord.Interaction, jugador: discord.User):
         if await check_ban(interaction, jugador.id, interaction.guild.id):
             return
-        player = db.get_player_by_id(interaction.guild.id, jugador.id)
+        player = await db.get_player_by_id(interaction.guild.id, jugador.id)
         if not player:
             await interaction.response.send_message(embed=error("Jugador no encontrado."), ephemeral=True)
             return
-        history = db.get_transfer_history_by_player(
+        history = await db.get_transfer_history_by_player(
             interaction.guild.id, player['name'])
         embed = info(f"Historial de {jugador.name}")
         embed.description = "\n".join(history) or "Sin historial."
@@ -911,11 +1035,11 @@ class LeagueCog(commands.Cog):
     @app_commands.command(name="historialequipo", description="Ver historial de transferencias de un equipo")
     @app_commands.describe(equipo="Nombre del equipo")
     async def historialequipo(self, interaction: discord.Interaction, equipo: str):
-        team = db.get_team_by_name(interaction.guild.id, equipo)
+        team = await db.get_team_by_name(interaction.guild.id, equipo)
         if not team:
             await interaction.response.send_message(embed=error("Equipo no encontrado."), ephemeral=True)
             return
-        history = db.get_transfer_history_by_team(
+        history = await db.get_transfer_history_by_team(
             interaction.guild.id, team['id'])
         embed = info(f"Historial de {equipo}")
         embed.description = "\n".join(history) or "Sin historial."
@@ -930,30 +1054,37 @@ class LeagueCog(commands.Cog):
     async def pagarclausula(self, interaction: discord.Interaction, jugador: discord.User, duracion: int, clausula: int):
         if await check_ban(interaction, jugador.id, interaction.guild.id):
             return
-        manager_team = db.get_team_by_manager(
+        manager_team = await db.get_team_by_manager(
             interaction.guild.id, interaction.user.id)
         if not manager_team:
             await interaction.response.send_message(embed=error("No eres manager de ningún equipo."), ephemeral=True)
             return
-        player = db.get_player_by_id(interaction.guild.id, jugador.id)
+        player = await db.get_player_by_id(interaction.guild.id, jugador.id)
         if not player or not player['release_clause']:
             await interaction.response.send_message(embed=error("El jugador no tiene cláusula."), ephemeral=True)
             return
         if player['team_id'] == manager_team['id']:
             await interaction.response.send_message(embed=error("El jugador ya está en tu equipo."), ephemeral=True)
             return
-        offer_id = db.pay_clause_and_transfer(
-            guild_id=interaction.guild.id,
-            player_name=player['name'],
-            to_team_id=manager_team['id'],
-            price=player['release_clause'],
-            manager_id=interaction.user.id,
-            duration=duracion,
-            new_clause=clausula
-        )
+        async with player_lock(interaction.guild.id, player['name']):
+            offer_id = await db.pay_clause_and_transfer(
+                guild_id=interaction.guild.id,
+                player_name=player['name'],
+                to_team_id=manager_team['id'],
+                price=player['release_clause'],
+                manager_id=interaction.user.id,
+                duration=duracion,
+                new_clause=clausula
+            )
         if offer_id == -1:
             await interaction.response.send_message(embed=error("Fondos insuficientes."), ephemeral=True)
             return
+        elif offer_id == -2:
+            await interaction.response.send_message(embed=error("El mercado está cerrado."), ephemeral=True)
+            return
+        elif offer_id == -4:
+            await interaction.response.send_message(embed=error("La cláusula del jugador cambió o ya hay una cláusula pagada pendiente. Inténtalo de nuevo."), ephemeral=True)
+            return
         view = OfferView(offer_id, interaction.user.id, interaction.guild.id, is_clause_payment=True)
         try:
             await jugador.send(embed=info(
@@ -973,17 +1104,17 @@ class LeagueCog(commands.Cog):
         if not re.match(r"^\d{2}:\d{2}$", inicio) or not re.match(r"^\d{2}:\d{2}$", fin):
             await interaction.response.send_message(embed=error("Formato de hora inválido. Debe ser HH:MM."), ephemeral=True)
             return
-        tabla_id = db.create_amistosos_tabla(interaction.guild.id, inicio, fin)
+        tabla_id = await db.create_amistosos_tabla(interaction.guild.id, inicio, fin)
         if tabla_id == -1:
             await interaction.response.send_message(embed=error("Error al crear la tabla. Verifica los horarios."), ephemeral=True)
             return
         await interaction.response.send_message(embed=success(f"Tabla de amistosos creada con ID {tabla_id}."), ephemeral=True)
 
-        config = db.get_server_config(interaction.guild.id)
+        config = await db.get_server_config(interaction.guild.id)
         if config and config['amistosos_channel_id']:
             channel = self.bot.get_channel(config['amistosos_channel_id'])
             if channel:
-                table = self.generate_amistosos_table(interaction.guild.id, tabla_id)
+                table = await self.generate_amistosos_table(interaction.guild.id, tabla_id)
                 message = await channel.send(table)
                 self.amistosos_message_id = message.id
 
@@ -992,19 +1123,17 @@ class LeagueCog(commands.Cog):
     async def registraramistoso(self, interaction: discord.Interaction, equipo: str, horario: str):
         await interaction.response.defer(ephemeral=True)
 
-        manager_team = db.get_team_by_manager(interaction.guild.id, interaction.user.id)
-        captain_team = db.get_team_by_captain(interaction.guild.id, interaction.user.id)
-        team = manager_team or captain_team
+        team = (await db.get_identity(interaction.guild.id, interaction.user.id))['team']
         if not team:
             await interaction.followup.send(embed=error("No eres manager ni capitán de ningún equipo."), ephemeral=True)
             return
 
-        tabla = db.get_latest_amistosos_tabla(interaction.guild.id)
+        tabla = await db.get_latest_amistosos_tabla(interaction.guild.id)
         if not tabla:
             await interaction.followup.send(embed=error("No hay una tabla de amistosos activa."), ephemeral=True)
             return
 
-        horarios = db.get_horarios_for_tabla(tabla['id'], interaction.guild.id)
+        horarios = await db.get_horarios_for_tabla(tabla['id'], interaction.guild.id)
         horario_info = next((h for h in horarios if h['horario'] == horario), None)
         if not horario_info:
             await interaction.followup.send(embed=error(f"El horario {horario} no está en la tabla actual."), ephemeral=True)
@@ -1013,7 +1142,7 @@ class LeagueCog(commands.Cog):
             await interaction.followup.send(embed=error(f"El horario {horario} ya está ocupado."), ephemeral=True)
             return
 
-        solicitado_team = db.get_team_by_name(interaction.guild.id, equipo)
+        solicitado_team = await db.get_team_by_name(interaction.guild.id, equipo)
         if not solicitado_team:
             await interaction.followup.send(embed=error("Equipo no encontrado."), ephemeral=True)
             return
@@ -1021,18 +1150,18 @@ class LeagueCog(commands.Cog):
             await interaction.followup.send(embed=error("No puedes jugar contra tu propio equipo."), ephemeral=True)
             return
 
-        amistosos = db.get_amistosos_for_tabla(interaction.guild.id, tabla['id'])
+        amistosos = await db.get_amistosos_for_tabla(interaction.guild.id, tabla['id'])
         if any(a['horario'] == horario and (a['team1_id'] in [team['id'], solicitado_team['id']] or a['team2_id'] in [team['id'], solicitado_team['id']]) for a in amistosos):
             await interaction.followup.send(embed=error("Uno de los equipos ya tiene un amistoso en ese horario."), ephemeral=True)
             return
 
-        solicitud_id = db.add_solicitud_amistoso(interaction.guild.id, team['id'], solicitado_team['id'], horario, tabla['id'], interaction.user.id)
+        solicitud_id = await db.add_solicitud_amistoso(interaction.guild.id, team['id'], solicitado_team['id'], horario, tabla['id'], interaction.user.id)
         if solicitud_id == -1:
             await interaction.followup.send(embed=error("Error al registrar la solicitud."), ephemeral=True)
             return
 
         manager_id = solicitado_team['manager_id']
-        captains = db.get_captains(interaction.guild.id, solicitado_team['id'])
+        captains = await db.get_captains(interaction.guild.id, solicitado_team['id'])
         recipients = set([manager_id] + captains) if manager_id else set(captains)
         if not recipients:
             await interaction.followup.send(embed=error("El equipo solicitado no tiene manager ni capitanes."), ephemeral=True)
@@ -1058,7 +1187,7 @@ class LeagueCog(commands.Cog):
     @app_commands.checks.has_permissions(administrator=True)
     async def quitarmanager(self, interaction: discord.Interaction, equipo: str):
         # Obtener el equipo por nombre
-        team = db.get_team_by_name(interaction.guild.id, equipo)
+        team = await db.get_team_by_name(interaction.guild.id, equipo)
         if not team:
             await interaction.response.send_message(embed=error("Equipo no encontrado."), ephemeral=True)
             return
@@ -1069,7 +1198,7 @@ class LeagueCog(commands.Cog):
             return
 
         # Quitar el manager asignando NULL al manager_id
-        db.assign_manager_to_team(interaction.guild.id, team['id'], None)
+        await db.assign_manager_to_team(interaction.guild.id, team['id'], None)
 
         # Obtener el nombre del usuario que era manager (si está disponible)
         manager = self.bot.get_user(team['manager_id']) if team['manager_id'] else None
@@ -1082,78 +1211,113 @@ class LeagueCog(commands.Cog):
     @app_commands.describe(jugador="Jugador objetivo")
     @app_commands.checks.has_permissions(administrator=True)
     async def sancionar(self, interaction: discord.Interaction, jugador: discord.User):
-        player = db.get_player_by_id(interaction.guild.id, jugador.id)
+        player = await db.get_player_by_id(interaction.guild.id, jugador.id)
         if not player:
             await interaction.response.send_message(embed=error("Jugador no encontrado."), ephemeral=True)
             return
-        db.ban_player(interaction.guild.id, player['name'])
+        await db.ban_player(interaction.guild.id, player['name'])
         await interaction.response.send_message(embed=success(f"{jugador.name} ha sido sancionado."))
 
     @app_commands.command(name="quitaresancion", description="Quitar sanción a un jugador")
     @app_commands.describe(jugador="Jugador objetivo")
     @app_commands.checks.has_permissions(administrator=True)
     async def quitaresancion(self, interaction: discord.Interaction, jugador: discord.User):
-        player = db.get_player_by_id(interaction.guild.id, jugador.id)
+        player = await db.get_player_by_id(interaction.guild.id, jugador.id)
         if not player:
             await interaction.response.send_message(embed=error("Jugador no encontrado."), ephemeral=True)
             return
-        db.unban_player(interaction.guild.id, player['name'])
+        await db.unban_player(interaction.guild.id, player['name'])
         await interaction.response.send_message(embed=success(f"Sanción quitada a {jugador.name}."))
 
     @app_commands.command(name="quitarjugador", description="Enviar a un jugador a agentes libres")
     @app_commands.describe(jugador="Jugador a remover")
     async def quitarjugador(self, interaction: discord.Interaction, jugador: discord.User):
-        player = db.get_player_by_id(interaction.guild.id, jugador.id)
+        player = await db.get_player_by_id(interaction.guild.id, jugador.id)
         if not player:
             await interaction.response.send_message(embed=error("Jugador no encontrado."), ephemeral=True)
             return
         if not player['team_id']:
             await interaction.response.send_message(embed=error(f"{jugador.name} ya es agente libre."), ephemeral=True)
             return
-        manager_team = db.get_team_by_manager(
+        manager_team = await db.get_team_by_manager(
             interaction.guild.id, interaction.user.id)
         if not (interaction.user.guild_permissions.administrator or (manager_team and manager_team['id'] == player['team_id'])):
             await interaction.response.send_message(embed=error("Solo admins o el manager del equipo pueden usar este comando."), ephemeral=True)
             return
-        db.remove_player_from_team(interaction.guild.id, player['name'])
+        await db.remove_player_from_team(interaction.guild.id, player['name'])
         await interaction.response.send_message(embed=success(f"{jugador.name} ahora es agente libre."))
 
     @app_commands.command(name="avanzartemporada", description="Avanzar una temporada")
     @app_commands.checks.has_permissions(administrator=True)
     async def avanzartemporada(self, interaction: discord.Interaction):
-        db.advance_season(interaction.guild.id)
-        await interaction.response.send_message(embed=success("Temporada avanzada. Contratos reducidos y agentes libres actualizados."), ephemeral=True)
+        await interaction.response.defer(ephemeral=True)
+        summary = await db.advance_season(interaction.guild.id)
+        if summary is None:
+            await interaction.followup.send(embed=error("Error al avanzar la temporada. No se aplicó ningún cambio."), ephemeral=True)
+            return
+        released = summary['released']
+        embed = success(
+            f"Temporada avanzada.\n"
+            f"Contratos reducidos: **{summary['decremented']:,}**\n"
+            f"Jugadores liberados: **{len(released):,}**\n"
+            f"Ofertas canceladas: **{summary['offers_cancelled']:,}** "
+            f"({summary['clauses_refunded']} cláusulas devueltas, {summary['refunded_amount']:,} en total)\n"
+            f"Capitanías retiradas: **{summary['captains_removed']:,}**"
+        )
+        await interaction.followup.send(embed=embed, ephemeral=True)
+        if summary['refunds_failed']:
+            # El vendedor no tiene saldo para devolver la cláusula: la oferta se canceló igual y hay que resolverlo a mano
+            pending = "\n".join(
+                f"Oferta {offer['id']}: **{offer['player_name']}** — {offer['price']:,} de "
+                f"{offer['from_team_name'] or 'Sin equipo'} a {offer['to_team_name'] or 'Sin equipo'}"
+                for offer in summary['refunds_failed'])
+            await interaction.followup.send(
+                embed=error(f"Cláusulas no devueltas por falta de saldo del vendedor:\n{pending}"[:4000]), ephemeral=True)
+
+        # La lista de liberados se envía por partes a medida que se arma (un mensaje admite 6000 caracteres de embeds)
+        lines, length, part = [], 0, 1
+        for player in released:
+            line = f"**{player['name']}** (<@{player['user_id']}>) — {player['team_name'] or 'Sin equipo'}"
+            if length + len(line) + 1 > 4000:
+                await self._send_released(interaction, lines, part)
+                lines, length, part = [], 0, part + 1
+            lines.append(line)
+            length += len(line) + 1
+        if lines:
+            await self._send_released(interaction, lines, part)
+
+    async def _send_released(self, interaction: discord.Interaction, lines: list, part: int):
+        embed = Embed(title=f"📋 Jugadores liberados (parte {part})", description="\n".join(lines), color=Color.blue())
+        await interaction.followup.send(embed=embed, ephemeral=True)
 
     @app_commands.command(name="equiposregistrados", description="Ver todos los equipos registrados, opcionalmente por división")
     @app_commands.describe(division="División a filtrar (opcional)")
     async def equiposregistrados(self, interaction: discord.Interaction, division: str = None):
-        teams = db.get_all_teams(interaction.guild.id, division)
+        teams = await db.get_all_teams(interaction.guild.id, division)
         view = TeamBookView(teams, interaction.user.id, self.bot, interaction.guild.id)
-        await interaction.response.send_message(embed=view.get_embed(), view=view)
+        await interaction.response.send_message(embed=await view.get_embed(), view=view)
 
     @app_commands.command(name="mercado", description="Ver jugadores transferibles")
     async def mercado(self, interaction: discord.Interaction):
-        players = db.get_transferable_players(interaction.guild.id)
+        players = await db.get_transferable_players_with_teams(interaction.guild.id)
         if not players:
             await interaction.response.send_message(embed=info("No hay jugadores transferibles."), ephemeral=True)
             return
         embed = info("Jugadores Transferibles")
         for player in players:
-            team = db.get_team_by_id(
-                interaction.guild.id, player['team_id']) if player['team_id'] else None
             embed.add_field(
-                name=player['name'], value=f"Equipo: {team['name'] if team else 'Libre'}\nCláusula: {player['release_clause']:,}", inline=False)
+                name=player['name'], value=f"Equipo: {player['team_name'] or 'Libre'}\nCláusula: {player['release_clause']:,}", inline=False)
         await interaction.response.send_message(embed=embed)
 
     @app_commands.command(name="agregarmercado", description="Marcar a un jugador como transferible y opcionalmente modificar su cláusula")
     @app_commands.describe(jugador="Jugador a agregar", clausula="Nueva cláusula (opcional)")
     async def agregarmercado(self, interaction: discord.Interaction, jugador: discord.User, clausula: int = None):
-        manager_team = db.get_team_by_manager(
+        manager_team = await db.get_team_by_manager(
             interaction.guild.id, interaction.user.id)
         if not (interaction.user.guild_permissions.administrator or manager_team):
             await interaction.response.send_message(embed=error("Solo admins o managers pueden usar este comando."), ephemeral=True)
             return
-        player = db.get_player_by_id(interaction.guild.id, jugador.id)
+        player = await db.get_player_by_id(interaction.guild.id, jugador.id)
         if not player:
             await interaction.response.send_message(embed=error("Jugador no encontrado."), ephemeral=True)
             return
@@ -1166,7 +1330,7 @@ class LeagueCog(commands.Cog):
         if clausula is not None and clausula <= 0:
             await interaction.response.send_message(embed=error("La cláusula debe ser un número positivo."), ephemeral=True)
             return
-        db.set_player_transferable(
+        await db.set_player_transferable(
             interaction.guild.id, player['name'], clausula)
         clause_value = clausula if clausula is not None else player['release_clause']
         await interaction.response.send_message(embed=success(f"{jugador.name} agregado al mercado con cláusula {clause_value:,}."))
@@ -1174,12 +1338,12 @@ class LeagueCog(commands.Cog):
     @app_commands.command(name="quitarmercado", description="Quitar a un jugador del mercado")
     @app_commands.describe(jugador="Jugador a quitar")
     async def quitarmercado(self, interaction: discord.Interaction, jugador: discord.User):
-        manager_team = db.get_team_by_manager(
+        manager_team = await db.get_team_by_manager(
             interaction.guild.id, interaction.user.id)
         if not (interaction.user.guild_permissions.administrator or manager_team):
             await interaction.response.send_message(embed=error("Solo admins o managers pueden usar este comando."), ephemeral=True)
             return
-        player = db.get_player_by_id(interaction.guild.id, jugador.id)
+        player = await db.get_player_by_id(interaction.guild.id, jugador.id)
         if not player:
             await interaction.response.send_message(embed=error("Jugador no encontrado."), ephemeral=True)
             return
@@ -1189,50 +1353,50 @@ class LeagueCog(commands.Cog):
         if not interaction.user.guild_permissions.administrator and manager_team['id'] != player['team_id']:
             await interaction.response.send_message(embed=error("Solo puedes quitar jugadores de tu equipo."), ephemeral=True)
             return
-        db.unset_player_transferable(interaction.guild.id, player['name'])
+        await db.unset_player_transferable(interaction.guild.id, player['name'])
         await interaction.response.send_message(embed=success(f"{jugador.name} removido del mercado."))
 
     @app_commands.command(name="balance", description="Ver el balance de un club")
     @app_commands.describe(equipo="Nombre del equipo")
     async def balance(self, interaction: discord.Interaction, equipo: str):
-        team = db.get_team_by_name(interaction.guild.id, equipo)
+        team = await db.get_team_by_name(interaction.guild.id, equipo)
         if not team:
             await interaction.response.send_message(embed=error("Equipo no encontrado."), ephemeral=True)
             return
-        balance = db.get_club_balance(interaction.guild.id, team['id'])
+        balance = await db.get_club_balance(interaction.guild.id, team['id'])
         await interaction.response.send_message(embed=info(f"Balance de {equipo}: {balance:,}"))
 
     @app_commands.command(name="addmoney", description="Agregar dinero a un club")
     @app_commands.describe(equipo="Nombre del equipo", cantidad="Cantidad a agregar")
     @app_commands.checks.has_permissions(administrator=True)
     async def addmoney(self, interaction: discord.Interaction, equipo: str, cantidad: int):
-        team = db.get_team_by_name(interaction.guild.id, equipo)
+        team = await db.get_team_by_name(interaction.guild.id, equipo)
         if not team:
             await interaction.response.send_message(embed=error("Equipo no encontrado."), ephemeral=True)
             return
-        db.add_money_to_club(interaction.guild.id, team['id'], cantidad)
+        await db.add_money_to_club(interaction.guild.id, team['id'], cantidad)
         await interaction.response.send_message(embed=success(f"{cantidad:,} agregado al balance de {equipo}."))
 
     @app_commands.command(name="removemoney", description="Quitar dinero a un club")
     @app_commands.describe(equipo="Nombre del equipo", cantidad="Cantidad a quitar")
     @app_commands.checks.has_permissions(administrator=True)
     async def removemoney(self, interaction: discord.Interaction, equipo: str, cantidad: int):
-        team = db.get_team_by_name(interaction.guild.id, equipo)
+        team = await db.get_team_by_name(interaction.guild.id, equipo)
         if not team:
             await interaction.response.send_message(embed=error("Equipo no encontrado."), ephemeral=True)
             return
-        db.remove_money_from_club(interaction.guild.id, team['id'], cantidad)
+        await db.remove_money_from_club(interaction.guild.id, team['id'], cantidad)
         await interaction.response.send_message(embed=success(f"{cantidad:,} quitado del balance de {equipo}."))
 
     @app_commands.command(name="eliminarequipo", description="Eliminar un equipo y sus datos")
     @app_commands.describe(equipo="Nombre del equipo")
     @app_commands.checks.has_permissions(administrator=True)
     async def eliminarequipo(self, interaction: discord.Interaction, equipo: str):
-        team = db.get_team_by_name(interaction.guild.id, equipo)
+        team = await db.get_team_by_name(interaction.guild.id, equipo)
         if not team:
             await interaction.response.send_message(embed=error("Equipo no encontrado."), ephemeral=True)
             return
-        db.delete_team(interaction.guild.id, equipo)
+        await db.delete_team(interaction.guild.id, equipo)
         await interaction.response.send_message(embed=success("Equipo eliminado, todos sus jugadores son agentes libres"), ephemeral=True)
 
     @app_commands.command(name="fichajes", description="Ver los últimos fichajes realizados en la liga")
@@ -1241,7 +1405,7 @@ class LeagueCog(commands.Cog):
         if cantidad < 1 or cantidad > 25:
             await interaction.response.send_message(embed=error("La cantidad debe estar entre 1 y 25."), ephemeral=True)
             return
-        transfers = db.get_recent_transfers(interaction.guild.id, cantidad)
+        transfers = await db.get_recent_transfers(interaction.guild.id, cantidad)
         if not transfers:
             await interaction.response.send_message(embed=info("No hay fichajes recientes."), ephemeral=True)
             return
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import os
+from aiohttp import web
+from discord.ext import commands, tasks
+import backups
+import database as db
+import metrics
+
+logger = logging.getLogger('bot')
+
+WAL_CHECKPOINT_MINUTES = float(os.getenv("WAL_CHECKPOINT_MINUTES", "5"))
+# Intervalo de las copias de seguridad de todas las bases de datos; 0 las desactiva
+BACKUP_INTERVAL_MINUTES = float(os.getenv("BACKUP_INTERVAL_MINUTES", "60"))
+METRICS_DUMP_PATH = os.getenv("METRICS_DUMP_PATH", "metrics.prom")
+METRICS_DUMP_SECONDS = float(os.getenv("METRICS_DUMP_SECONDS", "60"))
+# Puerto local para /metrics en formato Prometheus; 0 lo desactiva
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+class MaintenanceCog(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.last_checkpoint_report = {}
+        self.last_backup_report = {}
+        self.metrics_runner = None
+
+    async def cog_load(self):
+        self.wal_checkpoint.start()
+        if BACKUP_INTERVAL_MINUTES > 0:
+            self.backup.start()
+        if METRICS_DUMP_PATH:
+            self.metrics_dump.start()
+        if METRICS_PORT:
+            await self.start_metrics_server()
+
+    async def cog_unload(self):
+        self.wal_checkpoint.cancel()
+        self.backup.cancel()
+        self.metrics_dump.cancel()
+        if self.metrics_runner:
+            await self.metrics_runner.cleanup()
+
+    async def start_metrics_server(self):
+        async def handle_metrics(request):
+            return web.Response(text=metrics.registry.render(), content_type='text/plain', charset='utf-8')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle_metrics)
+        self.metrics_runner = web.AppRunner(app)
+        await self.metrics_runner.setup()
+        await web.TCPSite(self.metrics_runner, METRICS_HOST, METRICS_PORT).start()
+        logger.info(f"Métricas disponibles en http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+    @tasks.loop(seconds=METRICS_DUMP_SECONDS)
+    async def metrics_dump(self):
+        try:
+            await asyncio.to_thread(metrics.write_snapshot, METRICS_DUMP_PATH)
+        except OSError as e:
+            logger.error(f"Error al volcar las métricas a {METRICS_DUMP_PATH}: {e}")
+
+    @tasks.loop(minutes=WAL_CHECKPOINT_MINUTES)
+    async def wal_checkpoint(self):
+        try:
+            self.last_checkpoint_report = await asyncio.to_thread(db.checkpoint_all_wal)
+        except Exception as e:
+            logger.error(f"Error en el checkpoint periódico del WAL: {e}", exc_info=True)
+
+    @wal_checkpoint.before_loop
+    async def before_wal_checkpoint(self):
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(minutes=max(BACKUP_INTERVAL_MINUTES, 1))
+    async def backup(self):
+        try:
+            self.last_backup_report = await asyncio.to_thread(backups.backup_all)
+        except Exception as e:
+            logger.error(f"Error en la copia de seguridad periódica: {e}", exc_info=True)
+
+    @backup.before_loop
+    async def before_backup(self):
+        await self.bot.wait_until_ready()
+
+async def setup(bot):
+    await bot.add_cog(MaintenanceCog(bot))
@@ -0,0 +1,161 @@
+import asyncio
+import functools
+import inspect
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import database
+from database import get_db_path, generate_horarios, READER_THREADS_PER_DB
+
+logger = logging.getLogger('database')
+
+MAX_ACTIVE_DATABASES = int(os.getenv("DB_MAX_ACTIVE_EXECUTORS", "64"))
+
+# Funciones de database.py que escriben: se ejecutan en el hilo escritor de cada guild
+_WRITES = (
+    'create_tables', 'set_market_status', 'set_ocr_roi', 'set_server_settings', 'set_amistosos_channel',
+    'reset_transferable_status', 'add_team', 'delete_team', 'assign_manager_to_team',
+    'add_player', 'ban_player', 'unban_player', 'remove_player_from_team',
+    'set_player_transferable', 'unset_player_transferable', 'create_transfer_offer',
+    'update_offer_status', 'accept_offer', 'reject_offer', 'pay_clause_and_transfer',
+    'accept_clause_payment', 'add_money_to_club', 'remove_money_from_club', 'add_captain',
+    'remove_captain', 'update_solicitud_status', 'advance_season', 'add_screenshot',
+    'update_screenshot_status', 'set_registro_channel', 'create_amistosos_tabla',
+    'add_solicitud_amistoso', 'add_amistoso', 'delete_amistoso',
+    # Actualiza last_seen del hash encontrado
+    'find_duplicate_screenshot', 'add_screenshot_hash',
+    'upsert_screenshots',
+)
+
+# Funciones de solo lectura: se reparten entre los hilos lectores de cada guild
+_READS = (
+    'get_market_status', 'get_ocr_roi', 'get_team_by_manager', 'get_team_by_name',
+    'get_team_by_id', 'get_all_teams', 'get_player_by_id', 'get_transferable_players',
+    'get_transferable_players_with_teams',
+    'get_offer', 'list_offers_by_manager', 'list_offers_for_player', 'has_pending_offer',
+    'get_club_balance', 'get_free_agents', 'get_captains', 'is_captain', 'get_team_by_captain',
+    'get_solicitud_by_id', 'get_all_players', 'get_players_by_team', 'get_transfer_history_by_player',
+    'get_transfer_history_by_team', 'get_recent_transfers', 'get_screenshots_by_user', 'get_screenshots_by_ids',
+    'get_player_by_name', 'get_latest_amistosos_tabla',
+    'get_horarios_for_tabla', 'get_amistosos_for_tabla', 'get_amistosos_with_teams',
+    'get_identity',
+)
+
+# Funciones sobre global.db (no dependen de un guild)
+_GLOBAL_WRITES = ('ban_guild', 'unban_guild')
+_GLOBAL_READS = ('is_guild_banned',)
+
+_GLOBAL_KEY = 'global'
+
+class _DatabaseExecutors:
+    def __init__(self, key):
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"db-writer-{key}")
+        self.readers = ThreadPoolExecutor(max_workers=READER_THREADS_PER_DB, thread_name_prefix=f"db-reader-{key}")
+        # Tareas encoladas o en curso; lo protege el lock del registro
+        self.in_flight = 0
+
+    def shutdown(self, wait: bool = False):
+        self.writer.shutdown(wait=wait)
+        self.readers.shutdown(wait=wait)
+
+class ExecutorRegistry:
+    """Un hilo escritor y un grupo de hilos lectores por archivo de base de datos, con desalojo LRU.
+
+    Solo se desalojan entradas sin tareas pendientes: si no, al volver el guild se crearía un segundo
+    hilo escritor mientras el anterior aún vacía su cola.
+    """
+
+    def __init__(self, max_databases: int):
+        self.max_databases = max(1, max_databases)
+        self._executors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, key, write: bool, func) -> Future:
+        with self._lock:
+            executors = self._executors.get(key)
+            if executors is None:
+                executors = self._executors[key] = _DatabaseExecutors(key)
+            self._executors.move_to_end(key)
+            executors.in_flight += 1
+            try:
+                future = (executors.writer if write else executors.readers).submit(func)
+            except BaseException:
+                executors.in_flight -= 1
+                raise
+            self._evict_idle()
+        future.add_done_callback(lambda _: self._done(executors))
+        return future
+
+    def _done(self, executors: _DatabaseExecutors):
+        with self._lock:
+            executors.in_flight -= 1
+            self._evict_idle()
+
+    def _evict_idle(self):
+        # De la menos usada a la más reciente; si todas están ocupadas se supera el límite hasta que alguna quede libre
+        excess = len(self._executors) - self.max_databases
+        if excess <= 0:
+            return
+        for key in [key for key, ex in self._executors.items() if ex.in_flight == 0][:excess]:
+            self._executors.pop(key).shutdown(wait=False)
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            executors = list(self._executors.values())
+            self._executors.clear()
+        for ex in executors:
+            ex.shutdown(wait=wait)
+
+_executors = ExecutorRegistry(MAX_ACTIVE_DATABASES)
+
+async def run_read(key, func, *args, **kwargs):
+    return await asyncio.wrap_future(_executors.submit(key, False, functools.partial(func, *args, **kwargs)))
+
+async def run_write(key, func, *args, **kwargs):
+    return await asyncio.wrap_future(_executors.submit(key, True, functools.partial(func, *args, **kwargs)))
+
+async def run_guild_write(guild_id, func, *args, **kwargs):
+    # Cualquier función que deba ir en el hilo escritor de un guild (None = global.db), sin intercalarse con sus escrituras
+    return await run_write(_GLOBAL_KEY if guild_id is None else guild_id, func, *args, **kwargs)
+
+def _mirror(name: str, write: bool, is_global: bool = False):
+    sync_func = getattr(database, name)
+    signature = inspect.signature(sync_func)
+    runner = run_write if write else run_read
+
+    @functools.wraps(sync_func)
+    async def wrapper(*args, **kwargs):
+        key = _GLOBAL_KEY if is_global else signature.bind(*args, **kwargs).arguments['guild_id']
+        # Se resuelve en cada llamada para respetar cualquier envoltorio aplicado a database.py
+        return await runner(key, getattr(database, name), *args, **kwargs)
+    return wrapper
+
+for _name in _WRITES:
+    globals()[_name] = _mirror(_name, write=True)
+for _name in _READS:
+    globals()[_name] = _mirror(_name, write=False)
+for _name in _GLOBAL_WRITES:
+    globals()[_name] = _mirror(_name, write=True, is_global=True)
+for _name in _GLOBAL_READS:
+    globals()[_name] = _mirror(_name, write=False, is_global=True)
+
+async def get_server_config(guild_id: int):
+    # Con la configuración en caché se responde desde el bucle de eventos, sin saltar a un hilo
+    cached = database.peek_server_config(guild_id)
+    if cached is not database.CONFIG_NOT_CACHED:
+        return cached
+    return await run_read(guild_id, database.get_server_config, guild_id)
+
+async def get_identity(guild_id: int, user_id: int) -> dict:
+    # Con el índice del guild cargado la respuesta sale de memoria; solo la primera consulta lo carga en un hilo
+    identity = database.peek_identity(guild_id, user_id)
+    if identity is not database.NOT_LOADED:
+        return identity
+    return await run_read(guild_id, database.get_identity, guild_id, user_id)
+
+def shutdown(wait: bool = True):
+    _executors.shutdown(wait=wait)
+    logger.info("Hilos de base de datos detenidos.")
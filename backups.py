@@ -0,0 +1,303 @@
+import argparse
+import atexit
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import database
+import migrations
+
+logger = logging.getLogger('database')
+
+# Copias de seguridad de global.db y de cada league_<guild>.db con la API de backup online de SQLite
+# (copia consistente sin bloquear a los escritores), comprimidas con gzip y con retención por cantidad.
+# Son incrementales: una base sin cambios desde la última copia no se vuelve a guardar.
+#   python -m backups backup [--force]
+#   python -m backups restore <guild_id|global> [--file archivo.db.gz]
+# Con el bot en marcha la restauración se hace con /restore_backup: las cachés en memoria (configuración,
+# entidades, índice de identidades) y el pool de conexiones son del proceso del bot.
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "24"))
+BACKUP_COMPRESSLEVEL = int(os.getenv("BACKUP_COMPRESSLEVEL", "6"))
+# Páginas copiadas por paso de la API de backup; entre pasos los escritores pueden avanzar
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "1024"))
+CHUNK_SIZE = 1024 * 1024
+# Archivo con el PID del bot mientras está en marcha; otro proceso no puede restaurar mientras exista
+BOT_LOCK_PATH = os.getenv("BOT_LOCK_PATH", "bot.lock")
+
+# Las copias periódicas, /backup_now y /restore_backup no deben tocar a la vez el mismo manifiesto
+_lock = threading.RLock()
+
+def hold_bot_lock():
+    with open(BOT_LOCK_PATH, 'w', encoding='utf-8') as f:
+        f.write(str(os.getpid()))
+    atexit.register(_release_bot_lock)
+
+def _release_bot_lock():
+    if bot_running() == os.getpid():
+        os.remove(BOT_LOCK_PATH)
+
+def bot_running() -> int:
+    """PID del bot si está en marcha, o None."""
+    try:
+        with open(BOT_LOCK_PATH, encoding='utf-8') as f:
+            pid = int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+    if os.name == 'nt':
+        # En Windows os.kill termina el proceso: se confía en el archivo
+        return pid
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass
+    return pid
+
+def _db_path(guild_id: int = None) -> str:
+    return database.GLOBAL_DB_PATH if guild_id is None else database.get_db_path(guild_id)
+
+def _prefix(guild_id: int = None) -> str:
+    return "global" if guild_id is None else f"guild_{guild_id}"
+
+def _backup_dir(guild_id: int = None) -> str:
+    return os.path.join(BACKUP_DIR, _prefix(guild_id))
+
+def _load_manifest(guild_id: int = None) -> dict:
+    try:
+        with open(os.path.join(_backup_dir(guild_id), 'manifest.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'backups': [], 'fingerprint': None}
+
+def _save_manifest(guild_id: int, manifest: dict):
+    path = os.path.join(_backup_dir(guild_id), 'manifest.json')
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+def _fingerprint(db_path: str) -> list:
+    # Cualquier escritura cambia el tamaño o la fecha del archivo principal o de su WAL
+    fingerprint = []
+    for path in (db_path, f"{db_path}-wal"):
+        try:
+            stat = os.stat(path)
+            fingerprint += [stat.st_size, stat.st_mtime_ns]
+        except OSError:
+            fingerprint += [0, 0]
+    return fingerprint
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _snapshot(db_path: str, target: str):
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP)
+    finally:
+        dst.close()
+        src.close()
+
+def _prune(guild_id: int, manifest: dict) -> int:
+    backups = manifest['backups']
+    expired, manifest['backups'] = backups[:-BACKUP_KEEP], backups[-BACKUP_KEEP:]
+    for entry in expired:
+        try:
+            os.remove(os.path.join(_backup_dir(guild_id), entry['file']))
+        except OSError as e:
+            logger.warning(f"No se pudo borrar la copia vieja {entry['file']}: {e}")
+    return len(expired)
+
+def backup_database(guild_id: int = None, force: bool = False) -> dict:
+    """Copia comprimida de una base de datos. status: 'created', 'unchanged' o 'missing'."""
+    with _lock:
+        return _backup_database(guild_id, force)
+
+def _backup_database(guild_id: int, force: bool) -> dict:
+    start = time.perf_counter()
+    db_path = _db_path(guild_id)
+    if not os.path.exists(db_path):
+        return {'status': 'missing', 'seconds': 0.0}
+    directory = _backup_dir(guild_id)
+    os.makedirs(directory, exist_ok=True)
+    manifest = _load_manifest(guild_id)
+    fingerprint = _fingerprint(db_path)
+    if not force and manifest['backups'] and manifest.get('fingerprint') == fingerprint:
+        return {'status': 'unchanged', 'seconds': time.perf_counter() - start}
+
+    snapshot = os.path.join(directory, 'snapshot.tmp')
+    try:
+        _snapshot(db_path, snapshot)
+        sha256 = _sha256(snapshot)
+        last = manifest['backups'][-1] if manifest['backups'] else None
+        # El archivo cambió pero el contenido no (p. ej. tras un checkpoint del WAL)
+        if not force and last and last['sha256'] == sha256:
+            manifest['fingerprint'] = fingerprint
+            _save_manifest(guild_id, manifest)
+            return {'status': 'unchanged', 'seconds': time.perf_counter() - start}
+        name = f"{_prefix(guild_id)}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.db.gz"
+        target = os.path.join(directory, name)
+        with open(snapshot, 'rb') as src, gzip.open(f"{target}.tmp", 'wb', compresslevel=BACKUP_COMPRESSLEVEL) as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.replace(f"{target}.tmp", target)
+        size = os.path.getsize(snapshot)
+    finally:
+        if os.path.exists(snapshot):
+            os.remove(snapshot)
+
+    manifest['backups'].append({
+        'file': name,
+        'sha256': sha256,
+        'bytes': size,
+        'compressed_bytes': os.path.getsize(target),
+        'created': datetime.now().isoformat(timespec='seconds'),
+    })
+    manifest['fingerprint'] = fingerprint
+    pruned = _prune(guild_id, manifest)
+    _save_manifest(guild_id, manifest)
+    report = {'status': 'created', 'file': target, 'bytes': size, 'compressed_bytes': manifest['backups'][-1]['compressed_bytes'],
+              'pruned': pruned, 'seconds': time.perf_counter() - start}
+    logger.info(f"Copia de seguridad de {db_path} creada en {target} ({size / 1024:,.1f} KiB -> "
+                f"{report['compressed_bytes'] / 1024:,.1f} KiB) en {report['seconds']:.2f}s.")
+    return report
+
+def backup_all(force: bool = False) -> dict:
+    report = {}
+    for guild_id in [None] + database.list_guild_databases():
+        try:
+            report[guild_id] = backup_database(guild_id, force)
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"Error al copiar la base de datos de {_prefix(guild_id)}: {e}")
+            report[guild_id] = {'status': f'error: {e}', 'seconds': 0.0}
+    created = sum(1 for r in report.values() if r['status'] == 'created')
+    if created:
+        logger.info(f"Copias de seguridad: {created} nuevas de {len(report)} bases de datos.")
+    return report
+
+def list_backups(guild_id: int = None) -> list:
+    return _load_manifest(guild_id)['backups']
+
+def restore_backup(guild_id: int = None, file: str = None) -> dict:
+    """Restaura una copia (la última si no se indica archivo) y devuelve el tiempo de cada paso.
+
+    Antes de tocar la base en uso se comprueban el sha256 del manifiesto y PRAGMA integrity_check sobre la copia
+    descomprimida y se guarda una copia del estado actual; la restauración se hace con la API de backup sobre
+    la base en uso (respeta su WAL). Las cachés que se descartan son las de este proceso, así que con el bot
+    en marcha solo puede llamarse desde el propio bot, en el hilo escritor del guild (async_database.run_guild_write)
+    para que ninguna escritura se intercale con la restauración.
+    Lanza ValueError si la copia no existe, no pasa la verificación o el bot está en marcha en otro proceso.
+    """
+    pid = bot_running()
+    if pid is not None and pid != os.getpid():
+        raise ValueError(f"El bot está en marcha (PID {pid}): restaura la copia con /restore_backup.")
+    with _lock:
+        return _restore_backup(guild_id, file)
+
+def _restore_backup(guild_id: int, file: str) -> dict:
+    timings = {}
+    backups = list_backups(guild_id)
+    entry = next((b for b in backups if b['file'] == file), None) if file else (backups[-1] if backups else None)
+    if entry is None:
+        raise ValueError(f"No hay copia {'llamada ' + file if file else 'disponible'} para {_prefix(guild_id)}.")
+    directory = _backup_dir(guild_id)
+    restored = os.path.join(directory, 'restore.tmp')
+    db_path = _db_path(guild_id)
+    try:
+        start = time.perf_counter()
+        try:
+            with gzip.open(os.path.join(directory, entry['file']), 'rb') as src, open(restored, 'wb') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        except (OSError, EOFError) as e:
+            raise ValueError(f"No se pudo descomprimir la copia {entry['file']}: {e}")
+        timings['decompress'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if _sha256(restored) != entry['sha256']:
+            raise ValueError(f"La copia {entry['file']} está dañada: el sha256 no coincide con el manifiesto.")
+        conn = sqlite3.connect(restored)
+        try:
+            result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+        finally:
+            conn.close()
+        if result != 'ok':
+            raise ValueError(f"La copia {entry['file']} no pasa integrity_check: {result}")
+        timings['verify'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        # Copia del estado actual antes de sobrescribirlo, para poder deshacer la restauración
+        if os.path.exists(db_path):
+            backup_database(guild_id)
+        timings['pre_backup'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        # Las conexiones del pool se reabren después con el contenido restaurado
+        database.close_pool(db_path)
+        src, dst = sqlite3.connect(restored), sqlite3.connect(db_path)
+        try:
+            # En un solo paso: nadie llega a ver la base a medio restaurar
+            src.backup(dst)
+            result = dst.execute('PRAGMA integrity_check').fetchone()[0]
+        finally:
+            src.close()
+            dst.close()
+        timings['restore'] = time.perf_counter() - start
+    finally:
+        if os.path.exists(restored):
+            os.remove(restored)
+
+    if result != 'ok':
+        raise ValueError(f"La base restaurada {db_path} no pasa integrity_check: {result}")
+    start = time.perf_counter()
+    # Una copia anterior a las últimas migraciones se pone al día
+    if guild_id is not None:
+        migrations.migrate_guild(guild_id)
+        database.invalidate_server_config(guild_id)
+        database.invalidate_entities(guild_id)
+    timings['migrate'] = time.perf_counter() - start
+    # La copia que se acaba de restaurar no debe contar como "sin cambios" respecto a la anterior
+    manifest = _load_manifest(guild_id)
+    manifest['fingerprint'] = None
+    _save_manifest(guild_id, manifest)
+    timings['total'] = sum(timings.values())
+    logger.info(f"Copia {entry['file']} restaurada en {db_path}: "
+                + ", ".join(f"{step} {seconds:.2f}s" for step, seconds in timings.items()))
+    return {'file': entry['file'], 'created': entry['created'], 'bytes': entry['bytes'], 'timings': timings}
+
+def main():
+    parser = argparse.ArgumentParser(description="Copias de seguridad de las bases de datos del bot")
+    sub = parser.add_subparsers(dest='command', required=True)
+    backup = sub.add_parser('backup', help="Copia todas las bases de datos")
+    backup.add_argument('--force', action='store_true', help="Copia aunque no haya cambios")
+    restore = sub.add_parser('restore', help="Restaura una base de datos")
+    restore.add_argument('target', help="ID del guild o 'global'")
+    restore.add_argument('--file', help="Archivo .db.gz a restaurar (por defecto el último)")
+    args = parser.parse_args()
+
+    if args.command == 'backup':
+        for guild_id, report in backup_all(args.force).items():
+            print(f"{_prefix(guild_id)}: {report['status']} ({report['seconds']:.2f}s)")
+        return
+    guild_id = None if args.target == 'global' else int(args.target)
+    try:
+        report = restore_backup(guild_id, args.file)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    print(f"Restaurada {report['file']} ({report['created']}): "
+          + ", ".join(f"{step} {seconds:.2f}s" for step, seconds in report['timings'].items()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from pathlib import Path
+
+import async_database as db
+from nicktag_matcher import NicktagMatcher
+from ocr_engine import ScreenshotEngine, EngineSaturated
+from utils.downloads import IMAGE_EXTENSIONS, download_attachment
+
+logger = logging.getLogger('bot')
+
+# Reprocesado masivo de capturas (tras cambiar umbrales o regiones de OCR): desde el historial de un canal
+# con /reprocesarcapturas, o desde un directorio de imágenes con
+#   python -m batch_ocr <guild_id> <directorio>
+# donde cada archivo se llama <id de la captura>.png/.jpg.
+
+BATCH_SIZE = int(os.getenv("BATCH_OCR_SIZE", "50"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_OCR_CONCURRENCY", str(max(1, (os.cpu_count() or 2) - 1))))
+
+async def _ocr(engine: ScreenshotEngine, data: bytes, roi: dict, semaphore: asyncio.Semaphore) -> dict:
+    async with semaphore:
+        while True:
+            try:
+                return await engine.process(data, roi)
+            except EngineSaturated:
+                # Las capturas en vivo tienen prioridad: se espera a que baje la cola
+                await asyncio.sleep(0.5)
+
+def _resolve(result: dict, matcher: NicktagMatcher, user_id: int, names: tuple) -> str:
+    match = matcher.match_player(result['nicktags'], user_id, aliases={user_id: names})
+    return match['tag'] if match else "No detectado"
+
+async def reprocess_channel(channel, guild_id: int, engine: ScreenshotEngine, session, limit: int = 1000,
+                            progress=None) -> dict:
+    """Relee las capturas del historial de un canal y las guarda por lotes; progress(summary) se llama tras cada lote."""
+    start = time.perf_counter()
+    roi = await db.get_ocr_roi(guild_id)
+    matcher = NicktagMatcher(await db.get_all_players(guild_id))
+    registered = {user_id for user_id, _, _ in matcher.players}
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    summary = Counter()
+
+    async def process(message, attachment):
+        try:
+            data = await download_attachment(session, attachment)
+            result = await _ocr(engine, data, roi, semaphore)
+        except Exception as e:
+            logger.warning(f"No se pudo reprocesar el adjunto {attachment.id} del mensaje {message.id}: {e}")
+            summary['errors'] += 1
+            return None
+        return {
+            'attachment_id': attachment.id,
+            'user_id': message.author.id,
+            'discord_name': message.author.name,
+            'channel_id': channel.id,
+            'image_url': attachment.url,
+            'timestamp': message.created_at.astimezone().strftime("%Y-%m-%d %H:%M:%S"),
+            'nicktag': _resolve(result, matcher, message.author.id, (message.author.name, message.author.display_name)),
+            'screenshot_time': result['screenshot_time'],
+        }
+
+    async def flush(batch):
+        rows = [row for row in await asyncio.gather(*(process(m, a) for m, a in batch)) if row]
+        summary.update(await db.upsert_screenshots(guild_id, rows))
+        summary['processed'] += len(rows)
+        if progress:
+            await progress(dict(summary))
+
+    batch = []
+    async for message in channel.history(limit=limit):
+        summary['messages'] += 1
+        if message.author.bot or message.author.id not in registered:
+            continue
+        batch.extend((message, a) for a in message.attachments if a.filename.lower().endswith(IMAGE_EXTENSIONS))
+        if len(batch) >= BATCH_SIZE:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+
+    summary['seconds'] = time.perf_counter() - start
+    logger.info(f"Reprocesado del canal {channel.id} en guild {guild_id}: {dict(summary)}")
+    return dict(summary)
+
+async def reprocess_directory(guild_id: int, directory: str, engine: ScreenshotEngine, progress=None) -> dict:
+    """Relee imágenes guardadas como <id de captura>.<ext> y actualiza esas capturas; progress(summary) se llama tras cada lote."""
+    start = time.perf_counter()
+    files = sorted(p for p in Path(directory).iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS and p.stem.isdigit())
+    roi = await db.get_ocr_roi(guild_id)
+    matcher = NicktagMatcher(await db.get_all_players(guild_id))
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    summary = Counter(files=len(files))
+
+    async def process(path, screenshot):
+        try:
+            data = await asyncio.to_thread(path.read_bytes)
+            result = await _ocr(engine, data, roi, semaphore)
+        except Exception as e:
+            logger.warning(f"No se pudo reprocesar {path}: {e}")
+            summary['errors'] += 1
+            return None
+        return {
+            'id': screenshot['id'],
+            'nicktag': _resolve(result, matcher, screenshot['user_id'], (screenshot['discord_name'],)),
+            'screenshot_time': result['screenshot_time'],
+        }
+
+    for offset in range(0, len(files), BATCH_SIZE):
+        chunk = files[offset:offset + BATCH_SIZE]
+        screenshots = await db.get_screenshots_by_ids(guild_id, [int(p.stem) for p in chunk])
+        summary['missing'] += sum(1 for p in chunk if int(p.stem) not in screenshots)
+        jobs = [process(p, screenshots[int(p.stem)]) for p in chunk if int(p.stem) in screenshots]
+        rows = [row for row in await asyncio.gather(*jobs) if row]
+        summary.update(await db.upsert_screenshots(guild_id, rows))
+        summary['processed'] += len(rows)
+        if progress:
+            await progress(dict(summary))
+
+    summary['seconds'] = time.perf_counter() - start
+    logger.info(f"Reprocesado del directorio {directory} en guild {guild_id}: {dict(summary)}")
+    return dict(summary)
+
+def main():
+    parser = argparse.ArgumentParser(description="Reprocesa con OCR un directorio de capturas (<id>.png/.jpg)")
+    parser.add_argument('guild_id', type=int)
+    parser.add_argument('directory')
+    parser.add_argument('--workers', type=int, default=BATCH_CONCURRENCY, help="Procesos de OCR")
+    args = parser.parse_args()
+
+    async def progress(summary):
+        done = summary.get('processed', 0) + summary.get('missing', 0) + summary.get('errors', 0)
+        print(f"{done}/{summary['files']} archivos")
+
+    engine = ScreenshotEngine(workers=args.workers, max_pending=args.workers * 2)
+    engine.start()
+    try:
+        summary = asyncio.run(reprocess_directory(args.guild_id, args.directory, engine, progress))
+    finally:
+        engine.shutdown()
+        db.shutdown()
+    print(f"{summary.get('processed', 0)} capturas reprocesadas ({summary.get('updated', 0)} actualizadas, "
+          f"{summary.get('missing', 0)} sin registro, {summary.get('errors', 0)} errores) en {summary['seconds']:.1f}s")
+
+if __name__ == '__main__':
+    main()
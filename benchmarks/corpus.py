@@ -0,0 +1,61 @@
+import random
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+# Capturas sintéticas parecidas a un marcador de partido: filas "#<dorsal> <nick>" y un reloj en la esquina.
+# Cada muestra lleva sus etiquetas para poder medir la precisión del OCR.
+
+NICK_CHARS = 'abcdefghijkmnpqrstuvwxyz23456789'
+
+def _load_font(size: int):
+    for name in ('DejaVuSans-Bold.ttf', 'DejaVuSans.ttf', 'arial.ttf'):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        return ImageFont.load_default()
+
+def _random_nick(rng: random.Random) -> str:
+    return ''.join(rng.choice(NICK_CHARS) for _ in range(rng.randint(5, 10)))
+
+def make_sample(rng: random.Random, width: int = 1280, height: int = 720, rows: int = 10) -> dict:
+    background = tuple(rng.randint(10, 60) for _ in range(3))
+    img = Image.new('RGB', (width, height), background)
+    draw = ImageDraw.Draw(img)
+    font = _load_font(height // 26)
+
+    # Franjas alternas como las de un marcador real
+    row_height = (height - 120) // rows
+    for i in range(rows):
+        if i % 2:
+            y = 80 + i * row_height
+            draw.rectangle((40, y, width - 40, y + row_height), fill=tuple(min(255, c + 25) for c in background))
+
+    nicktags = []
+    for i in range(rows):
+        nick = _random_nick(rng)
+        nicktags.append(nick)
+        y = 80 + i * row_height + row_height // 4
+        draw.text((60, y), f"#{rng.randint(1, 99)}  {nick}", fill=(235, 235, 235), font=font)
+
+    screenshot_time = f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}"
+    draw.text((width - 180, 20), screenshot_time, fill=(255, 255, 255), font=font)
+
+    # Desenfoque leve, ruido y compresión JPEG como en las capturas que sube la gente
+    img = img.filter(ImageFilter.GaussianBlur(radius=rng.uniform(0.3, 0.9)))
+    noise = Image.effect_noise((width, height), rng.uniform(8, 20)).convert('RGB')
+    img = Image.blend(img, noise, 0.08)
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=rng.randint(60, 85))
+    return {'data': buffer.getvalue(), 'nicktags': nicktags, 'screenshot_time': screenshot_time}
+
+# Regiones de interés del corpus, en el formato de ocr_utils.parse_roi: las filas de nicktags y el reloj
+CORPUS_ROI = {'nicktags': [0.03, 0.1, 0.6, 0.95], 'clock': [0.8, 0.0, 1.0, 0.1]}
+
+def make_corpus(size: int, seed: int = 1234, **kwargs) -> list:
+    rng = random.Random(seed)
+    return [make_sample(rng, **kwargs) for _ in range(size)]
@@ -0,0 +1,155 @@
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+import pytesseract
+import ocr_utils
+from benchmarks.corpus import CORPUS_ROI, make_corpus
+from nicktag_matcher import NicktagMatcher
+
+# Benchmark del pipeline de OCR sobre el corpus sintético etiquetado (no necesita red):
+# latencia p50/p95 por etapa, capturas por segundo y precisión de nicktags y horas.
+# Mide ocr_utils.process_screenshot, lo mismo que ejecutan los procesos de OCR del bot; --roi elige la
+# configuración del guild: las dos regiones, solo nicktags (reloj por defecto) o la captura completa.
+#   python -m benchmarks.ocr_bench --samples 30 --save-baseline baseline.json
+#   python -m benchmarks.ocr_bench --samples 30 --baseline baseline.json
+# Con --baseline el proceso termina con código 1 si la precisión baja o la latencia p95 empeora.
+
+# decode, preprocess y ocr son los tiempos que devuelve process_screenshot; extract es el resto de esa llamada
+# (recortes de las regiones y extracción de nicktags y hora)
+STAGES = ('decode', 'preprocess', 'ocr', 'extract', 'match')
+
+ROI_MODES = {
+    'regions': CORPUS_ROI,
+    'nicktags': {'nicktags': CORPUS_ROI['nicktags']},
+    'full': None,
+}
+
+def _percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+def run(samples: int, seed: int, engine: str, backend: str, roi_mode: str) -> dict:
+    # process_screenshot usa el preprocesado y el backend configurados en el módulo, como en los workers
+    ocr_utils.OCR_PREPROCESS = engine
+    ocr_utils.OCR_BACKEND = backend
+    ocr = ocr_utils.get_backend()
+    roi = ROI_MODES[roi_mode]
+    if ocr.name == 'pytesseract':
+        try:
+            pytesseract.get_tesseract_version()
+        except (pytesseract.TesseractNotFoundError, OSError):
+            raise SystemExit(f"Tesseract no está disponible en {ocr_utils.TESSERACT_PATH}.")
+
+    corpus = make_corpus(samples, seed=seed)
+    rng = random.Random(seed)
+    # Todos los nicks del corpus son jugadores registrados; en cada captura "sube" uno de ellos
+    players = [{'name': nick, 'user_id': i} for i, nick in enumerate(n for s in corpus for n in s['nicktags'])]
+    matcher = NicktagMatcher(players)
+    owners = {p['name']: p['user_id'] for p in players}
+
+    timings = {stage: [] for stage in STAGES}
+    totals = []
+    tags_found = tags_total = uploaders_ok = clocks_ok = 0
+    for sample in corpus:
+        start = time.perf_counter()
+        result = ocr_utils.process_screenshot(sample['data'], roi)
+        processed = time.perf_counter()
+        nicktags, screenshot_time = result['nicktags'], result['screenshot_time']
+        uploader = rng.choice(sample['nicktags'])
+        match = matcher.match_player(nicktags, owners[uploader])
+        end = time.perf_counter()
+
+        stages = {stage: result['timings'].get(stage, 0.0) for stage in ('decode', 'preprocess', 'ocr')}
+        stages['extract'] = max(0.0, processed - start - sum(stages.values()))
+        stages['match'] = end - processed
+        for stage, elapsed in stages.items():
+            timings[stage].append(elapsed * 1000)
+        totals.append(end - start)
+
+        matched = {m['user_id'] for m in matcher.match_all(nicktags)}
+        tags_found += sum(1 for nick in sample['nicktags'] if owners[nick] in matched)
+        tags_total += len(sample['nicktags'])
+        uploaders_ok += match is not None
+        clocks_ok += screenshot_time == sample['screenshot_time']
+
+    return {
+        'samples': samples,
+        'seed': seed,
+        'engine': engine,
+        'backend': ocr.name,
+        'roi': roi_mode,
+        'throughput': samples / sum(totals),
+        'stages': {stage: {'p50_ms': statistics.median(values), 'p95_ms': _percentile(values, 0.95)}
+                   for stage, values in timings.items()},
+        'total_p95_ms': _percentile([t * 1000 for t in totals], 0.95),
+        'nicktag_recall': tags_found / tags_total,
+        'uploader_accuracy': uploaders_ok / samples,
+        'time_accuracy': clocks_ok / samples,
+    }
+
+def print_report(report: dict):
+    print(f"{report['samples']} capturas (seed {report['seed']}, preprocesado {report['engine']}, backend {report['backend']}, "
+          f"ROI {report['roi']}): "
+          f"{report['throughput']:.2f} capturas/s, p95 total {report['total_p95_ms']:.0f} ms")
+    for stage, values in report['stages'].items():
+        print(f"  {stage:>10}: p50 {values['p50_ms']:8.1f} ms  p95 {values['p95_ms']:8.1f} ms")
+    print(f"  nicktags reconocidos: {report['nicktag_recall']:.1%}  "
+          f"uploader: {report['uploader_accuracy']:.1%}  horas: {report['time_accuracy']:.1%}")
+
+def compare(report: dict, baseline: dict, accuracy_tolerance: float, latency_tolerance: float) -> list:
+    if (report['samples'], report['seed']) != (baseline['samples'], baseline['seed']):
+        print("Aviso: el baseline se midió con otro corpus (samples/seed); la comparación no es exacta.")
+    if report['roi'] != baseline.get('roi', 'full'):
+        print(f"Aviso: el baseline se midió con ROI {baseline.get('roi', 'full')}; la comparación no es exacta.")
+    regressions = []
+    print("Comparación con el baseline:")
+    for key in ('nicktag_recall', 'uploader_accuracy', 'time_accuracy'):
+        delta = report[key] - baseline[key]
+        print(f"  {key}: {baseline[key]:.1%} -> {report[key]:.1%} ({delta:+.1%})")
+        if delta < -accuracy_tolerance:
+            regressions.append(key)
+    for stage in STAGES:
+        if stage not in baseline['stages']:
+            continue
+        before, after = baseline['stages'][stage]['p95_ms'], report['stages'][stage]['p95_ms']
+        change = (after - before) / before if before else 0.0
+        print(f"  {stage} p95: {before:.1f} -> {after:.1f} ms ({change:+.0%})")
+        # Las etapas de menos de 1 ms son ruido
+        if before >= 1 and change > latency_tolerance:
+            regressions.append(f"{stage}_p95")
+    print(f"  capturas/s: {baseline['throughput']:.2f} -> {report['throughput']:.2f}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de velocidad y precisión del OCR de capturas")
+    parser.add_argument('--samples', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--engine', choices=('pillow', 'numpy'), default=ocr_utils.OCR_PREPROCESS)
+    parser.add_argument('--backend', choices=('auto', 'tesserocr', 'pytesseract'), default=ocr_utils.OCR_BACKEND)
+    parser.add_argument('--roi', choices=tuple(ROI_MODES), default='regions',
+                        help="Regiones de OCR: las dos del corpus, solo nicktags o la captura completa")
+    parser.add_argument('--baseline', help="JSON de una ejecución anterior con el que comparar")
+    parser.add_argument('--save-baseline', help="Guarda el resultado como baseline en este archivo")
+    parser.add_argument('--accuracy-tolerance', type=float, default=0.02, help="Caída de precisión permitida (fracción)")
+    parser.add_argument('--latency-tolerance', type=float, default=0.15, help="Aumento de p95 permitido (fracción)")
+    args = parser.parse_args()
+
+    report = run(args.samples, args.seed, args.engine, args.backend, args.roi)
+    print_report(report)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline guardado en {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.accuracy_tolerance, args.latency_tolerance)
+        if regressions:
+            print(f"Regresiones: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import statistics
+import time
+from io import BytesIO
+
+import pytesseract
+from PIL import Image
+
+import ocr_utils
+from benchmarks.corpus import make_corpus
+
+# Compara los motores de preprocesado (Pillow y NumPy) en velocidad y, si Tesseract está instalado,
+# en nicktags y horas reconocidos sobre el corpus sintético.
+#   python -m benchmarks.preprocess_bench --samples 20
+
+ENGINES = ('pillow', 'numpy')
+
+def _tesseract_available() -> bool:
+    try:
+        pytesseract.get_tesseract_version()
+        return True
+    except (pytesseract.TesseractNotFoundError, OSError):
+        return False
+
+def _score(text: str, sample: dict) -> tuple:
+    text = text.replace('O', '0').replace('I', '1').replace('l', '1')
+    found = {ocr_utils.normalize_name(tag) for tag in ocr_utils.extract_nicktags(text)}
+    expected = [ocr_utils.normalize_name(tag) for tag in sample['nicktags']]
+    hits = sum(1 for tag in expected if tag in found)
+    return hits, len(expected), ocr_utils.extract_screenshot_time(text) == sample['screenshot_time']
+
+def run(samples: int, repeat: int, seed: int):
+    if ocr_utils.np is None:
+        raise SystemExit("numpy no está instalado: no se puede comparar el motor 'numpy'.")
+    corpus = make_corpus(samples, seed=seed)
+    images = [Image.open(BytesIO(sample['data'])).convert('RGB') for sample in corpus]
+    with_ocr = _tesseract_available()
+    if not with_ocr:
+        print("Tesseract no disponible: solo se mide el tiempo de preprocesado.")
+
+    print(f"{samples} capturas, {repeat} repeticiones")
+    for engine in ENGINES:
+        timings = []
+        hits = total = clocks = 0
+        for img, sample in zip(images, corpus):
+            for _ in range(repeat):
+                start = time.perf_counter()
+                processed = ocr_utils.preprocess(img, engine)
+                timings.append((time.perf_counter() - start) * 1000)
+            if with_ocr:
+                h, t, clock_ok = _score(pytesseract.image_to_string(processed, lang='eng'), sample)
+                hits += h
+                total += t
+                clocks += clock_ok
+        timings.sort()
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        line = f"{engine:>7}: p50 {statistics.median(timings):7.1f} ms  p95 {p95:7.1f} ms"
+        if with_ocr:
+            line += f"  nicktags {hits}/{total} ({hits / max(total, 1):.0%})  horas {clocks}/{len(corpus)}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de los motores de preprocesado de OCR")
+    parser.add_argument('--samples', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args()
+    run(args.samples, args.repeat, args.seed)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,19 @@
 import sqlite3
 import logging
 import os
+import threading
+import time
+import glob
+import json
+import re
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
+import query_metrics
+from entity_cache import EntityCache
+from identity_index import IdentityIndex, NOT_LOADED, empty_identity
+
 database_logger = logging.getLogger('database')
 database_logger.setLevel(logging.INFO)
 handler = logging.FileHandler('bot.log')
@@ -12,14 +23,215 @@ database_logger.addHandler(handler)
 GLOBAL_DB_PATH = 'global.db'
 VALID_STATUSES = {'pending', 'accepted', 'rejected', 'cancelled', 'finalized', 'bought_clause'}
 
+# Hilos lectores por base de datos en async_database.py (además de su único hilo escritor)
+READER_THREADS_PER_DB = int(os.getenv("DB_READER_THREADS", "4"))
+# Escritor + lectores + uno para los hilos de mantenimiento (checkpoints, copias, migraciones)
+POOL_SIZE_PER_DB = int(os.getenv("DB_POOL_SIZE", str(READER_THREADS_PER_DB + 2)))
+POOL_MAX_DATABASES = int(os.getenv("DB_POOL_MAX_DATABASES", "64"))
+POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "10"))
+
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "8192"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+WAL_SIZE_LIMIT = int(os.getenv("DB_WAL_SIZE_LIMIT", str(32 * 1024 * 1024)))
+WAL_TRUNCATE_THRESHOLD = int(os.getenv("DB_WAL_TRUNCATE_THRESHOLD", str(16 * 1024 * 1024)))
+
+# Pragmas aplicados a cada conexión nueva del pool
+_CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size = {DB_MMAP_SIZE}",
+    "PRAGMA temp_store = MEMORY",
+    f"PRAGMA journal_size_limit = {WAL_SIZE_LIMIT}",
+)
+
+# Caché de hashes perceptuales de capturas (tabla screenshot_hashes, migración 2)
+SCREENSHOT_HASH_MAX_ENTRIES = int(os.getenv("SCREENSHOT_HASH_MAX_ENTRIES", "5000"))
+# Bits distintos (de 1024) para considerar dos capturas la misma imagen recortada o recomprimida
+SCREENSHOT_HASH_MAX_DISTANCE = int(os.getenv("SCREENSHOT_HASH_MAX_DISTANCE", "45"))
+
+def _hamming(a: bytes, b: bytes) -> int:
+    if a is None or b is None or len(a) != len(b):
+        return None
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).bit_count()
+
 def get_db_path(guild_id: int) -> str:
     return f"league_{guild_id}.db"
 
+class _DatabasePool:
+    def __init__(self, db_path: str, lock: threading.Lock):
+        self.db_path = db_path
+        self.idle = []
+        self.in_use = 0
+        self.lent = set()
+        # Una condición por base: una conexión liberada solo despierta a quien espera por esa misma base
+        self.released = threading.Condition(lock)
+
+class ConnectionPool:
+    """Pool acotado de conexiones abiertas por archivo de base de datos, con desalojo LRU de las bases inactivas."""
+
+    def __init__(self, size_per_db: int, max_databases: int, acquire_timeout: float):
+        self.size_per_db = max(1, size_per_db)
+        self.max_databases = max(1, max_databases)
+        self.acquire_timeout = acquire_timeout
+        self._pools = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _open(self, db_path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=self.acquire_timeout)
+        conn.row_factory = sqlite3.Row
+        conn.create_function('hamming', 2, _hamming, deterministic=True)
+        for pragma in _CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _evict_idle(self):
+        # Cierra las bases menos usadas recientemente que no tengan conexiones prestadas
+        for path in list(self._pools):
+            if len(self._pools) <= self.max_databases:
+                break
+            pool = self._pools[path]
+            if pool.in_use:
+                continue
+            for conn in pool.idle:
+                conn.close()
+            del self._pools[path]
+            database_logger.debug(f"Pool de conexiones de {path} desalojado por inactividad.")
+
+    def acquire(self, db_path: str) -> sqlite3.Connection:
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._lock:
+            while True:
+                pool = self._pools.get(db_path)
+                if pool is None:
+                    pool = self._pools[db_path] = _DatabasePool(db_path, self._lock)
+                    self._evict_idle()
+                self._pools.move_to_end(db_path)
+                if pool.idle or pool.in_use < self.size_per_db:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise sqlite3.OperationalError(f"Tiempo de espera agotado para obtener una conexión a {db_path}")
+                # Si el pool se cierra mientras se espera, la vuelta siguiente usa el nuevo
+                pool.released.wait(remaining)
+            pool.in_use += 1
+            if pool.idle:
+                conn = pool.idle.pop()
+                pool.lent.add(conn)
+                return conn
+        try:
+            conn = self._open(db_path)
+        except sqlite3.Error:
+            with self._lock:
+                pool.in_use -= 1
+                pool.released.notify()
+            raise
+        with self._lock:
+            pool.lent.add(conn)
+        return conn
+
+    def release(self, db_path: str, conn: sqlite3.Connection):
+        with self._lock:
+            pool = self._pools.get(db_path)
+            if pool is None or conn not in pool.lent:
+                # El pool fue cerrado (y quizá recreado) mientras la conexión estaba prestada
+                conn.close()
+                return
+            pool.lent.discard(conn)
+            pool.in_use -= 1
+            pool.idle.append(conn)
+            pool.released.notify()
+
+    @contextmanager
+    def connection(self, db_path: str):
+        conn = self.acquire(db_path)
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self.release(db_path, conn)
+
+    def close(self, db_path: str = None):
+        with self._lock:
+            paths = [db_path] if db_path else list(self._pools)
+            for path in paths:
+                pool = self._pools.pop(path, None)
+                if pool:
+                    for conn in pool.idle:
+                        conn.close()
+                    pool.released.notify_all()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {path: {'idle': len(pool.idle), 'in_use': pool.in_use} for path, pool in self._pools.items()}
+
+_pool = ConnectionPool(POOL_SIZE_PER_DB, POOL_MAX_DATABASES, POOL_ACQUIRE_TIMEOUT)
+
+def _connect(guild_id: int):
+    return _pool.connection(get_db_path(guild_id))
+
+def _connect_global():
+    return _pool.connection(GLOBAL_DB_PATH)
+
+def close_connections(guild_id: int = None):
+    close_pool(get_db_path(guild_id) if guild_id is not None else None)
+
+def close_pool(db_path: str = None):
+    """Cierra las conexiones de un archivo (o de todos); las prestadas se cierran al devolverse."""
+    _pool.close(db_path)
+
+def list_guild_databases() -> list:
+    guild_ids = []
+    for path in glob.glob("league_*.db"):
+        match = re.fullmatch(r"league_(\d+)\.db", os.path.basename(path))
+        if match:
+            guild_ids.append(int(match.group(1)))
+    return sorted(guild_ids)
+
+def get_wal_size(guild_id: int = None) -> int:
+    db_path = get_db_path(guild_id) if guild_id is not None else GLOBAL_DB_PATH
+    try:
+        return os.path.getsize(f"{db_path}-wal")
+    except OSError:
+        return 0
+
+def checkpoint_wal(guild_id: int = None, mode: str = 'PASSIVE') -> tuple:
+    if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+        raise ValueError(f"Modo de checkpoint inválido: {mode}")
+    db_path = get_db_path(guild_id) if guild_id is not None else GLOBAL_DB_PATH
+    try:
+        with _pool.connection(db_path) as conn:
+            busy, log_frames, checkpointed = conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+            return busy, log_frames, checkpointed
+    except sqlite3.Error as e:
+        database_logger.error(f"Error al hacer checkpoint del WAL para guild {guild_id or 'global'}: {e}")
+        return 1, -1, -1
+
+def checkpoint_all_wal() -> dict:
+    # PASSIVE nunca bloquea a lectores ni escritores; TRUNCATE solo cuando el WAL creció demasiado
+    report = {}
+    for guild_id in [None] + list_guild_databases():
+        size_before = get_wal_size(guild_id)
+        if size_before == 0:
+            continue
+        mode = 'TRUNCATE' if size_before > WAL_TRUNCATE_THRESHOLD else 'PASSIVE'
+        busy, _, _ = checkpoint_wal(guild_id, mode)
+        report[guild_id] = {'before': size_before, 'after': get_wal_size(guild_id), 'mode': mode, 'busy': bool(busy)}
+    if report:
+        database_logger.info(f"Checkpoint de WAL completado para {len(report)} bases de datos.")
+    return report
+
+def get_wal_sizes() -> dict:
+    return {guild_id: get_wal_size(guild_id) for guild_id in [None] + list_guild_databases()}
+
 def create_tables(guild_id: int):
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.executescript("""
             CREATE TABLE IF NOT EXISTS teams (
@@ -129,9 +341,32 @@ def create_tables(guild_id: int):
         database_logger.error(f"Error al crear tablas para guild {guild_id}: {e}")
         raise
 
+def _is_full_scan(detail: str) -> bool:
+    # "SCAN tabla" sin índice recorre la tabla entera; "SCAN ... USING INDEX" recorre un índice
+    return detail.startswith('SCAN') and 'INDEX' not in detail and 'CONSTANT ROW' not in detail
+
+def explain_query_plans(guild_id: int) -> dict:
+    plans = {}
+    try:
+        with _connect(guild_id) as conn:
+            for name, (query, params, allow_scan) in _QUERY_PLAN_CHECKS.items():
+                details = [row['detail'] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', params)]
+                plans[name] = {
+                    'plan': details,
+                    'full_scan': any(_is_full_scan(d) for d in details),
+                    'allow_scan': allow_scan,
+                }
+    except sqlite3.Error as e:
+        database_logger.error(f"Error al obtener planes de consulta para guild {guild_id}: {e}")
+    return plans
+
+def find_query_plan_regressions(guild_id: int) -> dict:
+    return {name: info['plan'] for name, info in explain_query_plans(guild_id).items()
+            if info['full_scan'] and not info['allow_scan']}
+
 def create_global_tables():
     try:
-        with sqlite3.connect(GLOBAL_DB_PATH) as conn:
+        with _connect_global() as conn:
             conn.execute('''CREATE TABLE IF NOT EXISTS banned_guilds (
                 guild_id INTEGER PRIMARY KEY
             )''')
@@ -142,7 +377,7 @@ def create_global_tables():
 
 def ban_guild(guild_id: int):
     try:
-        with sqlite3.connect(GLOBAL_DB_PATH) as conn:
+        with _connect_global() as conn:
             conn.execute('INSERT OR IGNORE INTO banned_guilds (guild_id) VALUES (?)', (guild_id,))
             conn.commit()
         database_logger.info(f"Guild {guild_id} baneado.")
@@ -151,7 +386,7 @@ def ban_guild(guild_id: int):
 
 def unban_guild(guild_id: int):
     try:
-        with sqlite3.connect(GLOBAL_DB_PATH) as conn:
+        with _connect_global() as conn:
             conn.execute('DELETE FROM banned_guilds WHERE guild_id = ?', (guild_id,))
             conn.commit()
         database_logger.info(f"Guild {guild_id} desbaneado.")
@@ -160,7 +395,7 @@ def unban_guild(guild_id: int):
 
 def is_guild_banned(guild_id: int) -> bool:
     try:
-        with sqlite3.connect(GLOBAL_DB_PATH) as conn:
+        with _connect_global() as conn:
             cur = conn.execute('SELECT 1 FROM banned_guilds WHERE guild_id = ?', (guild_id,))
             return cur.fetchone() is not None
     except sqlite3.Error as e:
@@ -168,30 +403,50 @@ def is_guild_banned(guild_id: int) -> bool:
         return False
 
 def set_market_status(guild_id: int, status: str):
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             conn.execute('INSERT OR REPLACE INTO guild_config (key, value) VALUES (?, ?)', ('market_status', status))
             conn.commit()
         database_logger.info(f"Estado del mercado para guild {guild_id} establecido a {status}.")
     except sqlite3.Error as e:
         database_logger.error(f"Error al establecer estado del mercado para guild {guild_id}: {e}")
 
+_SQL_GUILD_CONFIG_VALUE = 'SELECT value FROM guild_config WHERE key = ?'
+
 def get_market_status(guild_id: int) -> str:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            cur = conn.execute('SELECT value FROM guild_config WHERE key = ?', ('market_status',))
+        with _connect(guild_id) as conn:
+            cur = conn.execute(_SQL_GUILD_CONFIG_VALUE, ('market_status',))
             row = cur.fetchone()
             return row[0] if row else 'closed'
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener estado del mercado para guild {guild_id}: {e}")
         return 'closed'
 
+def set_ocr_roi(guild_id: int, roi: dict):
+    try:
+        with _connect(guild_id) as conn:
+            if roi:
+                conn.execute('INSERT OR REPLACE INTO guild_config (key, value) VALUES (?, ?)', ('ocr_roi', json.dumps(roi)))
+            else:
+                conn.execute("DELETE FROM guild_config WHERE key = 'ocr_roi'")
+            conn.commit()
+        database_logger.info(f"Regiones de OCR para guild {guild_id} establecidas a {roi}.")
+    except sqlite3.Error as e:
+        database_logger.error(f"Error al establecer regiones de OCR para guild {guild_id}: {e}")
+
+def get_ocr_roi(guild_id: int) -> dict:
+    try:
+        with _connect(guild_id) as conn:
+            row = conn.execute(_SQL_GUILD_CONFIG_VALUE, ('ocr_roi',)).fetchone()
+            return json.loads(row[0]) if row else {}
+    except (sqlite3.Error, ValueError) as e:
+        database_logger.error(f"Error al obtener regiones de OCR para guild {guild_id}: {e}")
+        return {}
+
 def set_server_settings(guild_id: int, ss_channel_ids: str, arbiter_role_id: int):
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute(
                 "INSERT OR REPLACE INTO server_config (guild_id, ss_channel_ids, arbiter_role_id) VALUES (?, ?, ?)",
@@ -201,11 +456,12 @@ def set_server_settings(guild_id: int, ss_channel_ids: str, arbiter_role_id: int
             database_logger.info(f"Configuración establecida para guild {guild_id}: canales {ss_channel_ids}, rol {arbiter_role_id}")
     except sqlite3.Error as e:
         database_logger.error(f"Error al establecer configuración para guild {guild_id}: {e}")
+    finally:
+        invalidate_server_config(guild_id)
 
 def set_amistosos_channel(guild_id: int, channel_id: int):
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute(
                 "UPDATE server_config SET amistosos_channel_id = ? WHERE guild_id = ?",
@@ -220,61 +476,200 @@ def set_amistosos_channel(guild_id: int, channel_id: int):
             database_logger.info(f"Canal de amistosos establecido a {channel_id} para guild {guild_id}")
     except sqlite3.Error as e:
         database_logger.error(f"Error al establecer canal de amistosos para guild {guild_id}: {e}")
+    finally:
+        invalidate_server_config(guild_id)
+
+# Caché de server_config por guild. on_message la consulta en cada mensaje, así que se guarda ya parseada
+# (ss_channel_ids como frozenset) y los set_* la invalidan al escribir. También se guarda la ausencia de configuración.
+CONFIG_NOT_CACHED = object()
+_server_config_cache = {}
+_server_config_generation = {}
+_server_config_lock = threading.Lock()
+
+def peek_server_config(guild_id: int):
+    """Configuración en caché sin tocar la base de datos, o CONFIG_NOT_CACHED."""
+    return _server_config_cache.get(guild_id, CONFIG_NOT_CACHED)
+
+def invalidate_server_config(guild_id: int = None):
+    with _server_config_lock:
+        if guild_id is None:
+            _server_config_cache.clear()
+            for key in _server_config_generation:
+                _server_config_generation[key] += 1
+        else:
+            _server_config_cache.pop(guild_id, None)
+            _server_config_generation[guild_id] = _server_config_generation.get(guild_id, 0) + 1
+
+def _parse_server_config(row: sqlite3.Row) -> dict:
+    config = dict(row)
+    channel_ids = [int(id.strip()) for id in config['ss_channel_ids'].split(',')] if config['ss_channel_ids'] else []
+    config['ss_channel_ids'] = frozenset(channel_ids)
+    # El primer canal configurado recibe las capturas para revisión
+    config['review_channel_id'] = channel_ids[0] if channel_ids else None
+    return config
+
+_SQL_SERVER_CONFIG = 'SELECT * FROM server_config WHERE guild_id = ?'
 
 def get_server_config(guild_id: int) -> dict:
-    db_path = get_db_path(guild_id)
+    cached = peek_server_config(guild_id)
+    if cached is not CONFIG_NOT_CACHED:
+        return cached
+    with _server_config_lock:
+        generation = _server_config_generation.get(guild_id, 0)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('SELECT * FROM server_config WHERE guild_id = ?', (guild_id,))
+            cur.execute(_SQL_SERVER_CONFIG, (guild_id,))
             row = cur.fetchone()
-            if row:
-                config = dict(row)
-                config['ss_channel_ids'] = [int(id.strip()) for id in config['ss_channel_ids'].split(',')] if config['ss_channel_ids'] else []
-                return config
-            return None
+            config = _parse_server_config(row) if row else None
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener configuración del servidor para guild {guild_id}: {e}")
         return None
+    with _server_config_lock:
+        # Si hubo una escritura mientras se leía, el valor leído puede estar desactualizado
+        if _server_config_generation.get(guild_id, 0) == generation:
+            _server_config_cache[guild_id] = config
+    return config
         
 def reset_transferable_status(guild_id: int):
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('UPDATE players SET transferable = 0')
             conn.commit()
             database_logger.info(f"Estado transferable reiniciado a 0 para todos los jugadores en guild {guild_id}.")
     except sqlite3.Error as e:
         database_logger.error(f"Error al reiniciar transferable en guild {guild_id}: {e}")
+    finally:
+        _entities_changed(guild_id)
 
 def _row_to_dict(row: sqlite3.Row) -> dict:
     return dict(row) if row else None
 
+# Caché de equipos, jugadores y capitanes (ver entity_cache.py). Las lecturas cacheadas etiquetan sus
+# entradas con las entidades de las que dependen y cada escritura invalida solo esas etiquetas.
+_entities = EntityCache()
+
+def _team_tags(team: dict) -> list:
+    return [('team', team['id'])] if team else []
+
+def _player_tags(player: dict) -> list:
+    if not player:
+        return []
+    tags = [('player_name', player['name'])]
+    if player['team_id'] is not None:
+        tags.append(('roster', player['team_id']))
+    return tags
+
+def _fetch_one(guild_id: int, query: str, params: tuple) -> dict:
+    with _connect(guild_id) as conn:
+        return _row_to_dict(conn.execute(query, params).fetchone())
+
+def _load_identities(guild_id: int) -> tuple:
+    with _connect(guild_id) as conn:
+        teams = [dict(row) for row in conn.execute('SELECT * FROM teams')]
+        captains = [tuple(row) for row in conn.execute('SELECT team_id, captain_id FROM team_captains')]
+        players = [dict(row) for row in conn.execute('SELECT * FROM players')]
+    return teams, captains, players
+
+# Índice user_id -> rol y equipo (ver identity_index.py); las escrituras releen solo las filas que cambian
+_identities = IdentityIndex(_load_identities)
+
+def _rows_in(conn: sqlite3.Connection, query: str, values: set) -> list:
+    if not values:
+        return []
+    values = list(values)
+    return [dict(row) for row in conn.execute(query.format(','.join('?' * len(values))), values)]
+
+def _refresh_identities(guild_id: int, tags: tuple):
+    keys = {}
+    for kind, key in tags:
+        keys.setdefault(kind, set()).add(key)
+    names, managers, roster = keys.get('team_name', set()), keys.get('manager', set()), keys.get('roster', set())
+    player_names, captain_teams, captain_users = keys.get('player_name', set()), keys.get('captains', set()), keys.get('captain', set())
+
+    def patch(index):
+        # Se ejecuta con el lock del índice: las filas leídas son las últimas confirmadas y nadie más lo toca
+        # Las filas que hoy están en el índice también se releen, para detectar las que se borraron o cambiaron de equipo
+        team_ids = keys.get('team', set()) | {t['id'] for t in index.teams.values() if t['name'] in names or t['manager_id'] in managers}
+        user_ids = keys.get('player', set()) | {p['user_id'] for p in index.players.values()
+                                                if p['name'] in player_names or p['team_id'] in roster}
+        with _connect(guild_id) as conn:
+            teams = (_rows_in(conn, 'SELECT * FROM teams WHERE id IN ({})', team_ids)
+                     + _rows_in(conn, 'SELECT * FROM teams WHERE name IN ({})', names)
+                     + _rows_in(conn, 'SELECT * FROM teams WHERE manager_id IN ({})', managers))
+            players = (_rows_in(conn, 'SELECT * FROM players WHERE user_id IN ({})', user_ids)
+                       + _rows_in(conn, 'SELECT * FROM players WHERE name IN ({})', player_names)
+                       + _rows_in(conn, 'SELECT * FROM players WHERE team_id IN ({})', roster))
+            pairs = {(row['team_id'], row['captain_id']) for row in
+                     _rows_in(conn, 'SELECT team_id, captain_id FROM team_captains WHERE team_id IN ({})', captain_teams)
+                     + _rows_in(conn, 'SELECT team_id, captain_id FROM team_captains WHERE captain_id IN ({})', captain_users)}
+        teams = {team['id']: team for team in teams}
+        players = {player['user_id']: player for player in players}
+        for team_id in team_ids | teams.keys():
+            index.put_team(team_id, teams.get(team_id))
+        for user_id in user_ids | players.keys():
+            index.put_player(user_id, players.get(user_id))
+        if captain_teams or captain_users:
+            index.replace_captains(lambda team_id, captain_id: team_id not in captain_teams and captain_id not in captain_users,
+                                   sorted(pairs))
+
+    try:
+        _identities.refresh(guild_id, patch)
+    except sqlite3.Error as e:
+        # refresh ya descartó el índice del guild
+        database_logger.warning(f"No se pudo actualizar el índice de identidades en guild {guild_id}, se descarta: {e}")
+
+def _entities_changed(guild_id: int, *tags):
+    # Sin etiquetas: cambió todo el guild (temporada nueva, reinicio de transferibles)
+    if tags:
+        _entities.invalidate(guild_id, *tags)
+        _refresh_identities(guild_id, tags)
+    else:
+        _entities.clear(guild_id)
+        _identities.invalidate(guild_id)
+
+def entity_cache_stats() -> dict:
+    return _entities.stats()
+
+def invalidate_entities(guild_id: int = None):
+    _entities.clear(guild_id)
+    _identities.invalidate(guild_id)
+
+def peek_identity(guild_id: int, user_id: int):
+    """Identidad desde el índice en memoria sin tocar la base de datos, o NOT_LOADED."""
+    return _identities.peek(guild_id, user_id)
+
+def get_identity(guild_id: int, user_id: int) -> dict:
+    """Rol del usuario en el guild: jugador (y si está sancionado), manager o capitán, y de qué equipo."""
+    try:
+        return _identities.get(guild_id, user_id)
+    except sqlite3.Error as e:
+        database_logger.error(f"Error al cargar el índice de identidades en guild {guild_id}: {e}")
+        return empty_identity(user_id)
+
 def add_team(guild_id: int, name: str, division: str, manager_id: int = None) -> bool:
-    db_path = get_db_path(guild_id)
     if not name or not division:
         return False
     if manager_id and get_team_by_manager(guild_id, manager_id):
         return False
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('INSERT INTO teams(name, manager_id, division) VALUES (?, ?, ?)', (name, manager_id, division))
             team_id = cur.lastrowid
             cur.execute('INSERT OR IGNORE INTO club_balance(team_id, balance) VALUES (?, 0)', (team_id,))
             conn.commit()
             database_logger.info(f"Equipo {name} creado con ID {team_id} en división {division} en guild {guild_id}.")
+        _entities_changed(guild_id, ('team_name', name), ('manager', manager_id))
         return True
     except sqlite3.IntegrityError:
         database_logger.warning(f"Intento de crear equipo duplicado: {name} en guild {guild_id}")
         return False
 
 def delete_team(guild_id: int, team_name: str) -> bool:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('SELECT id FROM teams WHERE name = ?', (team_name,))
             team = cur.fetchone()
@@ -290,77 +685,80 @@ def delete_team(guild_id: int, team_name: str) -> bool:
             cur.execute('DELETE FROM teams WHERE id = ?', (team_id,))
             conn.commit()
             database_logger.info(f"Equipo {team_name} eliminado en guild {guild_id}.")
+        _entities_changed(guild_id, ('team', team_id), ('roster', team_id), ('captains', team_id))
         return True
     except sqlite3.Error as e:
         database_logger.error(f"Error al eliminar equipo {team_name} en guild {guild_id}: {e}")
         return False
 
+_SQL_TEAM_BY_MANAGER = 'SELECT * FROM teams WHERE manager_id = ?'
+
 def get_team_by_manager(guild_id: int, manager_id: int) -> dict:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute('SELECT * FROM teams WHERE manager_id = ?', (manager_id,))
-            return _row_to_dict(cur.fetchone())
+        return _entities.get(
+            guild_id, ('team_by_manager', manager_id),
+            lambda: _fetch_one(guild_id, _SQL_TEAM_BY_MANAGER, (manager_id,)),
+            lambda team: [('manager', manager_id)] + _team_tags(team))
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener equipo por manager {manager_id} en guild {guild_id}: {e}")
         return None
 
+_SQL_TEAM_BY_NAME = 'SELECT * FROM teams WHERE name = ?'
+
 def get_team_by_name(guild_id: int, name: str) -> dict:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute('SELECT * FROM teams WHERE name = ?', (name,))
-            return _row_to_dict(cur.fetchone())
+        return _entities.get(
+            guild_id, ('team_by_name', name),
+            lambda: _fetch_one(guild_id, _SQL_TEAM_BY_NAME, (name,)),
+            lambda team: [('team_name', name)] + _team_tags(team))
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener equipo por nombre {name} en guild {guild_id}: {e}")
         return None
 
+_SQL_TEAM_BY_ID = 'SELECT * FROM teams WHERE id = ?'
+
 def get_team_by_id(guild_id: int, team_id: int) -> dict:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute('SELECT * FROM teams WHERE id = ?', (team_id,))
-            return _row_to_dict(cur.fetchone())
+        return _entities.get(
+            guild_id, ('team_by_id', team_id),
+            lambda: _fetch_one(guild_id, _SQL_TEAM_BY_ID, (team_id,)),
+            lambda team: [('team', team_id)])
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener equipo por ID {team_id} en guild {guild_id}: {e}")
         return None
 
+_SQL_ALL_TEAMS = 'SELECT * FROM teams ORDER BY name'
+_SQL_TEAMS_BY_DIVISION = 'SELECT * FROM teams WHERE division = ? ORDER BY name'
+
 def get_all_teams(guild_id: int, division: str = None) -> list:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             if division:
-                cur.execute('SELECT * FROM teams WHERE division = ? ORDER BY name', (division,))
+                cur.execute(_SQL_TEAMS_BY_DIVISION, (division,))
             else:
-                cur.execute('SELECT * FROM teams ORDER BY name')
+                cur.execute(_SQL_ALL_TEAMS)
             return [dict(row) for row in cur.fetchall()]
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener equipos en guild {guild_id}: {e}")
         return []
 
 def assign_manager_to_team(guild_id: int, team_id: int, manager_id: int):
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('UPDATE teams SET manager_id = ? WHERE id = ?', (manager_id, team_id))
             conn.commit()
             database_logger.info(f"Manager {manager_id} asignado al equipo {team_id} en guild {guild_id}.")
     except sqlite3.Error as e:
         database_logger.error(f"Error al asignar manager {manager_id} al equipo {team_id} en guild {guild_id}: {e}")
+    finally:
+        # La entrada del manager anterior depende de ('team', team_id)
+        _entities_changed(guild_id, ('team', team_id), ('manager', manager_id))
 
 def add_player(guild_id: int, name: str, user_id: int, team_id: int = None) -> bool:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             # Verificar si el user_id ya existe
             cur.execute('SELECT name FROM players WHERE user_id = ?', (user_id,))
@@ -370,82 +768,103 @@ def add_player(guild_id: int, name: str, user_id: int, team_id: int = None) -> b
             cur.execute('INSERT INTO players(name, user_id, team_id) VALUES (?, ?, ?)', (name, user_id, team_id))
             conn.commit()
             database_logger.info(f"Jugador {name} (ID: {user_id}) agregado en guild {guild_id}.")
+            _entities_changed(guild_id, ('player', user_id))
             return True
     except sqlite3.IntegrityError:
         database_logger.warning(f"Intento de agregar jugador duplicado: {name} en guild {guild_id}")
         return False
 
+_SQL_PLAYER_BY_ID = 'SELECT * FROM players WHERE user_id = ?'
+
 def get_player_by_id(guild_id: int, user_id: int) -> dict:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute('SELECT * FROM players WHERE user_id = ?', (user_id,))
-            return _row_to_dict(cur.fetchone())
+        return _entities.get(
+            guild_id, ('player_by_id', user_id),
+            lambda: _fetch_one(guild_id, _SQL_PLAYER_BY_ID, (user_id,)),
+            lambda player: [('player', user_id)] + _player_tags(player))
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener jugador por ID {user_id} en guild {guild_id}: {e}")
         return None
 
 def ban_player(guild_id: int, name: str):
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('UPDATE players SET banned = 1 WHERE name = ?', (name,))
             conn.commit()
             database_logger.info(f"Jugador {name} baneado en guild {guild_id}.")
     except sqlite3.Error as e:
         database_logger.error(f"Error al banear jugador {name} en guild {guild_id}: {e}")
+    finally:
+        _entities_changed(guild_id, ('player_name', name))
 
 def unban_player(guild_id: int, name: str):
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('UPDATE players SET banned = 0 WHERE name = ?', (name,))
             conn.commit()
             database_logger.info(f"Jugador {name} desbaneado en guild {guild_id}.")
     except sqlite3.Error as e:
         database_logger.error(f"Error al desbanear jugador {name} en guild {guild_id}: {e}")
+    finally:
+        _entities_changed(guild_id, ('player_name', name))
 
 def remove_player_from_team(guild_id: int, player_name: str) -> bool:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('UPDATE players SET team_id = NULL, contract_duration = NULL, release_clause = NULL, transferable = 0 WHERE name = ?', (player_name,))
             if cur.rowcount > 0:
                 conn.commit()
                 database_logger.info(f"Jugador {player_name} removido de su equipo en guild {guild_id}.")
+                _entities_changed(guild_id, ('player_name', player_name))
                 return True
             return False
     except sqlite3.Error as e:
         database_logger.error(f"Error al quitar jugador {player_name} del equipo en guild {guild_id}: {e}")
         return False
 
+_SQL_TRANSFERABLE_PLAYERS = '''
+    SELECT p.name, p.team_id, p.release_clause
+    FROM players p
+    LEFT JOIN teams t ON p.user_id = t.manager_id
+    WHERE p.transferable = 1 AND t.manager_id IS NULL
+'''
+
 def get_transferable_players(guild_id: int) -> list:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('''
-                SELECT p.name, p.team_id, p.release_clause 
-                FROM players p
-                LEFT JOIN teams t ON p.user_id = t.manager_id
-                WHERE p.transferable = 1 AND t.manager_id IS NULL
-            ''')
+            cur.execute(_SQL_TRANSFERABLE_PLAYERS)
             rows = cur.fetchall()
         return [{'name': r['name'], 'team_id': r['team_id'], 'release_clause': r['release_clause']} for r in rows]
-    except ctypes3.Error as e:
+    except sqlite3.Error as e:
         database_logger.error(f"Error al obtener jugadores transferibles en guild {guild_id}: {e}")
         return []
 
+_SQL_TRANSFERABLE_PLAYERS_WITH_TEAMS = '''
+    SELECT p.name, p.team_id, p.release_clause, pt.name AS team_name
+    FROM players p
+    LEFT JOIN teams t ON p.user_id = t.manager_id
+    LEFT JOIN teams pt ON p.team_id = pt.id
+    WHERE p.transferable = 1 AND t.manager_id IS NULL
+'''
+
+def get_transferable_players_with_teams(guild_id: int) -> list:
+    # Igual que get_transferable_players pero con el nombre del equipo en la misma consulta
+    try:
+        with _connect(guild_id) as conn:
+            cur = conn.cursor()
+            cur.execute(_SQL_TRANSFERABLE_PLAYERS_WITH_TEAMS)
+            return [dict(row) for row in cur.fetchall()]
+    except sqlite3.Error as e:
+        database_logger.error(f"Error al obtener jugadores transferibles con equipos en guild {guild_id}: {e}")
+        return []
+
 def set_player_transferable(guild_id: int, player_name: str, new_clause: int = None) -> bool:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             if new_clause is not None:
                 cur.execute('SELECT release_clause FROM players WHERE name = ?', (player_name,))
@@ -458,6 +877,7 @@ def set_player_transferable(guild_id: int, player_name: str, new_clause: int = N
             if cur.rowcount > 0:
                 conn.commit()
                 database_logger.info(f"Jugador {player_name} marcado como transferible con cláusula {new_clause if new_clause else 'sin cambios'} en guild {guild_id}.")
+                _entities_changed(guild_id, ('player_name', player_name))
                 return True
             return False
     except sqlite3.Error as e:
@@ -465,9 +885,8 @@ def set_player_transferable(guild_id: int, player_name: str, new_clause: int = N
         return False
 
 def unset_player_transferable(guild_id: int, player_name: str) -> bool:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('SELECT original_release_clause FROM players WHERE name = ?', (player_name,))
             original_clause = cur.fetchone()
@@ -479,55 +898,106 @@ def unset_player_transferable(guild_id: int, player_name: str) -> bool:
             if cur.rowcount > 0:
                 conn.commit()
                 database_logger.info(f"Jugador {player_name} removido de transferibles en guild {guild_id}.")
+                _entities_changed(guild_id, ('player_name', player_name))
                 return True
             return False
     except sqlite3.Error as e:
         database_logger.error(f"Error al quitar estado transferible a {player_name} en guild {guild_id}: {e}")
         return False
 
+# Motor de transferencias: cada operación valida, mueve dinero, reasigna al jugador y cambia el estado de la
+# oferta en una sola transacción BEGIN IMMEDIATE sobre una única conexión. El bloqueo de escritura se toma al
+# empezar, así que dos aceptaciones simultáneas no pueden gastar el mismo saldo ni mover dos veces al jugador.
+
+MAX_CLAUSE = 100_000_000
+
+class _TransferAborted(Exception):
+    """Validación fallida dentro de la transacción: se deshace todo y se devuelve `result`."""
+
+    def __init__(self, result, reason: str):
+        super().__init__(reason)
+        self.result = result
+
+@contextmanager
+def _transfer_transaction(guild_id: int):
+    # El pool confirma al salir sin errores y deshace si se lanza cualquier excepción
+    with _connect(guild_id) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        yield conn
+
+def _require_market_open(conn: sqlite3.Connection, result):
+    row = conn.execute(_SQL_GUILD_CONFIG_VALUE, ('market_status',)).fetchone()
+    if not row or row[0] != 'open':
+        raise _TransferAborted(result, "El mercado está cerrado")
+
+_SQL_OFFER_BY_ID = 'SELECT * FROM transfer_offers WHERE id = ?'
+
+def _require_offer(conn: sqlite3.Connection, offer_id: int, status: str) -> sqlite3.Row:
+    offer = conn.execute(_SQL_OFFER_BY_ID, (offer_id,)).fetchone()
+    if not offer:
+        raise _TransferAborted(False, "No se encontró la oferta")
+    if offer['status'] != status:
+        raise _TransferAborted(False, f"La oferta está en estado '{offer['status']}', se esperaba '{status}'")
+    return offer
+
+_SQL_PLAYER_BY_NAME = 'SELECT * FROM players WHERE name = ?'
+
+def _require_player(conn: sqlite3.Connection, player_name: str, result) -> sqlite3.Row:
+    player = conn.execute(_SQL_PLAYER_BY_NAME, (player_name,)).fetchone()
+    if not player:
+        raise _TransferAborted(result, f"No se encontró jugador con nombre '{player_name}'")
+    return player
+
+def _debit(conn: sqlite3.Connection, team_id: int, amount: int) -> bool:
+    # El saldo se comprueba y descuenta en la misma sentencia: nunca queda en negativo
+    cur = conn.execute('UPDATE club_balance SET balance = balance - ? WHERE team_id = ? AND balance >= ?',
+                       (amount, team_id, amount))
+    return cur.rowcount > 0
+
+def _credit(conn: sqlite3.Connection, team_id: int, amount: int):
+    conn.execute('INSERT OR IGNORE INTO club_balance (team_id, balance) VALUES (?, 0)', (team_id,))
+    conn.execute('UPDATE club_balance SET balance = balance + ? WHERE team_id = ?', (amount, team_id))
+
+def _move_money(conn: sqlite3.Connection, from_team_id: int, to_team_id: int, amount: int, result):
+    if not _debit(conn, from_team_id, amount):
+        raise _TransferAborted(result, f"Fondos insuficientes en el equipo {from_team_id} para pagar {amount}")
+    if to_team_id is not None:
+        _credit(conn, to_team_id, amount)
+
+def _complete_offer(conn: sqlite3.Connection, offer: sqlite3.Row):
+    conn.execute('UPDATE players SET team_id = ?, contract_duration = ?, release_clause = ? WHERE name = ?',
+                 (offer['to_team_id'], offer['contract_duration'], offer['release_clause'], offer['player_name']))
+    conn.execute('UPDATE transfer_offers SET status = ? WHERE id = ?', ('accepted', offer['id']))
+
 def create_transfer_offer(guild_id: int, player_name: str, from_team_id: int, to_team_id: int, from_manager_id: int, clause: int, duration: int, price: int) -> int:
-    if get_market_status(guild_id) != 'open':
-        return -2
-    
-    # ✅ Verificar límite de cláusula
-    MAX_CLAUSE = 100_000_000
+    """Devuelve el ID de la oferta, -1 si falla, -2 con el mercado cerrado o -3 si la cláusula supera el máximo."""
     if clause > MAX_CLAUSE:
         database_logger.warning(f"❌ Cláusula excede el máximo permitido: {clause} > {MAX_CLAUSE}")
-        return -3  # nuevo código de error para cláusula inválida
-
-    db_path = get_db_path(guild_id)
+        return -3
     try:
-        with sqlite3.connect(db_path) as conn:
-            cur = conn.cursor()
-            
-            # Verificar si el jugador existe
-            cur.execute('SELECT name FROM players WHERE name = ?', (player_name,))
-            if not cur.fetchone():
-                database_logger.error(f"Intento de crear oferta para jugador inexistente: {player_name} en guild {guild_id}")
-                return -1
-
-            cur.execute('''
+        with _transfer_transaction(guild_id) as conn:
+            _require_market_open(conn, -2)
+            _require_player(conn, player_name, -1)
+            cur = conn.execute('''
                 INSERT INTO transfer_offers (player_name, from_team_id, to_team_id, from_manager_id, price, status, contract_duration, release_clause)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             ''', (player_name, from_team_id, to_team_id, from_manager_id, price, 'pending', duration, clause))
-            
             offer_id = cur.lastrowid
-            conn.commit()
-            database_logger.info(f"Oferta de transferencia {offer_id} creada para {player_name} en guild {guild_id}.")
-            return offer_id
-
+        database_logger.info(f"Oferta de transferencia {offer_id} creada para {player_name} en guild {guild_id}.")
+        return offer_id
+    except _TransferAborted as e:
+        database_logger.warning(f"No se creó la oferta para {player_name} en guild {guild_id}: {e}")
+        return e.result
     except sqlite3.Error as e:
         database_logger.error(f"Error al crear oferta de transferencia para {player_name} en guild {guild_id}: {e}")
         return -1
 
 
 def get_offer(guild_id: int, offer_id: int) -> dict:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('SELECT * FROM transfer_offers WHERE id = ?', (offer_id,))
+            cur.execute(_SQL_OFFER_BY_ID, (offer_id,))
             return _row_to_dict(cur.fetchone())
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener oferta {offer_id} en guild {guild_id}: {e}")
@@ -537,9 +1007,8 @@ def update_offer_status(guild_id: int, offer_id: int, status: str):
     if status not in VALID_STATUSES:
         database_logger.warning(f"Estado inválido {status} para oferta {offer_id} en guild {guild_id}")
         return
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('UPDATE transfer_offers SET status = ? WHERE id = ?', (status, offer_id))
             conn.commit()
@@ -548,170 +1017,135 @@ def update_offer_status(guild_id: int, offer_id: int, status: str):
         database_logger.error(f"Error al actualizar oferta {offer_id} en guild {guild_id}: {e}")
 
 def accept_offer(guild_id: int, offer_id: int) -> bool:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-
-            cur.execute('SELECT * FROM transfer_offers WHERE id = ?', (offer_id,))
-            offer = cur.fetchone()
-            if not offer:
-                database_logger.error("❌ No se encontró la oferta.")
-                return False
-            if offer['status'] != 'pending':
-                database_logger.error(f"❌ Oferta no está pendiente, está en estado '{offer['status']}'")
-                return False
-
-            player = get_player_by_name(guild_id, offer['player_name'])
-            if not player:
-                database_logger.error(f"❌ No se encontró jugador con nombre '{offer['player_name']}'")
-                return False
-
-            from_team_id = offer['from_team_id']
-            to_team_id = offer['to_team_id']
-
-            # Solo verificar y mover dinero si el jugador no es agente libre
-            if from_team_id is not None:
-                # Verifica que el equipo comprador tenga fondos
-                cur.execute('SELECT balance FROM club_balance WHERE team_id = ?', (to_team_id,))
-                balance = cur.fetchone()
-                if not balance or balance['balance'] < offer['price']:
-                    database_logger.error(f"❌ Fondos insuficientes. Tiene {balance['balance'] if balance else 0}, necesita {offer['price']}")
-                    return False
-
-                # Descontar y transferir dinero
-                cur.execute('UPDATE club_balance SET balance = balance - ? WHERE team_id = ?', (offer['price'], to_team_id))
-                cur.execute('UPDATE club_balance SET balance = balance + ? WHERE team_id = ?', (offer['price'], from_team_id))
-
-            # Actualizar jugador con nuevo equipo y contrato
-            cur.execute('UPDATE players SET team_id = ?, contract_duration = ?, release_clause = ? WHERE name = ?',
-                        (to_team_id, offer['contract_duration'], offer['release_clause'], offer['player_name']))
-
-            # Marcar la oferta como aceptada
-            cur.execute('UPDATE transfer_offers SET status = ? WHERE id = ?', ('accepted', offer_id))
-
-            conn.commit()
-            database_logger.info(f"Oferta {offer_id} aceptada en guild {guild_id}.")
-            return True
-
+        with _transfer_transaction(guild_id) as conn:
+            offer = _require_offer(conn, offer_id, 'pending')
+            player = _require_player(conn, offer['player_name'], False)
+            # Una oferta hecha cuando el jugador estaba en otro equipo ya no es válida
+            if player['team_id'] != offer['from_team_id']:
+                raise _TransferAborted(False, "El jugador cambió de equipo desde que se hizo la oferta")
+            # Solo se mueve dinero si el jugador no es agente libre
+            if offer['from_team_id'] is not None:
+                _move_money(conn, offer['to_team_id'], offer['from_team_id'], offer['price'], False)
+            _complete_offer(conn, offer)
+    except _TransferAborted as e:
+        database_logger.error(f"❌ Oferta {offer_id} no aceptada en guild {guild_id}: {e}")
+        return False
     except sqlite3.Error as e:
         database_logger.error(f"Error al aceptar oferta {offer_id} en guild {guild_id}: {e}")
         return False
+    _entities_changed(guild_id, ('player_name', offer['player_name']))
+    database_logger.info(f"Oferta {offer_id} aceptada en guild {guild_id}.")
+    return True
 
 def reject_offer(guild_id: int, offer_id: int):
     update_offer_status(guild_id, offer_id, 'rejected')
 
+_SQL_OFFERS_BY_MANAGER = 'SELECT * FROM transfer_offers WHERE from_manager_id = ? AND status = ?'
+
 def list_offers_by_manager(guild_id: int, manager_id: int, status: str) -> list:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('SELECT * FROM transfer_offers WHERE from_manager_id = ? AND status = ?', (manager_id, status))
+            cur.execute(_SQL_OFFERS_BY_MANAGER, (manager_id, status))
             return [dict(row) for row in cur.fetchall()]
     except sqlite3.Error as e:
         database_logger.error(f"Error al listar ofertas por manager {manager_id} en guild {guild_id}: {e}")
         return []
 
+_SQL_OFFERS_FOR_PLAYER = '''
+    SELECT t.* FROM transfer_offers t
+    JOIN players p ON t.player_name = p.name
+    WHERE p.user_id = ? AND t.status = ?
+'''
+
 def list_offers_for_player(guild_id: int, user_id: int, status: str) -> list:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('''
-                SELECT t.* FROM transfer_offers t
-                JOIN players p ON t.player_name = p.name
-                WHERE p.user_id = ? AND t.status = ?
-            ''', (user_id, status))
+            cur.execute(_SQL_OFFERS_FOR_PLAYER, (user_id, status))
             return [dict(row) for row in cur.fetchall()]
     except sqlite3.Error as e:
         database_logger.error(f"Error al listar ofertas para jugador {user_id} en guild {guild_id}: {e}")
         return []
 
+_SQL_PENDING_OFFER = '''
+    SELECT 1 FROM transfer_offers t
+    JOIN players p ON t.player_name = p.name
+    WHERE t.from_manager_id = ? AND p.user_id = ? AND t.status IN ('pending', 'bought_clause')
+'''
+
 def has_pending_offer(guild_id: int, manager_id: int, user_id: int) -> bool:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('''
-                SELECT 1 FROM transfer_offers t
-                JOIN players p ON t.player_name = p.name
-                WHERE t.from_manager_id = ? AND p.user_id = ? AND t.status IN ('pending', 'bought_clause')
-            ''', (manager_id, user_id))
+            cur.execute(_SQL_PENDING_OFFER, (manager_id, user_id))
             return cur.fetchone() is not None
     except sqlite3.Error as e:
         database_logger.error(f"Error al verificar oferta pendiente para manager {manager_id} y jugador {user_id} en guild {guild_id}: {e}")
         return False
 
-def pay_clause_and_transfer(guild_id: int, player_name: str, to_team_id: int, price: int, manager_id: int, duration: int, new_clause: int) -> int:
+_SQL_PENDING_CLAUSE = "SELECT 1 FROM transfer_offers WHERE player_name = ? AND status = 'bought_clause'"
 
-    if get_market_status(guild_id) != 'open':
-        return -2
-    db_path = get_db_path(guild_id)
-    try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute('SELECT * FROM players WHERE name = ?', (player_name,))
-            player = cur.fetchone()
-            if not player:
-                return -1
-            from_team_id = player['team_id']
-            cur.execute('SELECT balance FROM club_balance WHERE team_id = ?', (to_team_id,))
-            balance = cur.fetchone()
-            if not balance or balance['balance'] < price:
-                return -1
-            cur.execute('UPDATE club_balance SET balance = balance - ? WHERE team_id = ?', (price, to_team_id))
-            if from_team_id:
-                cur.execute('UPDATE club_balance SET balance = balance + ? WHERE team_id = ?', (price, from_team_id))
-            cur.execute('''
+def pay_clause_and_transfer(guild_id: int, player_name: str, to_team_id: int, price: int, manager_id: int, duration: int, new_clause: int) -> int:
+    """Cobra la cláusula y crea la oferta 'bought_clause' que el jugador debe aceptar.
+
+    Devuelve el ID de la oferta, -1 si no hay fondos o falla, -2 con el mercado cerrado y -4 si la cláusula
+    cambió desde que se leyó, el jugador ya es del equipo o ya hay una cláusula pagada pendiente para él.
+    """
+    try:
+        with _transfer_transaction(guild_id) as conn:
+            _require_market_open(conn, -2)
+            player = _require_player(conn, player_name, -1)
+            if player['release_clause'] != price:
+                raise _TransferAborted(-4, f"La cláusula es {player['release_clause']}, no {price}")
+            if player['team_id'] == to_team_id:
+                raise _TransferAborted(-4, "El jugador ya está en el equipo comprador")
+            pending = conn.execute(_SQL_PENDING_CLAUSE, (player_name,)).fetchone()
+            if pending:
+                raise _TransferAborted(-4, "Ya hay una cláusula pagada pendiente de aceptar")
+            _move_money(conn, to_team_id, player['team_id'], price, -1)
+            cur = conn.execute('''
                 INSERT INTO transfer_offers 
                 (player_name, from_team_id, to_team_id, from_manager_id, price, status, release_clause, contract_duration) 
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (player_name, from_team_id, to_team_id, manager_id, price, 'bought_clause', new_clause, duration))
+            ''', (player_name, player['team_id'], to_team_id, manager_id, price, 'bought_clause', new_clause, duration))
             offer_id = cur.lastrowid
-            conn.commit()
-            database_logger.info(f"Oferta por cláusula {offer_id} creada para {player_name} en guild {guild_id}.")
-            return offer_id
+        database_logger.info(f"Oferta por cláusula {offer_id} creada para {player_name} en guild {guild_id}.")
+        return offer_id
+    except _TransferAborted as e:
+        database_logger.warning(f"No se pagó la cláusula de {player_name} en guild {guild_id}: {e}")
+        return e.result
     except sqlite3.Error as e:
         database_logger.error(f"Error al pagar cláusula para {player_name} en guild {guild_id}: {e}")
         return -1
 
 def accept_clause_payment(guild_id: int, offer_id: int) -> bool:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-
-            cur.execute('SELECT * FROM transfer_offers WHERE id = ?', (offer_id,))
-            offer = cur.fetchone()
-            if not offer or offer['status'] != 'bought_clause':
-                return False
-
-            # Solo actualizar jugador y marcar oferta como aceptada
-            cur.execute('''
-                UPDATE players
-                SET team_id = ?, contract_duration = ?, release_clause = ?
-                WHERE name = ?
-            ''', (offer['to_team_id'], offer['contract_duration'], offer['release_clause'], offer['player_name']))
-
-            cur.execute('UPDATE transfer_offers SET status = ? WHERE id = ?', ('accepted', offer_id))
-            conn.commit()
-            return True
+        with _transfer_transaction(guild_id) as conn:
+            # El dinero se movió al pagar la cláusula: solo se reasigna al jugador
+            offer = _require_offer(conn, offer_id, 'bought_clause')
+            player = _require_player(conn, offer['player_name'], False)
+            if player['team_id'] != offer['from_team_id']:
+                raise _TransferAborted(False, "El jugador cambió de equipo desde que se pagó la cláusula")
+            _complete_offer(conn, offer)
+    except _TransferAborted as e:
+        database_logger.error(f"❌ Cláusula de la oferta {offer_id} no aceptada en guild {guild_id}: {e}")
+        return False
     except sqlite3.Error as e:
         database_logger.error(f"Error al aceptar cláusula para oferta {offer_id} en guild {guild_id}: {e}")
         return False
+    _entities_changed(guild_id, ('player_name', offer['player_name']))
+    database_logger.info(f"Cláusula de la oferta {offer_id} aceptada en guild {guild_id}.")
+    return True
+
+_SQL_CLUB_BALANCE = 'SELECT balance FROM club_balance WHERE team_id = ?'
 
 def get_club_balance(guild_id: int, team_id: int) -> int:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('SELECT balance FROM club_balance WHERE team_id = ?', (team_id,))
+            cur.execute(_SQL_CLUB_BALANCE, (team_id,))
             balance = cur.fetchone()
             return balance[0] if balance else 0
     except sqlite3.Error as e:
@@ -719,9 +1153,8 @@ def get_club_balance(guild_id: int, team_id: int) -> int:
         return 0
 
 def add_money_to_club(guild_id: int, team_id: int, amount: int):
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('INSERT OR REPLACE INTO club_balance (team_id, balance) VALUES (?, COALESCE((SELECT balance FROM club_balance WHERE team_id = ?), 0) + ?)', 
                        (team_id, team_id, amount))
@@ -731,9 +1164,8 @@ def add_money_to_club(guild_id: int, team_id: int, amount: int):
         database_logger.error(f"Error al agregar dinero al equipo {team_id} en guild {guild_id}: {e}")
 
 def remove_money_from_club(guild_id: int, team_id: int, amount: int):
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('INSERT OR REPLACE INTO club_balance (team_id, balance) VALUES (?, COALESCE((SELECT balance FROM club_balance WHERE team_id = ?), 0) - ?)', 
                        (team_id, team_id, amount))
@@ -742,26 +1174,26 @@ def remove_money_from_club(guild_id: int, team_id: int, amount: int):
     except sqlite3.Error as e:
         database_logger.error(f"Error al quitar dinero del equipo {team_id} en guild {guild_id}: {e}")
 
+_SQL_FREE_AGENTS = 'SELECT * FROM players WHERE team_id IS NULL'
+
 def get_free_agents(guild_id: int) -> list:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('SELECT * FROM players WHERE team_id IS NULL')
+            cur.execute(_SQL_FREE_AGENTS)
             return [dict(row) for row in cur.fetchall()]
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener agentes libres en guild {guild_id}: {e}")
         return []
 
 def add_captain(guild_id: int, team_id: int, captain_id: int) -> bool:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('INSERT INTO team_captains (team_id, captain_id) VALUES (?, ?)', (team_id, captain_id))
             conn.commit()
             database_logger.info(f"Capitán {captain_id} agregado al equipo {team_id} en guild {guild_id}.")
+            _entities_changed(guild_id, ('captains', team_id), ('captain', captain_id))
             return True
     except sqlite3.IntegrityError:
         database_logger.warning(f"Intento de agregar capitán duplicado {captain_id} al equipo {team_id} en guild {guild_id}")
@@ -771,72 +1203,75 @@ def add_captain(guild_id: int, team_id: int, captain_id: int) -> bool:
         return False
 
 def remove_captain(guild_id: int, team_id: int, captain_id: int) -> bool:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('DELETE FROM team_captains WHERE team_id = ? AND captain_id = ?', (team_id, captain_id))
             if cur.rowcount > 0:
                 conn.commit()
                 database_logger.info(f"Capitán {captain_id} removido del equipo {team_id} en guild {guild_id}.")
+                _entities_changed(guild_id, ('captains', team_id), ('captain', captain_id))
                 return True
             return False
     except sqlite3.Error as e:
         database_logger.error(f"Error al remover capitán {captain_id} del equipo {team_id} en guild {guild_id}: {e}")
         return False
 
+_SQL_CAPTAINS = 'SELECT captain_id FROM team_captains WHERE team_id = ?'
+
+def _fetch_captains(guild_id: int, team_id: int) -> list:
+    with _connect(guild_id) as conn:
+        return [row[0] for row in conn.execute(_SQL_CAPTAINS, (team_id,))]
+
 def get_captains(guild_id: int, team_id: int) -> list:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            cur = conn.cursor()
-            cur.execute('SELECT captain_id FROM team_captains WHERE team_id = ?', (team_id,))
-            return [row[0] for row in cur.fetchall()]
+        return _entities.get(guild_id, ('captains', team_id), lambda: _fetch_captains(guild_id, team_id),
+                             lambda captains: [('captains', team_id)])
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener capitanes del equipo {team_id} en guild {guild_id}: {e}")
         return []
 
+_SQL_IS_CAPTAIN = 'SELECT 1 FROM team_captains WHERE team_id = ? AND captain_id = ?'
+
 def is_captain(guild_id: int, team_id: int, user_id: int) -> bool:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('SELECT 1 FROM team_captains WHERE team_id = ? AND captain_id = ?', (team_id, user_id))
+            cur.execute(_SQL_IS_CAPTAIN, (team_id, user_id))
             return cur.fetchone() is not None
     except sqlite3.Error as e:
         database_logger.error(f"Error al verificar si {user_id} es capitán del equipo {team_id} en guild {guild_id}: {e}")
         return False
 
+_SQL_TEAM_BY_CAPTAIN = '''
+    SELECT t.* FROM teams t
+    JOIN team_captains tc ON t.id = tc.team_id
+    WHERE tc.captain_id = ?
+'''
+
 def get_team_by_captain(guild_id: int, captain_id: int) -> dict:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute('''
-                SELECT t.* FROM teams t
-                JOIN team_captains tc ON t.id = tc.team_id
-                WHERE tc.captain_id = ?
-            ''', (captain_id,))
-            return _row_to_dict(cur.fetchone())
+        return _entities.get(
+            guild_id, ('team_by_captain', captain_id),
+            lambda: _fetch_one(guild_id, _SQL_TEAM_BY_CAPTAIN, (captain_id,)),
+            lambda team: [('captain', captain_id)] + _team_tags(team))
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener equipo por capitán {captain_id} en guild {guild_id}: {e}")
         return None
 
+_SQL_SOLICITUD_BY_ID = 'SELECT * FROM solicitudes_amistosos WHERE id = ?'
+
 def get_solicitud_by_id(guild_id: int, solicitud_id: int) -> dict:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('SELECT * FROM solicitudes_amistosos WHERE id = ?', (solicitud_id,))
+            cur.execute(_SQL_SOLICITUD_BY_ID, (solicitud_id,))
             return _row_to_dict(cur.fetchone())
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener solicitud {solicitud_id} en guild {guild_id}: {e}")
         return None
 
 def update_solicitud_status(guild_id: int, solicitud_id: int, status: str, user_id: int):
-    db_path = get_db_path(guild_id)
     solicitud = get_solicitud_by_id(guild_id, solicitud_id)
     if not solicitud:
         return
@@ -845,7 +1280,7 @@ def update_solicitud_status(guild_id: int, solicitud_id: int, status: str, user_
         database_logger.warning(f"Usuario {user_id} no autorizado para actualizar solicitud {solicitud_id} en guild {guild_id}")
         return
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('UPDATE solicitudes_amistosos SET status = ? WHERE id = ?', (status, solicitud_id))
             conn.commit()
@@ -853,98 +1288,170 @@ def update_solicitud_status(guild_id: int, solicitud_id: int, status: str, user_
     except sqlite3.Error as e:
         database_logger.error(f"Error al actualizar solicitud {solicitud_id} en guild {guild_id}: {e}")
 
+_SQL_ALL_PLAYERS = 'SELECT name, user_id FROM players WHERE user_id IS NOT NULL'
+
+def get_all_players(guild_id: int) -> list:
+    try:
+        with _connect(guild_id) as conn:
+            cur = conn.execute(_SQL_ALL_PLAYERS)
+            return [dict(row) for row in cur.fetchall()]
+    except sqlite3.Error as e:
+        database_logger.error(f"Error al obtener jugadores en guild {guild_id}: {e}")
+        return []
+
+_SQL_PLAYERS_BY_TEAM = 'SELECT * FROM players WHERE team_id = ?'
+
 def get_players_by_team(guild_id: int, team_id: int) -> list:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('SELECT * FROM players WHERE team_id = ?', (team_id,))
+            cur.execute(_SQL_PLAYERS_BY_TEAM, (team_id,))
             return [dict(row) for row in cur.fetchall()]
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener jugadores del equipo {team_id} en guild {guild_id}: {e}")
         return []
 
-def advance_season(guild_id: int):
-    db_path = get_db_path(guild_id)
-    try:
-        with sqlite3.connect(db_path) as conn:
-            cur = conn.cursor()
-            cur.execute('UPDATE players SET contract_duration = contract_duration - 1 WHERE contract_duration > 0')
-            cur.execute('UPDATE players SET team_id = NULL, contract_duration = NULL, release_clause = NULL, transferable = 0 WHERE contract_duration <= 0')
-            conn.commit()
-            database_logger.info(f"Temporada avanzada en guild {guild_id}. Contratos actualizados.")
+def advance_season(guild_id: int) -> dict:
+    """Cierra la temporada en una sola transacción y devuelve el resumen.
+
+    Resta un año a los contratos; los que llegan a 0 quedan libres (sin equipo, cláusula ni transferible),
+    pierden la capitanía de su antiguo equipo y sus ofertas pendientes se cancelan. Las cláusulas ya pagadas
+    y no aceptadas se cancelan devolviendo el dinero al comprador si el vendedor tiene saldo para ello; las
+    que no se pueden cobrar se cancelan igual y se listan en 'refunds_failed' para que un admin las resuelva.
+    """
+    start = time.perf_counter()
+    summary = {'decremented': 0, 'released': [], 'offers_cancelled': 0, 'clauses_refunded': 0,
+               'refunded_amount': 0, 'refunds_failed': [], 'captains_removed': 0}
+    try:
+        with _transfer_transaction(guild_id) as conn:
+            # Los que terminan contrato se guardan en una tabla temporal: el resto de pasos son UPDATE/DELETE en bloque
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS season_released (name TEXT PRIMARY KEY, user_id INTEGER, team_id INTEGER)')
+            conn.execute('DELETE FROM temp.season_released')
+            conn.execute('''
+                INSERT INTO temp.season_released (name, user_id, team_id)
+                SELECT name, user_id, team_id FROM players
+                WHERE contract_duration IS NOT NULL AND contract_duration <= 1
+            ''')
+            summary['released'] = [dict(row) for row in conn.execute('''
+                SELECT r.user_id, r.name, r.team_id, t.name AS team_name
+                FROM temp.season_released r
+                LEFT JOIN teams t ON r.team_id = t.id
+                ORDER BY t.name, r.name
+            ''')]
+            summary['decremented'] = conn.execute(
+                'UPDATE players SET contract_duration = contract_duration - 1 WHERE contract_duration > 1').rowcount
+            conn.execute('''
+                UPDATE players SET team_id = NULL, contract_duration = NULL, release_clause = NULL, transferable = 0
+                WHERE name IN (SELECT name FROM temp.season_released)
+            ''')
+            summary['captains_removed'] = conn.execute('''
+                DELETE FROM team_captains
+                WHERE EXISTS (SELECT 1 FROM temp.season_released r
+                              WHERE r.user_id = team_captains.captain_id AND r.team_id = team_captains.team_id)
+            ''').rowcount
+            refunds = conn.execute('''
+                SELECT o.id, o.player_name, o.from_team_id, o.to_team_id, o.price,
+                       t1.name AS from_team_name, t2.name AS to_team_name
+                FROM transfer_offers o
+                LEFT JOIN teams t1 ON o.from_team_id = t1.id
+                LEFT JOIN teams t2 ON o.to_team_id = t2.id
+                WHERE o.status = 'bought_clause' AND o.player_name IN (SELECT name FROM temp.season_released)
+                ORDER BY o.id
+            ''').fetchall()
+            for offer in refunds:
+                # Sin equipo vendedor el dinero no fue a ningún club y se devuelve entero
+                if offer['from_team_id'] is not None and not _debit(conn, offer['from_team_id'], offer['price']):
+                    summary['refunds_failed'].append(dict(offer))
+                    continue
+                _credit(conn, offer['to_team_id'], offer['price'])
+                summary['clauses_refunded'] += 1
+                summary['refunded_amount'] += offer['price']
+            summary['offers_cancelled'] = conn.execute('''
+                UPDATE transfer_offers SET status = 'cancelled'
+                WHERE status IN ('pending', 'bought_clause') AND player_name IN (SELECT name FROM temp.season_released)
+            ''').rowcount
+            conn.execute('DELETE FROM temp.season_released')
+        summary['seconds'] = time.perf_counter() - start
+        database_logger.info(
+            f"Temporada avanzada en guild {guild_id}: {summary['decremented']} contratos reducidos, "
+            f"{len(summary['released'])} jugadores liberados, {summary['offers_cancelled']} ofertas canceladas, "
+            f"{summary['captains_removed']} capitanías retiradas, {len(summary['refunds_failed'])} cláusulas sin devolver "
+            f"en {summary['seconds'] * 1000:.1f} ms.")
     except sqlite3.Error as e:
         database_logger.error(f"Error al avanzar temporada en guild {guild_id}: {e}")
+        summary = None
+    finally:
+        # Cambian los contratos de todos los jugadores
+        _entities_changed(guild_id)
+    return summary
+
+_SQL_TRANSFER_HISTORY_BY_PLAYER = '''
+    SELECT t.id, t.player_name, t.price, t.status, t1.name AS from_team_name, t2.name AS to_team_name
+    FROM transfer_offers t
+    LEFT JOIN teams t1 ON t.from_team_id = t1.id
+    LEFT JOIN teams t2 ON t.to_team_id = t2.id
+    WHERE t.player_name = ? AND t.status IN ('accepted', 'finalized')
+'''
 
 def get_transfer_history_by_player(guild_id: int, player_name: str) -> list:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('''
-                SELECT t.id, t.player_name, t.price, t.status, t1.name AS from_team_name, t2.name AS to_team_name
-                FROM transfer_offers t
-                LEFT JOIN teams t1 ON t.from_team_id = t1.id
-                LEFT JOIN teams t2 ON t.to_team_id = t2.id
-                WHERE t.player_name = ? AND t.status IN ('accepted', 'finalized')
-            ''', (player_name,))
+            cur.execute(_SQL_TRANSFER_HISTORY_BY_PLAYER, (player_name,))
             return [f"ID {row['id']}: {row['player_name']} de {row['from_team_name'] or 'Libre'} a {row['to_team_name'] or 'Libre'} por {row['price']:,} [{row['status']}]" 
                    for row in cur.fetchall()]
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener historial de transferencias para {player_name} en guild {guild_id}: {e}")
         return []
 
+_SQL_TRANSFER_HISTORY_BY_TEAM = '''
+    SELECT t.id, t.player_name, t.price, t.status, t1.name AS from_team_name, t2.name AS to_team_name
+    FROM transfer_offers t
+    LEFT JOIN teams t1 ON t.from_team_id = t1.id
+    LEFT JOIN teams t2 ON t.to_team_id = t2.id
+    WHERE (t.from_team_id = ? OR t.to_team_id = ?) AND t.status IN ('accepted', 'finalized')
+'''
+
 def get_transfer_history_by_team(guild_id: int, team_id: int) -> list:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('''
-                SELECT t.id, t.player_name, t.price, t.status, t1.name AS from_team_name, t2.name AS to_team_name
-                FROM transfer_offers t
-                LEFT JOIN teams t1 ON t.from_team_id = t1.id
-                LEFT JOIN teams t2 ON t.to_team_id = t2.id
-                WHERE (t.from_team_id = ? OR t.to_team_id = ?) AND t.status IN ('accepted', 'finalized')
-            ''', (team_id, team_id))
+            cur.execute(_SQL_TRANSFER_HISTORY_BY_TEAM, (team_id, team_id))
             return [f"ID {row['id']}: {row['player_name']} de {row['from_team_name'] or 'Libre'} a {row['to_team_name'] or 'Libre'} por {row['price']:,} [{row['status']}]" 
                    for row in cur.fetchall()]
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener historial de transferencias para equipo {team_id} en guild {guild_id}: {e}")
         return []
 
+_SQL_RECENT_TRANSFERS = '''
+    SELECT t.id, t.player_name, t.price, t.status, t1.name AS from_team_name, t2.name AS to_team_name
+    FROM transfer_offers t
+    LEFT JOIN teams t1 ON t.from_team_id = t1.id
+    LEFT JOIN teams t2 ON t.to_team_id = t2.id
+    WHERE t.status IN ('accepted', 'finalized')
+    ORDER BY t.id DESC
+    LIMIT ?
+'''
+
 def get_recent_transfers(guild_id: int, limit: int) -> list:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('''
-                SELECT t.id, t.player_name, t.price, t.status, t1.name AS from_team_name, t2.name AS to_team_name
-                FROM transfer_offers t
-                LEFT JOIN teams t1 ON t.from_team_id = t1.id
-                LEFT JOIN teams t2 ON t.to_team_id = t2.id
-                WHERE t.status IN ('accepted', 'finalized')
-                ORDER BY t.id DESC
-                LIMIT ?
-            ''', (limit,))
+            cur.execute(_SQL_RECENT_TRANSFERS, (limit,))
             return [dict(row) for row in cur.fetchall()]
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener transferencias recientes en guild {guild_id}: {e}")
         return []
 
-def add_screenshot(guild_id: int, user_id: int, nicktag: str, discord_name: str, channel_id: int, image_url: str, screenshot_time: str) -> int:
-    db_path = get_db_path(guild_id)
+def add_screenshot(guild_id: int, user_id: int, nicktag: str, discord_name: str, channel_id: int, image_url: str, screenshot_time: str, duplicate_of: int = None, attachment_id: int = None) -> int:
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('''
-                INSERT INTO screenshots (user_id, nicktag, discord_name, channel_id, timestamp, screenshot_time, status, image_url)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (user_id, nicktag, discord_name, channel_id, timestamp, screenshot_time, 'pending', image_url))
+                INSERT INTO screenshots (user_id, nicktag, discord_name, channel_id, timestamp, screenshot_time, status, image_url, duplicate_of, attachment_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, nicktag, discord_name, channel_id, timestamp, screenshot_time, 'pending', image_url, duplicate_of, attachment_id))
             screenshot_id = cur.lastrowid
             conn.commit()
             database_logger.info(f"Captura {screenshot_id} agregada para usuario {user_id} en guild {guild_id}.")
@@ -953,10 +1460,57 @@ def add_screenshot(guild_id: int, user_id: int, nicktag: str, discord_name: str,
         database_logger.error(f"Error al agregar captura para usuario {user_id} en guild {guild_id}: {e}")
         return -1
 
+_SQL_NEAREST_SCREENSHOT_HASH = '''
+    SELECT hash, screenshot_id, nicktags, screenshot_time, hamming(hash, ?) AS distance
+    FROM screenshot_hashes
+    WHERE hamming(hash, ?) <= ?
+    ORDER BY distance
+    LIMIT 1
+'''
+
+def find_duplicate_screenshot(guild_id: int, image_hash: bytes, max_distance: int = SCREENSHOT_HASH_MAX_DISTANCE) -> dict:
+    try:
+        with _connect(guild_id) as conn:
+            # La tabla está acotada a SCREENSHOT_HASH_MAX_ENTRIES filas, así que el recorrido completo es barato
+            row = conn.execute(_SQL_NEAREST_SCREENSHOT_HASH, (image_hash, image_hash, max_distance)).fetchone()
+            if not row:
+                return None
+            conn.execute(
+                "UPDATE screenshot_hashes SET last_seen = ?, hits = hits + 1 WHERE hash = ?",
+                (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), row['hash'])
+            )
+            conn.commit()
+            return {
+                'screenshot_id': row['screenshot_id'],
+                'nicktags': json.loads(row['nicktags']),
+                'screenshot_time': row['screenshot_time'],
+                'distance': row['distance'],
+            }
+    except (sqlite3.Error, ValueError) as e:
+        database_logger.error(f"Error al buscar capturas duplicadas en guild {guild_id}: {e}")
+        return None
+
+def add_screenshot_hash(guild_id: int, image_hash: bytes, screenshot_id: int, nicktags: list, screenshot_time: str,
+                        max_entries: int = SCREENSHOT_HASH_MAX_ENTRIES):
+    try:
+        with _connect(guild_id) as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO screenshot_hashes (hash, screenshot_id, nicktags, screenshot_time, last_seen, hits)
+                VALUES (?, ?, ?, ?, ?, 0)
+            ''', (image_hash, screenshot_id, json.dumps(nicktags), screenshot_time, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            # Se descartan los hashes usados hace más tiempo para mantener la tabla acotada
+            conn.execute('''
+                DELETE FROM screenshot_hashes WHERE hash IN (
+                    SELECT hash FROM screenshot_hashes ORDER BY last_seen DESC LIMIT -1 OFFSET ?
+                )
+            ''', (max_entries,))
+            conn.commit()
+    except sqlite3.Error as e:
+        database_logger.error(f"Error al guardar hash de la captura {screenshot_id} en guild {guild_id}: {e}")
+
 def update_screenshot_status(guild_id: int, screenshot_id: int, status: str):
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
 
             cur = conn.cursor()
             cur.execute('UPDATE screenshots SET status = ? WHERE id = ?', (status, screenshot_id))
@@ -965,170 +1519,79 @@ def update_screenshot_status(guild_id: int, screenshot_id: int, status: str):
     except sqlite3.Error as e:
         database_logger.error(f"Error al actualizar captura {screenshot_id} en guild {guild_id}: {e}")
 
+_SQL_SCREENSHOTS_BY_USER = 'SELECT * FROM screenshots WHERE user_id = ?'
+
 def get_screenshots_by_user(guild_id: int, user_id: int) -> list:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('SELECT * FROM screenshots WHERE user_id = ?', (user_id,))
+            cur.execute(_SQL_SCREENSHOTS_BY_USER, (user_id,))
             return [dict(row) for row in cur.fetchall()]
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener capturas para usuario {user_id} en guild {guild_id}: {e}")
         return []
 
-def export_database_to_file(guild_id: int = None):
-    if guild_id is None:
-        db_path = GLOBAL_DB_PATH
-        prefix = "global"
-    else:
-        db_path = get_db_path(guild_id)
-        prefix = f"guild_{guild_id}"
+_SQL_SCREENSHOTS_BY_IDS = 'SELECT * FROM screenshots WHERE id IN ({})'
+
+def get_screenshots_by_ids(guild_id: int, screenshot_ids: list) -> dict:
     try:
-        backup_dir = "backups"
-        if not os.path.exists(backup_dir):
-            os.makedirs(backup_dir)
-            database_logger.info(f"Carpeta {backup_dir} creada.")
-        
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_file = os.path.join(backup_dir, f"db_backup_{prefix}_{timestamp}.txt")
-        
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            
-            with open(backup_file, "w", encoding="utf-8") as f:
-                f.write("=== Copia de la Base de Datos ===\n")
-                f.write(f"Fecha y hora: {timestamp}\n")
-                f.write(f"Guild ID: {guild_id if guild_id else 'Global'}\n\n")
-                
-                if guild_id:
-                    f.write("=== Tabla 'teams' ===\n")
-                    cur.execute('SELECT * FROM teams')
-                    teams = cur.fetchall()
-                    if teams:
-                        for team in teams:
-                            f.write(f"ID: {team['id']}, Name: {team['name']}, Manager ID: {team['manager_id'] or 'None'}, Division: {team['division']}\n")
-                    else:
-                        f.write("No hay equipos registrados.\n")
-                    f.write("\n")
-                    
-                    f.write("=== Tabla 'players' ===\n")
-                    cur.execute('SELECT * FROM players')
-                    players = cur.fetchall()
-                    if players:
-                        for player in players:
-                            f.write(f"Name: {player['name']}, User ID: {player['user_id']}, Team ID: {player['team_id'] or 'None'}, "
-                                   f"Transferable: {player['transferable']}, Banned: {player['banned']}, "
-                                   f"Contract Duration: {player['contract_duration'] or 'None'}, "
-                                   f"Release Clause: {player['release_clause'] or 'None'}, "
-                                   f"Original Release Clause: {player['original_release_clause'] or 'None'}\n")
-                    else:
-                        f.write("No hay jugadores registrados.\n")
-                    f.write("\n")
-                    
-                    f.write("=== Tabla 'transfer_offers' ===\n")
-                    cur.execute('SELECT * FROM transfer_offers')
-                    offers = cur.fetchall()
-                    if offers:
-                        for offer in offers:
-                            f.write(f"ID: {offer['id']}, Player: {offer['player_name']}, From Team ID: {offer['from_team_id'] or 'None'}, "
-                                   f"To Team ID: {offer['to_team_id'] or 'None'}, From Manager ID: {offer['from_manager_id'] or 'None'}, "
-                                   f"To Manager ID: {offer['to_manager_id'] or 'None'}, Price: {offer['price']}, "
-                                   f"Status: {offer['status']}, Contract Duration: {offer['contract_duration'] or 'None'}, "
-                                   f"Release Clause: {offer['release_clause'] or 'None'}\n")
-                    else:
-                        f.write("No hay ofertas de transferencia registradas.\n")
-                    f.write("\n")
-                    
-                    f.write("=== Tabla 'club_balance' ===\n")
-                    cur.execute('SELECT * FROM club_balance')
-                    balances = cur.fetchall()
-                    if balances:
-                        for balance in balances:
-                            f.write(f"Team ID: {balance['team_id']}, Balance: {balance['balance']}\n")
-                    else:
-                        f.write("No hay balances registrados.\n")
-                    f.write("\n")
-                    
-                    f.write("=== Tabla 'team_captains' ===\n")
-                    cur.execute('SELECT * FROM team_captains')
-                    captains = cur.fetchall()
-                    if captains:
-                        for captain in captains:
-                            f.write(f"Team ID: {captain['team_id']}, Captain ID: {captain['captain_id']}\n")
-                    else:
-                        f.write("No hay capitanes registrados.\n")
-                    f.write("\n")
-                    
-                    f.write("=== Tabla 'guild_config' ===\n")
-                    cur.execute('SELECT * FROM guild_config')
-                    configs = cur.fetchall()
-                    if configs:
-                        for config in configs:
-                            f.write(f"Key: {config['key']}, Value: {config['value']}\n")
-                    else:
-                        f.write("No hay configuraciones registradas.\n")
-                    f.write("\n")
-                    
-                    f.write("=== Tabla 'server_config' ===\n")
-                    cur.execute('SELECT * FROM server_config')
-                    server_configs = cur.fetchall()
-                    if server_configs:
-                        for config in server_configs:
-                            f.write(f"Guild ID: {config['guild_id']}, SS Channel ID: {config['ss_channel_id'] or 'None'}, "
-                                   f"Amistosos Channel ID: {config['amistosos_channel_id'] or 'None'}, Arbiter Role ID: {config['arbiter_role_id'] or 'None'}\n")
-                    else:
-                        f.write("No hay configuraciones de servidor registradas.\n")
-                    f.write("\n")
-                    
-                    f.write("=== Tabla 'screenshots' ===\n")
-                    cur.execute('SELECT * FROM screenshots')
-                    screenshots = cur.fetchall()
-                    if screenshots:
-                        for ss in screenshots:
-                            f.write(f"ID: {ss['id']}, User ID: {ss['user_id']}, Nicktag: {ss['nicktag']}, Discord Name: {ss['discord_name']}, "
-                                   f"Channel ID: {ss['channel_id']}, Timestamp: {ss['timestamp']}, Screenshot Time: {ss['screenshot_time'] or 'None'}, "
-                                   f"Status: {ss['status']}, Image URL: {ss['image_url']}\n")
-                    else:
-                        f.write("No hay capturas registradas.\n")
-                    f.write("\n")
-                    
-                    f.write("=== Tabla 'amistosos' ===\n")
-                    cur.execute('SELECT * FROM amistosos')
-                    amistosos = cur.fetchall()
-                    if amistosos:
-                        for amistoso in amistosos:
-                            f.write(f"ID: {amistoso['id']}, Team1 ID: {amistoso['team1_id']}, Team2 ID: {amistoso['team2_id']}, "
-                                   f"Hora: {amistoso['hora']}, Fecha: {amistoso['fecha']}, Status: {amistoso['status']}\n")
-                    else:
-                        f.write("No hay amistosos registrados.\n")
-                    f.write("\n")
-                    
-                    f.write("=== Tabla 'solicitudes_amistosos' ===\n")
-                    cur.execute('SELECT * FROM solicitudes_amistosos')
-                    solicitudes = cur.fetchall()
-                    if solicitudes:
-                        for solicitud in solicitudes:
-                            f.write(f"ID: {solicitud['id']}, Solicitante Team ID: {solicitud['solicitante_team_id']}, "
-                                   f"Solicitado Team ID: {solicitud['solicitado_team_id']}, Hora: {solicitud['hora']}, "
-                                   f"Fecha: {solicitud['fecha']}, Status: {solicitud['status']}\n")
-                    else:
-                        f.write("No hay solicitudes de amistosos registradas.\n")
-                
+        with _connect(guild_id) as conn:
+            result = {}
+            # SQLite limita el número de parámetros por consulta
+            for start in range(0, len(screenshot_ids), 500):
+                chunk = screenshot_ids[start:start + 500]
+                cur = conn.execute(_SQL_SCREENSHOTS_BY_IDS.format(','.join('?' * len(chunk))), chunk)
+                result.update((row['id'], dict(row)) for row in cur.fetchall())
+            return result
+    except sqlite3.Error as e:
+        database_logger.error(f"Error al obtener capturas por ID en guild {guild_id}: {e}")
+        return {}
+
+def upsert_screenshots(guild_id: int, rows: list) -> dict:
+    """Guarda en una sola transacción los resultados de un reprocesado de capturas.
+
+    Cada fila lleva 'id' (actualiza esa captura) o 'attachment_id' (actualiza la captura de ese adjunto
+    o la inserta con user_id, discord_name, channel_id, image_url y timestamp). Las decisiones de los
+    árbitros se respetan: solo cambia el estado de las capturas pendientes que no estén retenidas como
+    posibles duplicados (duplicate_of).
+    """
+    summary = {'inserted': 0, 'updated': 0}
+    try:
+        with _connect(guild_id) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            touched = []
+            for row in rows:
+                status = 'accepted' if row['nicktag'] != "No detectado" and row['screenshot_time'] else 'pending'
+                if row.get('id') is not None:
+                    where, key = 'id = ?', row['id']
                 else:
-                    f.write("=== Tabla 'banned_guilds' ===\n")
-                    cur.execute('SELECT * FROM banned_guilds')
-                    banned_guilds = cur.fetchall()
-                    if banned_guilds:
-                        for guild in banned_guilds:
-                            f.write(f"Guild ID: {guild['guild_id']}\n")
-                    else:
-                        f.write("No hay guilds baneados.\n")
-                
-                database_logger.info(f"Base de datos exportada a {backup_file}.")
-    except sqlite3.Error as e:
-        database_logger.error(f"Error al exportar base de datos para guild {guild_id or 'global'}: {e}")
+                    where, key = 'attachment_id = ?', row['attachment_id']
+                ids = [r['id'] for r in conn.execute(f'SELECT id FROM screenshots WHERE {where}', (key,)).fetchall()]
+                if ids:
+                    conn.executemany('''
+                        UPDATE screenshots
+                        SET nicktag = ?, screenshot_time = ?,
+                            status = CASE WHEN status = 'pending' AND duplicate_of IS NULL THEN ? ELSE status END
+                        WHERE id = ?
+                    ''', [(row['nicktag'], row['screenshot_time'], status, i) for i in ids])
+                    touched.extend(ids)
+                    summary['updated'] += len(ids)
+                elif row.get('id') is None:
+                    conn.execute('''
+                        INSERT INTO screenshots (user_id, nicktag, discord_name, channel_id, timestamp, screenshot_time, status, image_url, attachment_id)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', (row['user_id'], row['nicktag'], row['discord_name'], row['channel_id'], row['timestamp'],
+                          row['screenshot_time'], status, row['image_url'], row['attachment_id']))
+                    summary['inserted'] += 1
+            # El OCR guardado para estas capturas ya no es el actual
+            conn.executemany('DELETE FROM screenshot_hashes WHERE screenshot_id = ?', [(i,) for i in touched])
+            conn.commit()
+        database_logger.info(
+            f"Capturas reprocesadas en guild {guild_id}: {summary['inserted']} nuevas, {summary['updated']} actualizadas.")
+    except sqlite3.Error as e:
+        database_logger.error(f"Error al guardar capturas reprocesadas en guild {guild_id}: {e}")
+    return summary
+
         
 def generate_horarios(inicio: str, fin: str) -> list:
     try:
@@ -1146,12 +1609,10 @@ def generate_horarios(inicio: str, fin: str) -> list:
         return []
 
 def get_player_by_name(guild_id: int, name: str) -> dict:
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('SELECT * FROM players WHERE name = ?', (name,))
+            cur.execute(_SQL_PLAYER_BY_NAME, (name,))
             row = cur.fetchone()
             return dict(row) if row else None
     except sqlite3.Error as e:
@@ -1159,9 +1620,8 @@ def get_player_by_name(guild_id: int, name: str) -> dict:
         return None
 
 def set_registro_channel(guild_id: int, channel_id: int):
-    db_path = get_db_path(guild_id)
     try:
-        with sqlite3.connect(db_path) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute(
                 "UPDATE server_config SET registro_channel_id = ? WHERE guild_id = ?",
@@ -1176,13 +1636,15 @@ def set_registro_channel(guild_id: int, channel_id: int):
             database_logger.info(f"Canal de registros establecido a {channel_id} para guild {guild_id}")
     except sqlite3.Error as e:
         database_logger.error(f"Error al establecer canal de registros para guild {guild_id}: {e}")
+    finally:
+        invalidate_server_config(guild_id)
         
 def create_amistosos_tabla(guild_id: int, inicio: str, fin: str) -> int:
     horarios = generate_horarios(inicio, fin)
     if not horarios:
         return -1
     try:
-        with sqlite3.connect(get_db_path(guild_id)) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('INSERT INTO amistosos_tablas (guild_id, created_at) VALUES (?, ?)', 
                         (guild_id, datetime.now().isoformat()))
@@ -1197,23 +1659,25 @@ def create_amistosos_tabla(guild_id: int, inicio: str, fin: str) -> int:
         database_logger.error(f"Error al crear tabla de amistosos para guild {guild_id}: {e}")
         return -1
 
+_SQL_LATEST_AMISTOSOS_TABLA = 'SELECT * FROM amistosos_tablas WHERE guild_id = ? ORDER BY id DESC LIMIT 1'
+
 def get_latest_amistosos_tabla(guild_id: int) -> dict:
     try:
-        with sqlite3.connect(get_db_path(guild_id)) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('SELECT * FROM amistosos_tablas WHERE guild_id = ? ORDER BY id DESC LIMIT 1', (guild_id,))
+            cur.execute(_SQL_LATEST_AMISTOSOS_TABLA, (guild_id,))
             return _row_to_dict(cur.fetchone())
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener la última tabla para guild {guild_id}: {e}")
         return None
 
+_SQL_HORARIOS_FOR_TABLA = 'SELECT horario, disponible FROM amistosos_horarios WHERE tabla_id = ? ORDER BY horario'
+
 def get_horarios_for_tabla(tabla_id: int, guild_id: int) -> list:
     try:
-        with sqlite3.connect(get_db_path(guild_id)) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('SELECT horario, disponible FROM amistosos_horarios WHERE tabla_id = ? ORDER BY horario', (tabla_id,))
+            cur.execute(_SQL_HORARIOS_FOR_TABLA, (tabla_id,))
             return [{'horario': row['horario'], 'disponible': row['disponible']} for row in cur.fetchall()]
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener horarios para tabla {tabla_id}: {e}")
@@ -1225,7 +1689,7 @@ def add_solicitud_amistoso(guild_id: int, solicitante_team_id: int, solicitado_t
         database_logger.warning(f"Usuario {user_id} no autorizado para solicitar amistoso.")
         return -1
     try:
-        with sqlite3.connect(get_db_path(guild_id)) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute(
                 'INSERT INTO solicitudes_amistosos (tabla_id, horario, solicitante_team_id, solicitado_team_id, status) VALUES (?, ?, ?, ?, ?)',
@@ -1241,7 +1705,7 @@ def add_solicitud_amistoso(guild_id: int, solicitante_team_id: int, solicitado_t
 
 def add_amistoso(guild_id: int, team1_id: int, team2_id: int, horario: str, tabla_id: int) -> bool:
     try:
-        with sqlite3.connect(get_db_path(guild_id)) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('INSERT INTO amistosos (tabla_id, horario, team1_id, team2_id) VALUES (?, ?, ?, ?)', 
                         (tabla_id, horario, team1_id, team2_id))
@@ -1254,20 +1718,41 @@ def add_amistoso(guild_id: int, team1_id: int, team2_id: int, horario: str, tabl
         database_logger.error(f"Error al agregar amistoso en guild {guild_id}: {e}")
         return False
 
+_SQL_AMISTOSOS_FOR_TABLA = 'SELECT * FROM amistosos WHERE tabla_id = ?'
+
 def get_amistosos_for_tabla(guild_id: int, tabla_id: int) -> list:
     try:
-        with sqlite3.connect(get_db_path(guild_id)) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
-            cur.execute('SELECT * FROM amistosos WHERE tabla_id = ?', (tabla_id,))
+            cur.execute(_SQL_AMISTOSOS_FOR_TABLA, (tabla_id,))
             return [dict(row) for row in cur.fetchall()]
     except sqlite3.Error as e:
         database_logger.error(f"Error al obtener amistosos para tabla {tabla_id}: {e}")
         return []
 
+_SQL_AMISTOSOS_WITH_TEAMS = '''
+    SELECT a.*, t1.name AS team1_name, t1.manager_id AS team1_manager_id,
+           t2.name AS team2_name, t2.manager_id AS team2_manager_id
+    FROM amistosos a
+    LEFT JOIN teams t1 ON a.team1_id = t1.id
+    LEFT JOIN teams t2 ON a.team2_id = t2.id
+    WHERE a.tabla_id = ?
+'''
+
+def get_amistosos_with_teams(guild_id: int, tabla_id: int) -> list:
+    # Amistosos de la tabla con nombre y manager de ambos equipos (None si el equipo ya no existe)
+    try:
+        with _connect(guild_id) as conn:
+            cur = conn.cursor()
+            cur.execute(_SQL_AMISTOSOS_WITH_TEAMS, (tabla_id,))
+            return [dict(row) for row in cur.fetchall()]
+    except sqlite3.Error as e:
+        database_logger.error(f"Error al obtener amistosos con equipos para tabla {tabla_id}: {e}")
+        return []
+
 def delete_amistoso(guild_id: int, amistoso_id: int) -> bool:
     try:
-        with sqlite3.connect(get_db_path(guild_id)) as conn:
+        with _connect(guild_id) as conn:
             cur = conn.cursor()
             cur.execute('SELECT tabla_id, horario FROM amistosos WHERE id = ?', (amistoso_id,))
             row = cur.fetchone()
@@ -1287,4 +1772,52 @@ def delete_amistoso(guild_id: int, amistoso_id: int) -> bool:
 def initialize_global():
     create_global_tables()
 
+# Planes de las consultas de cada accesor: usan las mismas constantes _SQL_* que los accesores, con parámetros
+# de ejemplo. allow_scan marca las que recorren la tabla a propósito.
+_QUERY_PLAN_CHECKS = {
+    'get_server_config': (_SQL_SERVER_CONFIG, (0,), False),
+    'get_market_status': (_SQL_GUILD_CONFIG_VALUE, ('market_status',), False),
+    'get_team_by_manager': (_SQL_TEAM_BY_MANAGER, (0,), False),
+    'get_team_by_name': (_SQL_TEAM_BY_NAME, ('',), False),
+    'get_team_by_id': (_SQL_TEAM_BY_ID, (0,), False),
+    'get_team_by_captain': (_SQL_TEAM_BY_CAPTAIN, (0,), False),
+    'get_all_teams': (_SQL_ALL_TEAMS, (), True),
+    'get_all_teams (division)': (_SQL_TEAMS_BY_DIVISION, ('',), True),
+    'get_player_by_id': (_SQL_PLAYER_BY_ID, (0,), False),
+    'get_player_by_name': (_SQL_PLAYER_BY_NAME, ('',), False),
+    'get_players_by_team': (_SQL_PLAYERS_BY_TEAM, (0,), False),
+    'get_all_players': (_SQL_ALL_PLAYERS, (), True),
+    'get_free_agents': (_SQL_FREE_AGENTS, (), False),
+    'get_transferable_players': (_SQL_TRANSFERABLE_PLAYERS, (), True),
+    'get_transferable_players_with_teams': (_SQL_TRANSFERABLE_PLAYERS_WITH_TEAMS, (), True),
+    'get_offer': (_SQL_OFFER_BY_ID, (0,), False),
+    'list_offers_by_manager': (_SQL_OFFERS_BY_MANAGER, (0, 'pending'), False),
+    'list_offers_for_player': (_SQL_OFFERS_FOR_PLAYER, (0, 'pending'), False),
+    'has_pending_offer': (_SQL_PENDING_OFFER, (0, 0), False),
+    'pay_clause_and_transfer': (_SQL_PENDING_CLAUSE, ('',), False),
+    'get_club_balance': (_SQL_CLUB_BALANCE, (0,), False),
+    'get_captains': (_SQL_CAPTAINS, (0,), False),
+    'is_captain': (_SQL_IS_CAPTAIN, (0, 0), False),
+    'get_solicitud_by_id': (_SQL_SOLICITUD_BY_ID, (0,), False),
+    'get_transfer_history_by_player': (_SQL_TRANSFER_HISTORY_BY_PLAYER, ('',), False),
+    'get_transfer_history_by_team': (_SQL_TRANSFER_HISTORY_BY_TEAM, (0, 0), False),
+    'get_recent_transfers': (_SQL_RECENT_TRANSFERS, (10,), False),
+    'find_duplicate_screenshot': (_SQL_NEAREST_SCREENSHOT_HASH, (b'', b'', 0), True),
+    'get_screenshots_by_user': (_SQL_SCREENSHOTS_BY_USER, (0,), False),
+    'get_screenshots_by_ids': (_SQL_SCREENSHOTS_BY_IDS.format('?, ?'), (0, 0), False),
+    'get_latest_amistosos_tabla': (_SQL_LATEST_AMISTOSOS_TABLA, (0,), True),
+    'get_horarios_for_tabla': (_SQL_HORARIOS_FOR_TABLA, (0,), False),
+    'get_amistosos_for_tabla': (_SQL_AMISTOSOS_FOR_TABLA, (0,), False),
+    'get_amistosos_with_teams': (_SQL_AMISTOSOS_WITH_TEAMS, (0,), False),
+}
+
+# Funciones de mantenimiento y utilidades que no son accesores: no se instrumentan
+_UNINSTRUMENTED = {
+    'get_db_path', 'close_connections', 'close_pool', 'list_guild_databases', 'get_wal_size', 'checkpoint_wal',
+    'checkpoint_all_wal', 'get_wal_sizes', 'explain_query_plans', 'find_query_plan_regressions',
+    'peek_server_config', 'invalidate_server_config', 'generate_horarios',
+    'initialize_global', 'entity_cache_stats', 'invalidate_entities', 'peek_identity',
+}
+query_metrics.instrument(globals(), exclude=_UNINSTRUMENTED)
+
 initialize_global()
@@ -0,0 +1,123 @@
+import copy
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import metrics
+
+# Caché de lectura de entidades (equipos, jugadores, capitanes) por guild, con TTL y límite LRU.
+# Cada entrada guarda las etiquetas de las entidades de las que depende, p. ej. ('team', 3) o ('player', 1234),
+# y las escrituras de database.py invalidan solo las entradas con esas etiquetas.
+
+ENTITY_CACHE_TTL = float(os.getenv("ENTITY_CACHE_TTL", "300"))
+ENTITY_CACHE_MAX_ENTRIES = int(os.getenv("ENTITY_CACHE_MAX_ENTRIES", "2000"))
+ENTITY_CACHE_MAX_GUILDS = int(os.getenv("ENTITY_CACHE_MAX_GUILDS", "64"))
+
+ENTITY_CACHE_REQUESTS = metrics.registry.counter(
+    'leaguebot_entity_cache_requests_total', "Consultas a la caché de entidades por tipo y resultado", ('kind', 'result'))
+
+class _GuildEntries:
+    def __init__(self):
+        self.entries = OrderedDict()  # clave -> (expira, valor, etiquetas)
+        self.by_tag = {}
+
+    def remove(self, key):
+        _, _, tags = self.entries.pop(key)
+        for tag in tags:
+            keys = self.by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.by_tag[tag]
+
+class EntityCache:
+    def __init__(self, ttl: float = ENTITY_CACHE_TTL, max_entries: int = ENTITY_CACHE_MAX_ENTRIES,
+                 max_guilds: int = ENTITY_CACHE_MAX_GUILDS):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.max_guilds = max(1, max_guilds)
+        self._guilds = OrderedDict()
+        # La generación de cada guild sube con cada invalidación: una lectura que empezó antes
+        # de una escritura no guarda su resultado (puede estar desactualizado)
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.counters = Counter()
+
+    def get(self, guild_id: int, key: tuple, load, tags):
+        """Devuelve el valor en caché o llama a load(); tags(valor) da las etiquetas de las que depende.
+
+        key[0] es el tipo de consulta (se usa para las estadísticas). Los errores de load() se propagan
+        y no se guardan en caché.
+        """
+        kind = key[0]
+        now = time.monotonic()
+        with self._lock:
+            guild = self._guilds.get(guild_id)
+            entry = guild.entries.get(key) if guild else None
+            if entry is not None and entry[0] > now:
+                guild.entries.move_to_end(key)
+                self._guilds.move_to_end(guild_id)
+                self._record(kind, 'hit')
+                return copy.copy(entry[1])
+            if entry is not None:
+                guild.remove(key)
+            self._record(kind, 'miss')
+            generation = self._generations.get(guild_id, 0)
+        value = load()
+        with self._lock:
+            if self._generations.get(guild_id, 0) == generation:
+                self._store(guild_id, key, value, tuple(tags(value)), now + self.ttl)
+        return copy.copy(value)
+
+    def _record(self, kind: str, result: str):
+        self.counters[(kind, result)] += 1
+        ENTITY_CACHE_REQUESTS.labels(kind=kind, result=result).inc()
+
+    def _store(self, guild_id: int, key: tuple, value, tags: tuple, expires: float):
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._guilds[guild_id] = _GuildEntries()
+            if len(self._guilds) > self.max_guilds:
+                self._guilds.popitem(last=False)
+        self._guilds.move_to_end(guild_id)
+        if key in guild.entries:
+            guild.remove(key)
+        guild.entries[key] = (expires, value, tags)
+        for tag in tags:
+            guild.by_tag.setdefault(tag, set()).add(key)
+        while len(guild.entries) > self.max_entries:
+            guild.remove(next(iter(guild.entries)))
+
+    def invalidate(self, guild_id: int, *tags):
+        with self._lock:
+            self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+            guild = self._guilds.get(guild_id)
+            if guild is None:
+                return
+            for tag in tags:
+                for key in list(guild.by_tag.get(tag, ())):
+                    guild.remove(key)
+
+    def clear(self, guild_id: int = None):
+        with self._lock:
+            if guild_id is None:
+                self._guilds.clear()
+                for key in self._generations:
+                    self._generations[key] += 1
+            else:
+                self._guilds.pop(guild_id, None)
+                self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+            entries = sum(len(guild.entries) for guild in self._guilds.values())
+            guilds = len(self._guilds)
+        kinds = {}
+        for (kind, result), count in counters.items():
+            kinds.setdefault(kind, {'hit': 0, 'miss': 0})[result] = count
+        for values in kinds.values():
+            total = values['hit'] + values['miss']
+            values['ratio'] = values['hit'] / total if total else 0.0
+        return {'kinds': kinds, 'entries': entries, 'guilds': guilds}
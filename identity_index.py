@@ -0,0 +1,129 @@
+import copy
+import os
+import threading
+from collections import OrderedDict
+
+# Índice de identidades por guild: user_id -> si es jugador, manager o capitán (y de qué equipo) y si está sancionado.
+# Se carga entero la primera vez que se consulta un guild (tres SELECT). Las escrituras sobre equipos, jugadores
+# o capitanes sustituyen en el índice solo las filas afectadas (refresh); las masivas lo descartan (invalidate).
+
+IDENTITY_INDEX_MAX_GUILDS = int(os.getenv("IDENTITY_INDEX_MAX_GUILDS", "64"))
+
+NOT_LOADED = object()
+
+def empty_identity(user_id: int) -> dict:
+    return {'user_id': user_id, 'player': None, 'banned': False, 'manager_of': None, 'captain_of': None, 'team': None}
+
+class _GuildIdentities:
+    def __init__(self, teams: list, captains: list, players: list):
+        self.teams = {team['id']: team for team in teams}
+        self.managers = {team['manager_id']: team['id'] for team in teams if team['manager_id'] is not None}
+        self.captain_pairs = list(captains)
+        self._index_captains()
+        self.players = {player['user_id']: player for player in players}
+
+    def _index_captains(self):
+        self.captains = {}
+        for team_id, captain_id in self.captain_pairs:
+            self.captains.setdefault(captain_id, team_id)
+
+    def put_team(self, team_id: int, team: dict):
+        """Sustituye un equipo por su fila actual (None si ya no existe)."""
+        old = self.teams.pop(team_id, None)
+        if old and self.managers.get(old['manager_id']) == team_id:
+            del self.managers[old['manager_id']]
+        if team:
+            self.teams[team_id] = team
+            if team['manager_id'] is not None:
+                self.managers[team['manager_id']] = team_id
+
+    def put_player(self, user_id: int, player: dict):
+        if player:
+            self.players[user_id] = player
+        else:
+            self.players.pop(user_id, None)
+
+    def replace_captains(self, keep, pairs: list):
+        """Conserva los pares (team_id, captain_id) para los que keep(team_id, captain_id) es cierto y añade pairs."""
+        self.captain_pairs = [pair for pair in self.captain_pairs if keep(*pair)] + list(pairs)
+        self._index_captains()
+
+    def lookup(self, user_id: int) -> dict:
+        player = self.players.get(user_id)
+        manager_of = self.teams.get(self.managers.get(user_id))
+        captain_of = self.teams.get(self.captains.get(user_id))
+        return {
+            'user_id': user_id,
+            'player': copy.copy(player),
+            'banned': bool(player and player['banned']),
+            'manager_of': copy.copy(manager_of),
+            'captain_of': copy.copy(captain_of),
+            # Equipo desde el que actúa: el que dirige o, si no, del que es capitán
+            'team': copy.copy(manager_of or captain_of),
+        }
+
+class IdentityIndex:
+    """load(guild_id) devuelve (equipos, pares (team_id, captain_id), jugadores) y puede lanzar sqlite3.Error."""
+
+    def __init__(self, load, max_guilds: int = IDENTITY_INDEX_MAX_GUILDS):
+        self.load = load
+        self.max_guilds = max(1, max_guilds)
+        self._guilds = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def peek(self, guild_id: int, user_id: int):
+        """Identidad si el guild ya está cargado, o NOT_LOADED (nunca toca la base de datos)."""
+        with self._lock:
+            guild = self._guilds.get(guild_id)
+            if guild is None:
+                return NOT_LOADED
+            self._guilds.move_to_end(guild_id)
+            # Dentro del lock: refresh() puede estar sustituyendo filas del mismo índice
+            return guild.lookup(user_id)
+
+    def get(self, guild_id: int, user_id: int) -> dict:
+        identity = self.peek(guild_id, user_id)
+        if identity is not NOT_LOADED:
+            return identity
+        with self._lock:
+            generation = self._generations.get(guild_id, 0)
+        guild = _GuildIdentities(*self.load(guild_id))
+        with self._lock:
+            # Si hubo una escritura durante la carga no se guarda: la siguiente consulta vuelve a cargar
+            if self._generations.get(guild_id, 0) == generation:
+                self._guilds[guild_id] = guild
+                while len(self._guilds) > self.max_guilds:
+                    self._guilds.popitem(last=False)
+        return guild.lookup(user_id)
+
+    def refresh(self, guild_id: int, patch) -> bool:
+        """Llama a patch(índice) para que relea y sustituya las filas que cambió una escritura.
+
+        Lectura y sustitución ocurren dentro del lock, así que ningún otro refresh, invalidate ni peek se
+        intercala, venga la escritura del hilo escritor del guild o de un llamador síncrono (batch_ocr,
+        migraciones, to_thread). Si el guild no estaba cargado no hay nada que parchear; si patch falla,
+        el índice del guild se descarta y la siguiente consulta lo recarga.
+        """
+        with self._lock:
+            # La generación nueva descarta las cargas (get) que empezaron antes de la escritura
+            self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+            guild = self._guilds.get(guild_id)
+            if guild is None:
+                return False
+            try:
+                patch(guild)
+            except BaseException:
+                self._guilds.pop(guild_id, None)
+                raise
+            return True
+
+    def invalidate(self, guild_id: int = None):
+        with self._lock:
+            if guild_id is None:
+                self._guilds.clear()
+                for key in self._generations:
+                    self._generations[key] += 1
+            else:
+                self._guilds.pop(guild_id, None)
+                self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
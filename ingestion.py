@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+import metrics
+
+logger = logging.getLogger('bot')
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "64"))
+LATENCY_WINDOW = 500
+
+class ScreenshotJob:
+    def __init__(self, message, attachment, config: dict):
+        self.message = message
+        self.attachment = attachment
+        self.config = config
+        self.guild_id = message.guild.id
+        self.user_id = message.author.id
+        # created_at lo pone Discord: la latencia incluye el tiempo hasta que llega el evento
+        self.uploaded_at = message.created_at
+        self.enqueued_at = time.perf_counter()
+
+    @property
+    def key(self) -> tuple:
+        return self.guild_id, self.user_id
+
+class IngestionQueue:
+    """Cola de capturas: agrupa las subidas de cada usuario y las procesa en orden con un número fijo de workers.
+
+    Las capturas de un mismo (guild, usuario) nunca se procesan en paralelo; las que llegan mientras
+    otras están en cola se unen a su lote. handler(job) devuelve el veredicto ('accepted', 'review', ...).
+    """
+
+    def __init__(self, handler, workers: int = INGEST_WORKERS, max_pending: int = INGEST_MAX_PENDING):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self._queue = asyncio.Queue()
+        self._pending = {}
+        self._active = set()
+        self._tasks = []
+        self.counters = Counter()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.queue_waits = deque(maxlen=LATENCY_WINDOW)
+
+    @property
+    def pending(self) -> int:
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(), name=f"ingestion-{i}") for i in range(self.workers)]
+            logger.info(f"Cola de capturas iniciada con {self.workers} workers y máximo de {self.max_pending} pendientes.")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("Cola de capturas detenida.")
+
+    def submit(self, job: ScreenshotJob) -> bool:
+        """Encola una captura; devuelve False si la cola está llena."""
+        if self.pending >= self.max_pending:
+            self.counters['rejected_full'] += 1
+            return False
+        self.counters['submitted'] += 1
+        jobs = self._pending.get(job.key)
+        if jobs is not None:
+            jobs.append(job)
+            self.counters['coalesced'] += 1
+            return True
+        self._pending[job.key] = [job]
+        # Si el usuario tiene un lote en proceso, el worker lo vuelve a encolar al terminar
+        if job.key not in self._active:
+            self._queue.put_nowait(job.key)
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._queue.get()
+            self._active.add(key)
+            jobs = self._pending.pop(key, [])
+            try:
+                for job in jobs:
+                    await self._run(job)
+            finally:
+                self._active.discard(key)
+                if key in self._pending:
+                    self._queue.put_nowait(key)
+                self._queue.task_done()
+
+    async def _run(self, job: ScreenshotJob):
+        wait = time.perf_counter() - job.enqueued_at
+        self.queue_waits.append(wait)
+        metrics.SCREENSHOT_STAGE_SECONDS.labels(stage='queue_wait').observe(wait)
+        try:
+            verdict = await self.handler(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error al procesar la captura de {job.user_id} en guild {job.guild_id}: {e}", exc_info=True)
+            verdict = 'error'
+        latency = (datetime.now(timezone.utc) - job.uploaded_at).total_seconds()
+        self.counters[f'verdict_{verdict}'] += 1
+        self.latencies.append(latency)
+        metrics.SCREENSHOTS_TOTAL.labels(verdict=verdict).inc()
+        metrics.SCREENSHOT_LATENCY_SECONDS.observe(latency)
+
+    @staticmethod
+    def _percentile(values, fraction: float) -> float:
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+    def stats(self) -> dict:
+        return {
+            'pending': self.pending,
+            'active_users': len(self._active),
+            'counters': dict(self.counters),
+            'latency_p50': self._percentile(self.latencies, 0.5),
+            'latency_p95': self._percentile(self.latencies, 0.95),
+            'latency_max': max(self.latencies, default=0.0),
+            'queue_wait_p95': self._percentile(self.queue_waits, 0.95),
+            'samples': len(self.latencies),
+        }
@@ -0,0 +1,408 @@
+import os
+import asyncio
+import logging
+import sqlite3
+import discord
+from discord.ext import commands
+from discord import app_commands
+from dotenv import load_dotenv
+import traceback
+import async_database
+from database import is_guild_banned, get_wal_sizes, explain_query_plans, entity_cache_stats
+from migrations import migrate_all, prepare_guild_database
+from query_metrics import top_accessors, SORT_KEYS, SLOW_QUERY_MS
+from backups import backup_all, restore_backup, list_backups, hold_bot_lock
+from Cogs.LeagueCog import OfferView, ConfirmAmistosoView
+
+load_dotenv()
+
+logger = logging.getLogger('bot')
+logger.setLevel(logging.DEBUG)
+
+logging.basicConfig(level=logging.INFO, filename='bot.log', format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+file_handler = logging.FileHandler('bot.log')
+file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(file_handler)
+
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+logger.addHandler(console_handler)
+
+intents = discord.Intents.default()
+intents.message_content = True
+intents.guilds = True
+intents.members = True
+intents.messages = True
+intents.guild_messages = True
+intents.dm_messages = True
+
+bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
+
+OWNER_ID = int(os.getenv("OWNER_ID", "509812954426769418"))  # Agrega tu ID en .env como OWNER_ID
+
+@bot.event
+async def setup_hook():
+    # Las migraciones terminan antes de cargar los cogs: ninguna captura llega a una base sin
+    # screenshot_hashes ni attachment_id. Aquí aún no hay guilds conectados: se migran los league_*.db existentes.
+    await asyncio.to_thread(migrate_all)
+    await bot.load_extension('Cogs.LeagueCog')
+    logger.info('Cog LeagueCog cargado.')
+    await bot.load_extension('Cogs.MaintenanceCog')
+    logger.info('Cog MaintenanceCog cargado.')
+
+@bot.event
+async def on_ready():
+    logger.info(f'Bot conectado como {bot.user}')
+    try:
+        active_guilds = [guild for guild in bot.guilds if not is_guild_banned(guild.id)]
+        # Crea las bases de los guilds a los que se unió mientras estaba desconectado
+        await asyncio.to_thread(migrate_all, [guild.id for guild in active_guilds])
+        for guild in bot.guilds:
+            if guild in active_guilds:
+                synced = await bot.tree.sync(guild=discord.Object(id=guild.id))
+                logger.info(f'Comandos sincronizados para guild {guild.id}: {[cmd.name for cmd in synced]}')
+            else:
+                await guild.leave()
+                logger.info(f'Bot salió del guild baneado {guild.id}')
+        global_synced = await bot.tree.sync()
+        logger.info(f'Comandos sincronizados globalmente: {[cmd.name for cmd in global_synced]}')
+        logger.info('Bot completamente inicializado.')
+    except Exception as e:
+        logger.error(f'Error al preparar los guilds o sincronizar: {e}', exc_info=True)
+
+@bot.event
+async def on_guild_join(guild):
+    if is_guild_banned(guild.id):
+        await guild.leave()
+        logger.info(f'Bot salió del guild baneado {guild.id}')
+    else:
+        await asyncio.to_thread(prepare_guild_database, guild.id)
+        synced = await bot.tree.sync(guild=discord.Object(id=guild.id))
+        logger.info(f'Comandos sincronizados para nuevo guild {guild.id}: {[cmd.name for cmd in synced]}')
+
+@bot.tree.error
+async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    logger.error(f'Error en comando: {error}', exc_info=True)
+    embed = discord.Embed(title="❌ Error", description=str(error), color=discord.Color.red())
+    if interaction.response.is_done():
+        await interaction.followup.send(embed=embed, ephemeral=True)
+    else:
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="list_guilds", description="Lista los servidores en los que está el bot (solo owner)")
+async def list_guilds(interaction: discord.Interaction):
+    if interaction.user.id != OWNER_ID:
+        await interaction.response.send_message("No tienes permiso para usar este comando.", ephemeral=True)
+        return
+    guilds_list = []
+    for guild in bot.guilds:
+        if not is_guild_banned(guild.id):
+            guilds_list.append(f"ID: {guild.id} | Nombre: {guild.name}")
+    if not guilds_list:
+        description = "El bot no está en ningún servidor no baneado."
+    else:
+        description = "\n".join(guilds_list)
+    embed = discord.Embed(
+        title="📋 Servidores del Bot",
+        description=description,
+        color=discord.Color.blue()
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+    logger.info(f"El dueño {interaction.user.id} ejecutó /list_guilds.")
+
+@bot.tree.command(name="ban_guild", description="Banear un guild (solo owner)")
+@app_commands.describe(guild_id="ID del guild a banear")
+async def ban_guild_command(interaction: discord.Interaction, guild_id: str):
+    if interaction.user.id != OWNER_ID:
+        await interaction.response.send_message("No tienes permiso para usar este comando.", ephemeral=True)
+        return
+    try:
+        if not guild_id.isdigit():
+            raise ValueError("El ID del guild debe ser un número entero.")
+        guild_id_int = int(guild_id)
+        if len(guild_id) < 10:
+            raise ValueError("El ID del guild es demasiado corto. Los IDs de Discord suelen tener al menos 10 dígitos.")
+        
+        from database import ban_guild
+        ban_guild(guild_id_int)
+        guild = bot.get_guild(guild_id_int)
+        if guild:
+            await guild.leave()
+            logger.info(f'Bot salió del guild {guild_id_int} tras ser baneado.')
+        await interaction.response.send_message(f"Guild {guild_id_int} baneado.", ephemeral=True)
+    except ValueError as ve:
+        logger.error(f"Error de validación en guild_id {guild_id}: {ve}")
+        await interaction.response.send_message(f"Error: {str(ve)}", ephemeral=True)
+    except sqlite3.Error as se:
+        logger.error(f"Error en la base de datos al banear guild {guild_id}: {se}")
+        await interaction.response.send_message("Error al banear el guild en la base de datos.", ephemeral=True)
+    except Exception as e:
+        logger.error(f"Error inesperado al banear guild {guild_id}: {e}")
+        await interaction.response.send_message(f"Error inesperado: {e}", ephemeral=True)
+
+@bot.tree.command(name="unban_guild", description="Desbanear un guild (solo owner)")
+@app_commands.describe(guild_id="ID del guild a desbanear")
+async def unban_guild_command(interaction: discord.Interaction, guild_id: str):
+    if interaction.user.id != OWNER_ID:
+        await interaction.response.send_message("No tienes permiso para usar este comando.", ephemeral=True)
+        return
+    try:
+        if not guild_id.isdigit():
+            raise ValueError("El ID del guild debe ser un número entero.")
+        guild_id_int = int(guild_id)
+        if len(guild_id) < 10:
+            raise ValueError("El ID del guild es demasiado corto. Los IDs de Discord suelen tener al menos 10 dígitos.")
+        
+        from database import unban_guild, is_guild_banned
+        if not is_guild_banned(guild_id_int):
+            raise ValueError(f"El guild {guild_id_int} no está baneado.")
+        
+        unban_guild(guild_id_int)
+        await interaction.response.send_message(f"Guild {guild_id_int} desbaneado.", ephemeral=True)
+        logger.info(f"Guild {guild_id_int} desbaneado por {interaction.user.id}.")
+    except ValueError as ve:
+        logger.error(f"Error de validación en guild_id {guild_id}: {ve}")
+        await interaction.response.send_message(f"Error: {str(ve)}", ephemeral=True)
+    except sqlite3.Error as se:
+        logger.error(f"Error en la base de datos al desbanear guild {guild_id}: {se}")
+        await interaction.response.send_message(f"Error al desbanear el guild en la base de datos: {str(se)}", ephemeral=True)
+    except Exception as e:
+        logger.error(f"Error inesperado al desbanear guild {guild_id}: {e}")
+        await interaction.response.send_message(f"Error inesperado: {str(e)}", ephemeral=True)
+
+@bot.tree.command(name="sync_commands", description="Forzar sincronización de comandos (solo owner)")
+async def sync_commands(interaction: discord.Interaction):
+    if interaction.user.id != OWNER_ID:
+        await interaction.response.send_message("No tienes permiso para usar este comando.", ephemeral=True)
+        return
+    try:
+        synced = await bot.tree.sync(guild=discord.Object(id=interaction.guild.id))
+        commands_list = [cmd.name for cmd in synced]
+        await interaction.response.send_message(f"Comandos sincronizados: {commands_list}", ephemeral=True)
+        logger.info(f"Comandos sincronizados manualmente para guild {interaction.guild.id}: {commands_list}")
+    except Exception as e:
+        await interaction.response.send_message(f"Error al sincronizar: {e}", ephemeral=True)
+        logger.error(f"Error al sincronizar comandos manualmente: {e}")
+
+@bot.tree.command(name="wal_status", description="Tamaño del WAL de cada base de datos (solo owner)")
+async def wal_status(interaction: discord.Interaction):
+    if interaction.user.id != OWNER_ID:
+        await interaction.response.send_message("No tienes permiso para usar este comando.", ephemeral=True)
+        return
+    sizes = await asyncio.to_thread(get_wal_sizes)
+    ranked = sorted(sizes.items(), key=lambda item: item[1], reverse=True)[:25]
+    lines = [f"{'global' if guild_id is None else guild_id}: {size / 1024:,.1f} KiB" for guild_id, size in ranked]
+    total = sum(sizes.values())
+    embed = discord.Embed(
+        title="🗄️ Estado del WAL",
+        description="\n".join(lines) or "No hay bases de datos.",
+        color=discord.Color.blue()
+    )
+    embed.set_footer(text=f"Total: {total / 1024:,.1f} KiB en {len(sizes)} bases de datos")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="query_plans", description="Revisa los planes de consulta de los accesores de la base de datos (solo owner)")
+@app_commands.describe(guild_id="ID del guild a revisar (opcional, por defecto el actual)")
+async def query_plans(interaction: discord.Interaction, guild_id: str = None):
+    if interaction.user.id != OWNER_ID:
+        await interaction.response.send_message("No tienes permiso para usar este comando.", ephemeral=True)
+        return
+    if guild_id is not None and not guild_id.isdigit():
+        await interaction.response.send_message("Error: El ID del guild debe ser un número entero.", ephemeral=True)
+        return
+    target = int(guild_id) if guild_id else interaction.guild.id
+    plans = await asyncio.to_thread(explain_query_plans, target)
+    lines = []
+    for name, plan in plans.items():
+        if plan['full_scan'] and not plan['allow_scan']:
+            marker = "❌"
+        elif plan['full_scan']:
+            marker = "⚠️"
+        else:
+            marker = "✅"
+        lines.append(f"{marker} `{name}`: {' | '.join(plan['plan'])}")
+    embed = discord.Embed(
+        title=f"🔎 Planes de consulta (guild {target})",
+        description="\n".join(lines)[:4000] or "No se pudieron obtener los planes.",
+        color=discord.Color.blue()
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="db_top", description="Accesores de la base de datos más lentos o más usados (solo owner)")
+@app_commands.describe(
+    cantidad="Cuántos accesores mostrar (por defecto 10)",
+    orden="p95, total (tiempo acumulado), calls o errors",
+    guild_id="ID del guild (opcional, por defecto todos)"
+)
+async def db_top(interaction: discord.Interaction, cantidad: int = 10, orden: str = 'p95', guild_id: str = None):
+    if interaction.user.id != OWNER_ID:
+        await interaction.response.send_message("No tienes permiso para usar este comando.", ephemeral=True)
+        return
+    if orden not in SORT_KEYS:
+        await interaction.response.send_message(f"Error: El orden debe ser uno de: {', '.join(SORT_KEYS)}.", ephemeral=True)
+        return
+    if guild_id is not None and not guild_id.isdigit():
+        await interaction.response.send_message("Error: El ID del guild debe ser un número entero.", ephemeral=True)
+        return
+    stats = top_accessors(max(1, min(cantidad, 25)), orden, int(guild_id) if guild_id else None)
+    lines = [
+        f"`{s['function']}`: {s['calls']:,} llamadas | p95 {s['p95_ms']:.1f} ms | media {s['mean_ms']:.1f} ms | "
+        f"total {s['total']:.1f}s | {s['rows']:,} filas | {s['errors']} errores"
+        for s in stats
+    ]
+    embed = discord.Embed(
+        title=f"🐢 Accesores de la base de datos ({'guild ' + guild_id if guild_id else 'todos los guilds'})",
+        description="\n".join(lines)[:4000] or "Todavía no hay llamadas registradas.",
+        color=discord.Color.blue()
+    )
+    embed.set_footer(text=f"Ordenado por {orden} desde el arranque | consultas lentas: >{SLOW_QUERY_MS:.0f} ms en bot.log")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="cache_stats", description="Aciertos de la caché de equipos, jugadores y capitanes (solo owner)")
+async def cache_stats(interaction: discord.Interaction):
+    if interaction.user.id != OWNER_ID:
+        await interaction.response.send_message("No tienes permiso para usar este comando.", ephemeral=True)
+        return
+    stats = entity_cache_stats()
+    lines = [
+        f"`{kind}`: {values['hit']:,} aciertos / {values['miss']:,} fallos ({values['ratio']:.1%})"
+        for kind, values in sorted(stats['kinds'].items())
+    ]
+    hits = sum(values['hit'] for values in stats['kinds'].values())
+    total = hits + sum(values['miss'] for values in stats['kinds'].values())
+    embed = discord.Embed(
+        title="🧠 Caché de entidades",
+        description="\n".join(lines) or "Todavía no hay consultas.",
+        color=discord.Color.blue()
+    )
+    embed.set_footer(text=f"Total: {hits / total if total else 0:.1%} de aciertos | "
+                          f"{stats['entries']:,} entradas en {stats['guilds']} guilds")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="backup_now", description="Copia de seguridad inmediata de todas las bases de datos (solo owner)")
+@app_commands.describe(forzar="Copiar también las bases sin cambios desde la última copia")
+async def backup_now(interaction: discord.Interaction, forzar: bool = False):
+    if interaction.user.id != OWNER_ID:
+        await interaction.response.send_message("No tienes permiso para usar este comando.", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True)
+    report = await asyncio.to_thread(backup_all, forzar)
+    lines = [
+        f"`{'global' if guild_id is None else guild_id}`: {r['status']}"
+        + (f" | {r['compressed_bytes'] / 1024:,.1f} KiB" if r['status'] == 'created' else "")
+        + f" | {r['seconds']:.2f}s"
+        for guild_id, r in report.items()
+    ]
+    created = sum(1 for r in report.values() if r['status'] == 'created')
+    embed = discord.Embed(
+        title=f"💾 Copias de seguridad: {created} nuevas de {len(report)}",
+        description="\n".join(lines)[:4000] or "No hay bases de datos.",
+        color=discord.Color.blue()
+    )
+    await interaction.followup.send(embed=embed, ephemeral=True)
+    logger.info(f"El dueño {interaction.user.id} ejecutó /backup_now.")
+
+@bot.tree.command(name="restore_backup", description="Restaura una copia de seguridad de una base de datos (solo owner)")
+@app_commands.describe(
+    guild_id="ID del guild o 'global'",
+    archivo="Archivo .db.gz a restaurar (por defecto el último)"
+)
+async def restore_backup_command(interaction: discord.Interaction, guild_id: str, archivo: str = None):
+    if interaction.user.id != OWNER_ID:
+        await interaction.response.send_message("No tienes permiso para usar este comando.", ephemeral=True)
+        return
+    if guild_id != 'global' and not guild_id.isdigit():
+        await interaction.response.send_message("Error: El ID del guild debe ser un número entero o 'global'.", ephemeral=True)
+        return
+    target = None if guild_id == 'global' else int(guild_id)
+    await interaction.response.defer(ephemeral=True)
+    try:
+        # En el hilo escritor del guild: ninguna escritura se cuela entre cerrar el pool, restaurar y descartar
+        # las cachés, y en este proceso para que las cachés que descarta sean las del bot
+        report = await async_database.run_guild_write(target, restore_backup, target, archivo)
+    except (ValueError, sqlite3.Error, OSError) as e:
+        logger.error(f"Error al restaurar la copia de {guild_id}: {e}")
+        recent = ", ".join(f"`{b['file']}`" for b in list_backups(target)[-5:]) or "ninguna"
+        await interaction.followup.send(f"Error: {e}\nÚltimas copias: {recent}", ephemeral=True)
+        return
+    cog = bot.get_cog('LeagueCog')
+    if cog is not None and target is not None:
+        cog.nicktag_matchers.invalidate(target)
+    embed = discord.Embed(
+        title=f"♻️ Copia restaurada: {report['file']}",
+        description="\n".join(f"`{step}`: {seconds:.2f}s" for step, seconds in report['timings'].items()),
+        color=discord.Color.green()
+    )
+    embed.set_footer(text=f"Creada {report['created']} | {report['bytes'] / 1024:,.1f} KiB")
+    await interaction.followup.send(embed=embed, ephemeral=True)
+    logger.info(f"El dueño {interaction.user.id} restauró {report['file']} en {guild_id}.")
+
+@bot.tree.command(name="filter_stats", description="Mensajes descartados por el filtro de capturas (solo owner)")
+async def filter_stats(interaction: discord.Interaction):
+    if interaction.user.id != OWNER_ID:
+        await interaction.response.send_message("No tienes permiso para usar este comando.", ephemeral=True)
+        return
+    cog = bot.get_cog('LeagueCog')
+    if cog is None:
+        await interaction.response.send_message("El cog LeagueCog no está cargado.", ephemeral=True)
+        return
+    stats = cog.message_filter.stats()
+    total = stats['total'] or 1
+    lines = [f"`{reason}`: {count:,} ({count / total:.1%})" for reason, count in stats['rejected'].items()]
+    lines.append(f"**Pasan al OCR**: {stats['passed']:,} ({stats['passed'] / total:.1%})")
+    embed = discord.Embed(
+        title="🧹 Filtro de mensajes",
+        description="\n".join(lines),
+        color=discord.Color.blue()
+    )
+    embed.set_footer(text=f"Total: {stats['total']:,} mensajes desde el arranque")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="ingest_stats", description="Estado de la cola de capturas (solo owner)")
+async def ingest_stats(interaction: discord.Interaction):
+    if interaction.user.id != OWNER_ID:
+        await interaction.response.send_message("No tienes permiso para usar este comando.", ephemeral=True)
+        return
+    cog = bot.get_cog('LeagueCog')
+    if cog is None:
+        await interaction.response.send_message("El cog LeagueCog no está cargado.", ephemeral=True)
+        return
+    stats = cog.ingestion.stats()
+    lines = [
+        f"Pendientes: {stats['pending']} | Usuarios en proceso: {stats['active_users']}",
+        f"Subida → veredicto: p50 {stats['latency_p50']:.2f}s, p95 {stats['latency_p95']:.2f}s, máx {stats['latency_max']:.2f}s",
+        f"Espera en cola p95: {stats['queue_wait_p95']:.2f}s",
+    ]
+    lines += [f"`{name}`: {count:,}" for name, count in sorted(stats['counters'].items())]
+    embed = discord.Embed(
+        title="📥 Cola de capturas",
+        description="\n".join(lines),
+        color=discord.Color.blue()
+    )
+    embed.set_footer(text=f"Últimas {stats['samples']} capturas")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="open_market", description="Abrir el mercado de transferencias (solo admins)")
+@app_commands.checks.has_permissions(administrator=True)
+async def open_market(interaction: discord.Interaction):
+    from database import set_market_status
+    set_market_status(interaction.guild.id, "open")
+    await interaction.response.send_message("El mercado de transferencias ha sido abierto.", ephemeral=False)
+
+@bot.tree.command(name="close_market", description="Cerrar el mercado de transferencias (solo admins)")
+@app_commands.checks.has_permissions(administrator=True)
+async def close_market(interaction: discord.Interaction):
+    from database import set_market_status
+    set_market_status(interaction.guild.id, "closed")
+    await interaction.response.send_message("El mercado de transferencias ha sido cerrado.", ephemeral=False)
+
+def main():
+    BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
+    if not BOT_TOKEN:
+        logger.error("DISCORD_BOT_TOKEN no está configurado.")
+        raise RuntimeError("DISCORD_BOT_TOKEN no está configurado.")
+    # Mientras el bot esté en marcha, `python -m backups restore` se niega a restaurar desde otro proceso
+    hold_bot_lock()
+    bot.run(BOT_TOKEN)
+
@@ -0,0 +1,188 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Registro de métricas en memoria con salida en formato de texto de Prometheus.
+# Los contadores e histogramas son seguros entre hilos (la base de datos se usa desde hilos del executor).
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+class _CounterChild:
+    def __init__(self, lock):
+        self._lock = lock
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+class _HistogramChild:
+    def __init__(self, lock, buckets: tuple):
+        self._lock = lock
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimación por interpolación lineal dentro del bucket (como histogram_quantile)."""
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = q * self.count
+            seen = 0
+            for i, count in enumerate(self.counts):
+                if seen + count >= rank and count:
+                    lower = self.buckets[i - 1] if i > 0 else 0.0
+                    upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                    return lower + (upper - lower) * (rank - seen) / count
+                seen += count
+            return self.buckets[-1]
+
+class _Metric:
+    def __init__(self, kind: str, name: str, help: str, labelnames: tuple, buckets: tuple = None):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        key = tuple((name, labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = _HistogramChild(self._lock, self.buckets) if self.kind == 'histogram' else _CounterChild(self._lock)
+                    self._children[key] = child
+        return child
+
+    # Atajos para métricas sin etiquetas
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def children(self) -> dict:
+        with self._lock:
+            return dict(self._children)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in sorted(self.children().items(), key=lambda item: str(item[0])):
+            if self.kind == 'counter':
+                lines.append(f"{self.name}{_format_labels(key)} {child.value}")
+                continue
+            with self._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', le),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+def aggregate(metric: _Metric, by: str, **match) -> dict:
+    """Suma los hijos de una métrica agrupando por la etiqueta `by`, filtrando por las etiquetas de `match`.
+
+    Devuelve {valor de la etiqueta: hijo} con hijos nuevos (contadores o histogramas combinados).
+    """
+    merged = {}
+    for key, child in metric.children().items():
+        labels = dict(key)
+        if any(str(labels.get(name)) != str(value) for name, value in match.items()):
+            continue
+        group = labels.get(by)
+        with metric._lock:
+            if metric.kind == 'counter':
+                target = merged.setdefault(group, _CounterChild(threading.Lock()))
+                target.value += child.value
+            else:
+                target = merged.setdefault(group, _HistogramChild(threading.Lock(), metric.buckets))
+                target.counts = [a + b for a, b in zip(target.counts, child.counts)]
+                target.sum += child.sum
+                target.count += child.count
+    return merged
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind: str, name: str, help: str, labelnames: tuple, buckets: tuple = None) -> _Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = _Metric(kind, name, help, tuple(labelnames), buckets)
+            return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> _Metric:
+        return self._get('counter', name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> _Metric:
+        return self._get('histogram', name, help, labelnames, tuple(buckets))
+
+    def get(self, name: str) -> _Metric:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+registry = Registry()
+
+def write_snapshot(path: str):
+    # Escritura atómica: quien lea el archivo nunca ve un volcado a medias
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(registry.render())
+    os.replace(tmp_path, path)
+
+SCREENSHOT_STAGE_SECONDS = registry.histogram(
+    'leaguebot_screenshot_stage_seconds', "Duración de cada etapa del pipeline de capturas", ('stage',))
+SCREENSHOT_LATENCY_SECONDS = registry.histogram(
+    'leaguebot_screenshot_latency_seconds', "Tiempo desde la subida de la captura hasta el veredicto",
+    buckets=(0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0))
+SCREENSHOTS_TOTAL = registry.counter('leaguebot_screenshots_total', "Capturas procesadas por veredicto", ('verdict',))
+
+DB_CALL_SECONDS = registry.histogram(
+    'leaguebot_db_call_seconds', "Duración de cada llamada a un accesor de database.py (_count = llamadas)", ('function', 'guild'),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+DB_ROWS_TOTAL = registry.counter('leaguebot_db_rows_total', "Filas devueltas por los accesores de database.py", ('function', 'guild'))
+DB_ERRORS_TOTAL = registry.counter('leaguebot_db_errors_total', "Errores en accesores de database.py", ('function', 'guild'))
+
+@contextmanager
+def span(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        SCREENSHOT_STAGE_SECONDS.labels(stage=stage).observe(time.perf_counter() - start)
+
+def record_stages(timings: dict):
+    # Etapas medidas en otro proceso (el pool de OCR devuelve sus tiempos con el resultado)
+    for stage, seconds in timings.items():
+        SCREENSHOT_STAGE_SECONDS.labels(stage=stage).observe(seconds)
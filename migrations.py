@@ -0,0 +1,166 @@
+import argparse
+import logging
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import database
+
+logger = logging.getLogger('database')
+
+MIGRATION_WORKERS = int(os.getenv("MIGRATION_WORKERS", "8"))
+
+# Cada migración recibe una conexión con una transacción abierta; no debe hacer commit ni usar executescript.
+def _m001_secondary_indexes(conn: sqlite3.Connection):
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS idx_players_team_id ON players(team_id)",
+        "CREATE INDEX IF NOT EXISTS idx_teams_manager_id ON teams(manager_id)",
+        "CREATE INDEX IF NOT EXISTS idx_transfer_offers_player_status ON transfer_offers(player_name, status)",
+        "CREATE INDEX IF NOT EXISTS idx_transfer_offers_manager_status ON transfer_offers(from_manager_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_transfer_offers_status ON transfer_offers(status)",
+        "CREATE INDEX IF NOT EXISTS idx_screenshots_user_id ON screenshots(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_team_captains_captain_id ON team_captains(captain_id)",
+        "CREATE INDEX IF NOT EXISTS idx_amistosos_tabla_id ON amistosos(tabla_id)",
+        "CREATE INDEX IF NOT EXISTS idx_amistosos_horarios_tabla_horario ON amistosos_horarios(tabla_id, horario)",
+    ):
+        conn.execute(statement)
+    # La versión del conjunto de índices ahora la lleva PRAGMA user_version
+    conn.execute("DELETE FROM guild_config WHERE key = 'index_version'")
+    conn.execute('ANALYZE')
+
+def _m002_screenshot_hashes(conn: sqlite3.Connection):
+    conn.execute("ALTER TABLE screenshots ADD COLUMN duplicate_of INTEGER")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS screenshot_hashes (
+            hash BLOB PRIMARY KEY,
+            screenshot_id INTEGER NOT NULL,
+            nicktags TEXT NOT NULL,
+            screenshot_time TEXT,
+            last_seen TEXT NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_screenshot_hashes_last_seen ON screenshot_hashes(last_seen)")
+
+# https://cdn.discordapp.com/attachments/<canal>/<adjunto>/<archivo>?ex=...
+_ATTACHMENT_URL = re.compile(r'/attachments/\d+/(\d+)/')
+
+def _m003_screenshot_attachment_id(conn: sqlite3.Connection):
+    # La URL del CDN lleva parámetros que caducan; el ID del adjunto es la clave estable para reprocesar
+    conn.execute("ALTER TABLE screenshots ADD COLUMN attachment_id INTEGER")
+    rows = conn.execute("SELECT id, image_url FROM screenshots").fetchall()
+    updates = []
+    for row in rows:
+        match = _ATTACHMENT_URL.search(row['image_url'] or '')
+        if match:
+            updates.append((int(match.group(1)), row['id']))
+    conn.executemany("UPDATE screenshots SET attachment_id = ? WHERE id = ?", updates)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_screenshots_attachment_id ON screenshots(attachment_id)")
+
+# (versión, descripción, función). Las versiones son consecutivas y nunca se reescriben una vez publicadas.
+MIGRATIONS = (
+    (1, "índices secundarios de las consultas frecuentes", _m001_secondary_indexes),
+    (2, "hashes perceptuales de capturas y columna duplicate_of", _m002_screenshot_hashes),
+    (3, "ID de adjunto en screenshots para reprocesar capturas", _m003_screenshot_attachment_id),
+)
+
+LATEST_VERSION = MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+def _check_migrations():
+    versions = [version for version, _, _ in MIGRATIONS]
+    if versions != list(range(1, len(versions) + 1)):
+        raise RuntimeError(f"Las versiones de migración deben ser consecutivas desde 1: {versions}")
+
+_check_migrations()
+
+def get_schema_version(guild_id: int) -> int:
+    with database._connect(guild_id) as conn:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate_guild(guild_id: int, dry_run: bool = False) -> list:
+    """Aplica las migraciones pendientes de un guild y devuelve el tiempo de cada una.
+
+    En modo dry_run las migraciones se ejecutan dentro de una única transacción que se revierte al final.
+    """
+    results = []
+    with database._connect(guild_id) as conn:
+        current = conn.execute('PRAGMA user_version').fetchone()[0]
+        pending = [m for m in MIGRATIONS if m[0] > current]
+        if not pending:
+            return results
+        if dry_run:
+            conn.execute('BEGIN IMMEDIATE')
+        try:
+            for version, description, migration in pending:
+                start = time.perf_counter()
+                if not dry_run:
+                    conn.execute('BEGIN IMMEDIATE')
+                try:
+                    migration(conn)
+                    conn.execute(f'PRAGMA user_version = {version}')
+                    if not dry_run:
+                        conn.commit()
+                except sqlite3.Error as e:
+                    conn.rollback()
+                    elapsed = time.perf_counter() - start
+                    results.append({'version': version, 'description': description, 'seconds': elapsed, 'status': f'error: {e}'})
+                    logger.error(f"Migración {version} falló en guild {guild_id} tras {elapsed:.3f}s: {e}")
+                    # Las migraciones siguientes dependen de esta
+                    return results
+                elapsed = time.perf_counter() - start
+                results.append({'version': version, 'description': description, 'seconds': elapsed,
+                                'status': 'dry-run' if dry_run else 'applied'})
+                logger.info(
+                    f"Migración {version} ({description}) {'simulada' if dry_run else 'aplicada'} en guild {guild_id} en {elapsed:.3f}s.")
+        finally:
+            if dry_run and conn.in_transaction:
+                conn.rollback()
+    return results
+
+def prepare_guild_database(guild_id: int, dry_run: bool = False) -> list:
+    if dry_run:
+        # Un dry-run nunca crea archivos nuevos
+        if not os.path.exists(database.get_db_path(guild_id)):
+            return []
+    else:
+        database.create_tables(guild_id)
+    return migrate_guild(guild_id, dry_run)
+
+def migrate_all(guild_ids: list = None, dry_run: bool = False, workers: int = MIGRATION_WORKERS) -> dict:
+    # Cada guild es un archivo independiente, así que se migran en paralelo
+    targets = sorted(set(guild_ids or []) | set(database.list_guild_databases()))
+    report = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="migrations") as executor:
+        futures = {executor.submit(prepare_guild_database, guild_id, dry_run): guild_id for guild_id in targets}
+        for future in as_completed(futures):
+            guild_id = futures[future]
+            try:
+                report[guild_id] = future.result()
+            except Exception as e:
+                logger.error(f"Error al migrar guild {guild_id}: {e}")
+                report[guild_id] = [{'version': None, 'description': None, 'seconds': 0.0, 'status': f'error: {e}'}]
+    applied = sum(1 for results in report.values() for r in results if r['status'] in ('applied', 'dry-run'))
+    logger.info(
+        f"Migraciones {'simuladas' if dry_run else 'aplicadas'}: {applied} en {len(targets)} guilds en {time.perf_counter() - start:.2f}s.")
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Aplica las migraciones de esquema a las bases league_*.db")
+    parser.add_argument('guild_ids', nargs='*', type=int, help="Guilds a migrar (por defecto todos los league_*.db)")
+    parser.add_argument('--dry-run', action='store_true', help="Ejecuta las migraciones y las revierte, solo para medir")
+    parser.add_argument('--workers', type=int, default=MIGRATION_WORKERS, help="Guilds migrados en paralelo")
+    args = parser.parse_args()
+
+    report = migrate_all(args.guild_ids, dry_run=args.dry_run, workers=args.workers)
+    for guild_id in sorted(report):
+        results = report[guild_id]
+        if not results:
+            print(f"guild {guild_id}: al día (versión {LATEST_VERSION})")
+        for r in results:
+            print(f"guild {guild_id}: v{r['version']} {r['description']} -> {r['status']} ({r['seconds'] * 1000:.1f} ms)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import os
+import re
+import time
+from collections import Counter
+from difflib import SequenceMatcher
+
+import async_database as db
+
+NICKTAG_MIN_CONFIDENCE = float(os.getenv("NICKTAG_MIN_CONFIDENCE", "0.6"))
+MATCHER_TTL = float(os.getenv("NICKTAG_MATCHER_TTL", "600"))
+MAX_CANDIDATES = 8
+
+_WHITESPACE = re.compile(r'\s+')
+# El OCR confunde estas letras con dígitos (process_screenshot ya reemplaza O, I y l en el texto leído)
+_OCR_FOLD = str.maketrans({'o': '0', 'i': '1', 'l': '1'})
+
+def fold_name(name: str) -> str:
+    return _WHITESPACE.sub(' ', name.strip().lower()).translate(_OCR_FOLD)
+
+def _trigrams(folded: str) -> set:
+    padded = f"^{folded}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _score(a: str, b: str) -> float:
+    if a == b:
+        return 1.0
+    score = SequenceMatcher(None, a, b).ratio()
+    # Nick con prefijo o sufijo de clan: uno contiene al otro
+    if min(len(a), len(b)) >= 4 and (a in b or b in a):
+        score = max(score, 0.8)
+    return score
+
+class NicktagMatcher:
+    """Índice de los jugadores registrados de un guild para resolver los nicktags leídos por OCR."""
+
+    def __init__(self, players: list):
+        self.players = []
+        self._exact = {}
+        self._index = {}
+        for player in players:
+            folded = fold_name(player['name'])
+            entry = (player['user_id'], player['name'], folded)
+            position = len(self.players)
+            self.players.append(entry)
+            self._exact.setdefault(folded, position)
+            for gram in _trigrams(folded):
+                self._index.setdefault(gram, []).append(position)
+        self.created_at = time.monotonic()
+
+    def _candidates(self, folded: str) -> list:
+        shared = Counter()
+        for gram in _trigrams(folded):
+            shared.update(self._index.get(gram, ()))
+        return [self.players[position] for position, _ in shared.most_common(MAX_CANDIDATES)]
+
+    def match(self, tag: str, aliases: dict = None) -> dict:
+        """Mejor jugador para un nicktag, o None si ninguno supera NICKTAG_MIN_CONFIDENCE.
+
+        aliases ({user_id: (nombre, ...)}) añade nombres que no están registrados, como el apodo de Discord.
+        """
+        folded = fold_name(tag)
+        if not folded:
+            return None
+        position = self._exact.get(folded)
+        if position is not None:
+            user_id, name, _ = self.players[position]
+            return {'tag': tag, 'user_id': user_id, 'name': name, 'confidence': 1.0}
+        candidates = self._candidates(folded)
+        for user_id, names in (aliases or {}).items():
+            candidates.extend((user_id, name, fold_name(name)) for name in names if name)
+        best = None
+        for user_id, name, candidate in candidates:
+            score = _score(folded, candidate)
+            if best is None or score > best['confidence']:
+                best = {'tag': tag, 'user_id': user_id, 'name': name, 'confidence': score}
+        if best is None or best['confidence'] < NICKTAG_MIN_CONFIDENCE:
+            return None
+        return best
+
+    def match_all(self, tags: list, aliases: dict = None) -> list:
+        # Cada jugador se queda con el nicktag que mejor le corresponde
+        best = {}
+        for tag in tags:
+            result = self.match(tag, aliases)
+            if result and (result['user_id'] not in best or result['confidence'] > best[result['user_id']]['confidence']):
+                best[result['user_id']] = result
+        return sorted(best.values(), key=lambda m: m['confidence'], reverse=True)
+
+    def match_player(self, tags: list, user_id: int, aliases: dict = None) -> dict:
+        return next((m for m in self.match_all(tags, aliases) if m['user_id'] == user_id), None)
+
+class MatcherCache:
+    """Un NicktagMatcher por guild; se reconstruye al registrar jugadores o cuando caduca."""
+
+    def __init__(self, ttl: float = MATCHER_TTL):
+        self.ttl = ttl
+        self._matchers = {}
+
+    async def get(self, guild_id: int) -> NicktagMatcher:
+        matcher = self._matchers.get(guild_id)
+        if matcher is None or time.monotonic() - matcher.created_at > self.ttl:
+            matcher = self._matchers[guild_id] = NicktagMatcher(await db.get_all_players(guild_id))
+        return matcher
+
+    def invalidate(self, guild_id: int = None):
+        if guild_id is None:
+            self._matchers.clear()
+        else:
+            self._matchers.pop(guild_id, None)
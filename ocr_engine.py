@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import ocr_utils
+
+logger = logging.getLogger('bot')
+
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+OCR_MAX_PENDING = int(os.getenv("OCR_MAX_PENDING", "32"))
+
+class EngineSaturated(Exception):
+    pass
+
+class ScreenshotEngine:
+    """Procesa capturas (preprocesado + Tesseract) en un pool de procesos con una cola acotada."""
+
+    def __init__(self, workers: int = OCR_WORKERS, max_pending: int = OCR_MAX_PENDING):
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.pending = 0
+        self._executor = None
+
+    def start(self):
+        if self._executor is None:
+            # spawn evita heredar los hilos del bot (pool de base de datos, discord.py) al hacer fork
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=ocr_utils.init_ocr_worker)
+            logger.info(f"Motor de OCR iniciado con {self.workers} procesos y cola máxima de {self.max_pending}.")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            logger.info("Motor de OCR detenido.")
+
+    @property
+    def saturated(self) -> bool:
+        return self.pending >= self.max_pending
+
+    async def run(self, func, *args):
+        if self.saturated:
+            raise EngineSaturated(f"{self.pending} capturas en cola")
+        self.start()
+        executor = self._executor
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            # Un proceso murió (OOM, fallo de tesserocr): el pool ya no sirve y el siguiente start() crea otro
+            if self._executor is executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+                logger.error("Un proceso de OCR terminó de forma inesperada; se reinicia el motor de OCR.")
+            raise
+        finally:
+            self.pending -= 1
+
+    async def process(self, data: bytes, roi: dict = None) -> dict:
+        return await self.run(ocr_utils.process_screenshot, data, roi)
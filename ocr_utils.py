@@ -1,11 +1,23 @@
 from PIL import Image, ImageEnhance, ImageFilter
+from io import BytesIO
 import re
-from difflib import SequenceMatcher
 import pytesseract
 import os
+import threading
+import time
 from dotenv import load_dotenv
 import logging
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
 load_dotenv()
 logger = logging.getLogger('leaguebot')
 
@@ -13,6 +25,14 @@ logger = logging.getLogger('leaguebot')
 TESSERACT_PATH = os.getenv("TESSERACT_PATH", "/usr/bin/tesseract")
 pytesseract.pytesseract.tesseract_cmd = TESSERACT_PATH
 
+# Motor de preprocesado: 'pillow' (cinco pasadas de Pillow) o 'numpy' (contraste, nitidez y umbral fusionados)
+OCR_PREPROCESS = os.getenv("OCR_PREPROCESS", "pillow").lower()
+
+# Backend de Tesseract: 'tesserocr' (API persistente en memoria), 'pytesseract' (un proceso tesseract por imagen)
+# o 'auto' (tesserocr si está instalado). tesserocr necesita libtesseract y se instala aparte.
+OCR_BACKEND = os.getenv("OCR_BACKEND", "auto").lower()
+TESSDATA_PATH = os.getenv("TESSDATA_PREFIX")
+
 def do_ocr(image_path: str) -> str:
     try:
         return pytesseract.image_to_string(image_path, lang='eng+spa')
@@ -30,6 +50,209 @@ def preprocess_image_for_ocr(img: Image.Image) -> Image.Image:
     img = img.point(lambda x: 255 if x > thresh else 0, mode='1')
     return img
 
+def _otsu_threshold(gray) -> int:
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256, dtype=np.float64)
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    sum_bg = np.cumsum(hist * levels)
+    mean_bg = sum_bg / np.maximum(weight_bg, 1)
+    mean_fg = (sum_bg[-1] - sum_bg) / np.maximum(weight_fg, 1)
+    between = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return int(np.argmax(between))
+
+def preprocess_image_for_ocr_numpy(img: Image.Image) -> Image.Image:
+    # El reescalado LANCZOS sigue en Pillow (C); el resto se hace en una sola pasada sobre el array
+    img = img.convert('L')
+    img = img.resize((img.width * 2, img.height * 2), Image.Resampling.LANCZOS)
+    a = np.asarray(img, dtype=np.float32)
+    mean = float(a.mean())
+
+    # SHARPEN de Pillow (kernel 3x3 con centro 32, vecinos -2, escala 16). El kernel suma 1, así que
+    # contraste y nitidez se combinan: contraste(nitidez(x)) = media + 2 * (nitidez(x) - media)
+    p = np.pad(a, 1, mode='edge')
+    neighbours = (p[:-2, :-2] + p[:-2, 1:-1] + p[:-2, 2:] + p[1:-1, :-2] + p[1:-1, 2:]
+                  + p[2:, :-2] + p[2:, 1:-1] + p[2:, 2:])
+    sharpened = (32.0 * a - 2.0 * neighbours) / 16.0
+    enhanced = np.clip(mean + 2.0 * (sharpened - mean), 0, 255).astype(np.uint8)
+
+    # Umbral adaptativo (Otsu) en vez del 160 fijo
+    binary = (enhanced > _otsu_threshold(enhanced)).astype(np.uint8)
+
+    # Sobre una imagen binaria la mediana 3x3 es un voto de mayoría de los 9 vecinos
+    b = np.pad(binary, 1, mode='edge')
+    votes = (b[:-2, :-2] + b[:-2, 1:-1] + b[:-2, 2:] + b[1:-1, :-2] + b[1:-1, 1:-1] + b[1:-1, 2:]
+             + b[2:, :-2] + b[2:, 1:-1] + b[2:, 2:])
+    return Image.fromarray(np.where(votes >= 5, 255, 0).astype(np.uint8)).convert('1')
+
+def preprocess(img: Image.Image, engine: str = None) -> Image.Image:
+    engine = engine or OCR_PREPROCESS
+    if engine == 'numpy':
+        if np is not None:
+            return preprocess_image_for_ocr_numpy(img)
+        logger.warning("OCR_PREPROCESS=numpy pero numpy no está instalado; se usa Pillow.")
+    return preprocess_image_for_ocr(img)
+
+class PytesseractBackend:
+    name = 'pytesseract'
+
+    def image_to_string(self, img: Image.Image, psm: int = None, whitelist: str = None) -> str:
+        config = []
+        if psm is not None:
+            config.append(f"--psm {psm}")
+        if whitelist:
+            config.append(f"-c tessedit_char_whitelist={whitelist}")
+        return pytesseract.image_to_string(img, lang='eng', config=' '.join(config))
+
+class TesserocrBackend:
+    """Una instancia de Tesseract cargada una sola vez; las imágenes se pasan en memoria sin archivos temporales."""
+    name = 'tesserocr'
+
+    def __init__(self):
+        kwargs = {'path': TESSDATA_PATH} if TESSDATA_PATH else {}
+        self._api = tesserocr.PyTessBaseAPI(lang='eng', **kwargs)
+
+    def image_to_string(self, img: Image.Image, psm: int = None, whitelist: str = None) -> str:
+        api = self._api
+        # Mismos valores por defecto que el binario de tesseract
+        api.SetPageSegMode(psm if psm is not None else tesserocr.PSM.AUTO)
+        api.SetVariable('tessedit_char_whitelist', whitelist or '')
+        try:
+            api.SetImage(img)
+            return api.GetUTF8Text()
+        finally:
+            api.Clear()
+
+    def close(self):
+        self._api.End()
+
+# Un backend por hilo: PyTessBaseAPI no se puede compartir entre hilos. En el pool de OCR cada proceso
+# tiene un único hilo, así que el modelo se carga una vez por proceso.
+_backends = threading.local()
+
+def _create_backend(name: str):
+    if name in ('auto', 'tesserocr') and tesserocr is not None:
+        try:
+            return TesserocrBackend()
+        except RuntimeError as e:
+            logger.warning(f"No se pudo iniciar tesserocr ({e}); se usa pytesseract.")
+    elif name == 'tesserocr':
+        logger.warning("OCR_BACKEND=tesserocr pero tesserocr no está instalado; se usa pytesseract.")
+    return PytesseractBackend()
+
+def get_backend(name: str = None):
+    name = name or OCR_BACKEND
+    backend = getattr(_backends, name, None)
+    if backend is None:
+        backend = _create_backend(name)
+        setattr(_backends, name, backend)
+    return backend
+
+def init_ocr_worker():
+    # Inicializador del pool de procesos: el modelo se carga al arrancar el worker, no con la primera captura
+    backend = get_backend()
+    logger.info(f"Worker de OCR {os.getpid()} listo con backend {backend.name}.")
+
+def ocr_text(img: Image.Image, psm: int = None, whitelist: str = None) -> str:
+    return get_backend().image_to_string(img, psm=psm, whitelist=whitelist)
+
+# Regiones de interés: cajas en fracciones del ancho y alto (x0, y0, x1, y1), configurables por guild.
+# Cada región se lee por separado con su modo de segmentación y su lista de caracteres permitidos.
+ROI_REGIONS = {
+    'nicktags': {'psm': 6, 'whitelist': "#0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz._-"},
+    'clock': {'psm': 7, 'whitelist': "0123456789:."},
+}
+# Reloj de la barra de estado. Se usa si el guild solo configura la región de nicktags, para no leer
+# la captura completa solo por la hora. Formato: "x0,y0,x1,y1" en fracciones.
+OCR_DEFAULT_CLOCK_ROI = [float(v) for v in os.getenv("OCR_DEFAULT_CLOCK_ROI", "0,0,1,0.1").split(',')]
+
+# El OCR confunde estas letras con dígitos; se unifican igual en la lectura completa y en la de nicktags
+_OCR_FOLD = str.maketrans({'O': '0', 'I': '1', 'l': '1'})
+
+def parse_roi(roi: dict) -> dict:
+    """Valida una configuración de ROI y la devuelve normalizada; lanza ValueError si no es válida."""
+    parsed = {}
+    for name, box in (roi or {}).items():
+        if name not in ROI_REGIONS:
+            raise ValueError(f"Región desconocida: {name}")
+        if not isinstance(box, (list, tuple)) or len(box) != 4:
+            raise ValueError(f"La región {name} debe tener cuatro valores (x0, y0, x1, y1).")
+        x0, y0, x1, y1 = (float(v) for v in box)
+        if not (0 <= x0 < x1 <= 1 and 0 <= y0 < y1 <= 1):
+            raise ValueError(f"La región {name} debe estar dentro de la imagen con x0 < x1 e y0 < y1.")
+        parsed[name] = [x0, y0, x1, y1]
+    return parsed
+
+def crop_region(img: Image.Image, box: list) -> Image.Image:
+    x0, y0, x1, y1 = box
+    return img.crop((round(x0 * img.width), round(y0 * img.height), round(x1 * img.width), round(y1 * img.height)))
+
+def _timed(timings: dict, stage: str, func, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+def _ocr_full_image(img: Image.Image, timings: dict) -> str:
+    processed = _timed(timings, 'preprocess', preprocess, img)
+    text = _timed(timings, 'ocr', ocr_text, processed)
+    return text.translate(_OCR_FOLD)
+
+def _ocr_region(img: Image.Image, name: str, box: list, timings: dict) -> str:
+    processed = _timed(timings, 'preprocess', preprocess, crop_region(img, box))
+    # La lista de caracteres de nicktags admite O, I y l, así que se unifican como en la lectura completa
+    return _timed(timings, 'ocr', ocr_text, processed, **ROI_REGIONS[name]).translate(_OCR_FOLD)
+
+# Las capturas de un mismo juego comparten la misma plantilla: con un dHash de 8x8 dos marcadores distintos
+# quedan a 2-3 bits. Con 32x32 (1024 bits) los nombres y el reloj ya separan capturas distintas.
+IMAGE_HASH_SIZE = 32
+
+def image_dhash(data: bytes, size: int = IMAGE_HASH_SIZE) -> bytes:
+    """Hash perceptual (dHash de size x size bits) de una imagen."""
+    img = Image.open(BytesIO(data))
+    # En JPEG draft decodifica directamente a escala reducida
+    img.draft('L', (size * 4, size * 4))
+    pixels = list(img.convert('L').resize((size + 1, size), Image.Resampling.BOX).getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            value = (value << 1) | (pixels[row * (size + 1) + col] > pixels[row * (size + 1) + col + 1])
+    return value.to_bytes(size * size // 8, 'big')
+
+TIME_PATTERN = re.compile(r'\b([01]?\d|2[0-3])[:.][0-5]\d\b')
+
+def extract_screenshot_time(text: str) -> str | None:
+    time_match = TIME_PATTERN.search(text)
+    return time_match.group(0).replace('.', ':') if time_match else None
+
+def process_screenshot(data: bytes, roi: dict = None) -> dict:
+    # Se ejecuta en un proceso del pool de OCR: recibe los bytes de la imagen y devuelve solo datos serializables.
+    # 'timings' lleva la duración de cada etapa para las métricas del proceso principal.
+    timings = {}
+    img = Image.open(BytesIO(data))
+    _timed(timings, 'decode', img.load)
+    roi = roi or {}
+    full_text = None
+    if 'nicktags' in roi:
+        nicktags_text = _ocr_region(img, 'nicktags', roi['nicktags'], timings)
+    else:
+        nicktags_text = full_text = _ocr_full_image(img, timings)
+    if 'clock' in roi:
+        clock_text = _ocr_region(img, 'clock', roi['clock'], timings)
+    elif full_text is not None:
+        # Sin región de reloj se reutiliza la lectura completa (solo se hace una vez)
+        clock_text = full_text
+    else:
+        clock_text = _ocr_region(img, 'clock', OCR_DEFAULT_CLOCK_ROI, timings)
+    text = nicktags_text if clock_text is nicktags_text else f"{nicktags_text}\n{clock_text}"
+    return {
+        'text': text,
+        'nicktags': extract_nicktags(nicktags_text),
+        'screenshot_time': extract_screenshot_time(clock_text),
+        'timings': timings,
+    }
+
 def extract_nicktags(text: str) -> list[str]:
     pattern = re.compile(r'#\w+\s+([\w\.\-]+)', re.IGNORECASE)
     matches = pattern.findall(text)
@@ -37,24 +260,3 @@ def extract_nicktags(text: str) -> list[str]:
 
 def normalize_name(name: str) -> str:
     return re.sub(r'\s+', ' ', name.strip().lower())
-
-def fuzzy_match(a: str, b: str, threshold: float = 0.6) -> bool:
-    score = SequenceMatcher(None, normalize_name(a), normalize_name(b)).ratio()
-    return score >= threshold
-
-def find_best_nicktag(nicktags: list[str], discord_name: str, discord_display: str) -> str | None:
-    discord_name = normalize_name(discord_name)
-    discord_display = normalize_name(discord_display)
-    for tag in nicktags:
-        tag_norm = normalize_name(tag)
-        if tag_norm == discord_name or tag_norm == discord_display:
-            return tag
-    for tag in nicktags:
-        tag_norm = normalize_name(tag)
-        if discord_name in tag_norm or discord_display in tag_norm or tag_norm in discord_name or tag_norm in discord_display:
-            return tag
-    for tag in nicktags:
-        tag_norm = normalize_name(tag)
-        if fuzzy_match(tag_norm, discord_name) or fuzzy_match(tag_norm, discord_display):
-            return tag
-    return None
@@ -0,0 +1,119 @@
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+import types
+
+import metrics
+
+# Instrumentación de los accesores de database.py: llamadas, latencia, filas devueltas y errores
+# por función y guild, más un log de consultas lentas. database.py envuelve sus funciones al final
+# del módulo, así que tanto `import database` como `from database import ...` ven la versión medida.
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "250"))
+
+database_logger = logging.getLogger('database')
+
+_local = threading.local()
+
+class _ErrorCounter(logging.Filter):
+    # Los accesores capturan sqlite3.Error y lo registran en el logger 'database' sin relanzarlo:
+    # cada error registrado mientras hay una llamada en curso se atribuye a esa llamada.
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR:
+            calls = getattr(_local, 'calls', None)
+            if calls:
+                calls[-1][0] += 1
+        return True
+
+database_logger.addFilter(_ErrorCounter())
+
+def _count_rows(result) -> int:
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    if isinstance(result, dict):
+        # {id: fila} cuenta cada fila; una fila suelta como dict cuenta una
+        return len(result) if result and isinstance(next(iter(result.values())), dict) else 1
+    return 0
+
+def _guild_index(func) -> int:
+    params = list(inspect.signature(func).parameters)
+    return params.index('guild_id') if 'guild_id' in params else -1
+
+def _wrap(func):
+    name = func.__name__
+    index = _guild_index(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if 'guild_id' in kwargs:
+            guild_id = kwargs['guild_id']
+        else:
+            guild_id = args[index] if 0 <= index < len(args) else None
+        guild = 'global' if guild_id is None else str(guild_id)
+        calls = getattr(_local, 'calls', None)
+        if calls is None:
+            calls = _local.calls = []
+        frame = [0]
+        calls.append(frame)
+        start = time.perf_counter()
+        result = None
+        try:
+            result = func(*args, **kwargs)
+            return result
+        except Exception:
+            frame[0] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            calls.pop()
+            metrics.DB_CALL_SECONDS.labels(function=name, guild=guild).observe(elapsed)
+            rows = _count_rows(result)
+            if rows:
+                metrics.DB_ROWS_TOTAL.labels(function=name, guild=guild).inc(rows)
+            if frame[0]:
+                metrics.DB_ERRORS_TOTAL.labels(function=name, guild=guild).inc(frame[0])
+            if elapsed * 1000 >= SLOW_QUERY_MS:
+                database_logger.warning(f"Consulta lenta: {name} en guild {guild} tardó {elapsed * 1000:.1f} ms "
+                                        f"(umbral {SLOW_QUERY_MS:.0f} ms).")
+
+    return wrapper
+
+def instrument(namespace: dict, exclude: set = frozenset()) -> list:
+    """Sustituye en `namespace` las funciones públicas definidas en ese módulo por su versión medida."""
+    module = namespace['__name__']
+    wrapped = []
+    for name, func in list(namespace.items()):
+        if (name.startswith('_') or name in exclude or not isinstance(func, types.FunctionType)
+                or func.__module__ != module or hasattr(func, '__wrapped__')):
+            continue
+        namespace[name] = _wrap(func)
+        wrapped.append(name)
+    return wrapped
+
+SORT_KEYS = ('p95', 'total', 'calls', 'errors')
+
+def top_accessors(limit: int = 10, order: str = 'p95', guild_id: int = None) -> list:
+    """Accesores ordenados por p95, tiempo total, llamadas o errores, sumando todos los guilds o solo uno."""
+    match = {'guild': guild_id} if guild_id is not None else {}
+    latencies = metrics.aggregate(metrics.DB_CALL_SECONDS, 'function', **match)
+    rows = metrics.aggregate(metrics.DB_ROWS_TOTAL, 'function', **match)
+    errors = metrics.aggregate(metrics.DB_ERRORS_TOTAL, 'function', **match)
+    stats = []
+    for name, histogram in latencies.items():
+        if not histogram.count:
+            continue
+        stats.append({
+            'function': name,
+            'calls': histogram.count,
+            'total': histogram.sum,
+            'mean_ms': histogram.sum / histogram.count * 1000,
+            'p95_ms': histogram.quantile(0.95) * 1000,
+            'rows': int(rows[name].value) if name in rows else 0,
+            'errors': int(errors[name].value) if name in errors else 0,
+        })
+    key = {'p95': 'p95_ms', 'total': 'total', 'calls': 'calls', 'errors': 'errors'}[order]
+    stats.sort(key=lambda item: item[key], reverse=True)
+    return stats[:limit]
@@ -0,0 +1,60 @@
+import os
+import aiohttp
+from PIL import ImageFile
+
+MAX_SCREENSHOT_BYTES = int(os.getenv("MAX_SCREENSHOT_BYTES", str(8 * 1024 * 1024)))
+MAX_SCREENSHOT_PIXELS = int(os.getenv("MAX_SCREENSHOT_PIXELS", str(3840 * 2160)))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "20"))
+CHUNK_SIZE = 64 * 1024
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+IMAGE_CONTENT_TYPES = ('image/png', 'image/jpeg')
+
+class DownloadRejected(Exception):
+    """La imagen no se descarga o se descarta; el mensaje se muestra al usuario."""
+
+def create_session() -> aiohttp.ClientSession:
+    # Una sola sesión compartida reutiliza las conexiones TLS al CDN de Discord
+    return aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT),
+        connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300),
+    )
+
+def _check_content_type(content_type: str):
+    if content_type and content_type.split(';')[0].strip().lower() not in IMAGE_CONTENT_TYPES:
+        raise DownloadRejected("Por favor, envía una imagen en formato PNG o JPG.")
+
+def _check_dimensions(width: int, height: int):
+    if width and height and width * height > MAX_SCREENSHOT_PIXELS:
+        raise DownloadRejected(f"La imagen es demasiado grande ({width}x{height}). Recórtala o redúcela antes de enviarla.")
+
+def check_attachment(attachment, max_bytes: int = MAX_SCREENSHOT_BYTES):
+    # Discord ya informa tipo, tamaño y dimensiones: se valida antes de descargar nada
+    if not attachment.filename.lower().endswith(IMAGE_EXTENSIONS):
+        raise DownloadRejected("Por favor, envía una imagen en formato PNG o JPG.")
+    _check_content_type(attachment.content_type)
+    if attachment.size and attachment.size > max_bytes:
+        raise DownloadRejected(f"La imagen supera el máximo de {max_bytes // (1024 * 1024)} MB.")
+    _check_dimensions(attachment.width, attachment.height)
+
+async def download_attachment(session: aiohttp.ClientSession, attachment, max_bytes: int = MAX_SCREENSHOT_BYTES) -> bytes:
+    check_attachment(attachment, max_bytes)
+    async with session.get(attachment.url) as response:
+        response.raise_for_status()
+        _check_content_type(response.headers.get('Content-Type'))
+        if response.content_length and response.content_length > max_bytes:
+            raise DownloadRejected(f"La imagen supera el máximo de {max_bytes // (1024 * 1024)} MB.")
+        data = bytearray()
+        parser = ImageFile.Parser()
+        header_checked = False
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            data += chunk
+            if len(data) > max_bytes:
+                raise DownloadRejected(f"La imagen supera el máximo de {max_bytes // (1024 * 1024)} MB.")
+            if not header_checked:
+                # Las dimensiones están en la cabecera: se cortan las imágenes enormes sin decodificarlas
+                parser.feed(chunk)
+                if parser.image is not None:
+                    _check_dimensions(*parser.image.size)
+                    header_checked = True
+        return bytes(data)
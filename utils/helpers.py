@@ -1,6 +1,6 @@
 from discord import Interaction
 from .make_embed import error
-from database import get_team_by_name, get_team_by_manager, get_player_by_id
+from async_database import get_team_by_name, get_team_by_manager, get_identity
 
 async def send_error(interaction: Interaction, message: str):
     embed = error(message)
@@ -8,9 +8,9 @@ async def send_error(interaction: Interaction, message: str):
 
 async def resolve_team(interaction: Interaction, name: str = None):
     if name:
-        team = get_team_by_name(name)
+        team = await get_team_by_name(interaction.guild.id, name)
     else:
-        team = get_team_by_manager(interaction.user.id)
+        team = await get_team_by_manager(interaction.guild.id, interaction.user.id)
     if not team:
         await send_error(interaction, 'Equipo no encontrado.')
         return None
@@ -22,8 +22,7 @@ async def check_ban(interaction: Interaction, player_id: int, guild_id: int = No
             await send_error(interaction, "No se pudo determinar el servidor.")
             return True
         guild_id = interaction.guild.id
-    player = get_player_by_id(guild_id, player_id)
-    if player and player['banned']:
+    if (await get_identity(guild_id, player_id))['banned']:
         await send_error(interaction, "Este jugador está sancionado y no puede interactuar con el bot.")
         return True
     return False
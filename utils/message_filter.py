@@ -0,0 +1,62 @@
+import logging
+from collections import Counter
+
+import async_database as db
+import database
+import metrics
+from utils.downloads import IMAGE_EXTENSIONS
+
+logger = logging.getLogger('bot')
+
+# Motivos de descarte, en el orden en que se comprueban
+REJECT_REASONS = ('bot', 'dm', 'no_attachments', 'not_image', 'unwatched_channel', 'no_arbiter_role')
+
+class MessageFilter:
+    """Descarta los mensajes que no son capturas usando solo estado en memoria.
+
+    Solo los mensajes con imágenes consultan la configuración, y sale de la caché de server_config: solo
+    el primero de cada guild (o el primero tras cambiar la configuración) llega a la base de datos.
+    """
+
+    def __init__(self):
+        self.counters = Counter()
+
+    async def check(self, message):
+        """Devuelve (motivo, config, adjuntos de imagen); el motivo es None si el mensaje pasa el filtro."""
+        reason, config, images = await self._check(message)
+        self.counters[reason or 'passed'] += 1
+        return reason, config, images
+
+    async def _check(self, message):
+        if message.author.bot:
+            return 'bot', None, []
+        if message.guild is None:
+            return 'dm', None, []
+        if not message.attachments:
+            return 'no_attachments', None, []
+        images = [a for a in message.attachments if a.filename.lower().endswith(IMAGE_EXTENSIONS)]
+        if not images:
+            # Solo se devuelve la configuración (para avisar al usuario) si ya está en caché y el canal es vigilado
+            config = database.peek_server_config(message.guild.id)
+            if config is database.CONFIG_NOT_CACHED or not config or message.channel.id not in config['ss_channel_ids']:
+                config = None
+            return 'not_image', config, []
+        with metrics.span('config'):
+            config = await db.get_server_config(message.guild.id)
+        if not config or message.channel.id not in config['ss_channel_ids']:
+            return 'unwatched_channel', config, []
+        if not config['arbiter_role_id']:
+            logger.warning(f"No se encontró rol de árbitro configurado en guild {message.guild.id}")
+            return 'no_arbiter_role', config, []
+        return None, config, images
+
+    def stats(self) -> dict:
+        total = sum(self.counters.values())
+        return {
+            'total': total,
+            'passed': self.counters['passed'],
+            'rejected': {reason: self.counters[reason] for reason in REJECT_REASONS},
+        }
+
+    def reset(self):
+        self.counters.clear()